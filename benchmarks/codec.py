@@ -0,0 +1,130 @@
+## @package codec
+# Microbenchmark of state and object decode/encode throughput in documents per second.
+#
+# "before" replays the previous serialization path: decode the whole BSON document
+# to dicts, rebuild every Transition eagerly and rebuild the transitions list on
+# every encode. "after" uses the codec layer (decode_state/encode_state) on raw BSON.
+# The object cases read the fields the engine needs from objects carrying a large payload.
+#   $ python benchmarks/codec.py --states 2000 --fanout 4 --triggers 4
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bson import BSON, ObjectId
+from bson.raw_bson import RawBSONDocument
+from main import Object, State, Transition, decode_object, decode_state, encode_object, encode_state
+from suite import generate_workflow, make_engine
+
+
+## Decode a state the way State.from_dictionary used to
+# @param bytes The BSON document
+# @return State The state
+def decode_before(data):
+	document = BSON(data).decode()
+	state = State(document)
+	transitions = {}
+	for transition in document["transitions"]:
+		transitions[transition["end"]] = Transition(None, transition)
+		transitions[transition["end"]].set_conditions(transition["conditions"])
+		transitions[transition["end"]].set_triggers(transition["triggers"])
+	state._transitions = transitions
+	return state
+
+## Encode a state the way State.to_dictionary used to
+# @param State The state
+# @return bytes The BSON document
+def encode_before(state):
+	document = dict(state._document)
+	document["transitions"] = [trans.to_dictionary() for trans in state.get_transitions().values()]
+	return BSON.encode(document)
+
+## Decode a state with the codec layer
+# @param bytes The BSON document
+# @return State The state
+def decode_after(data):
+	return decode_state(RawBSONDocument(data))
+
+## Encode a state with the codec layer
+# @param State The state
+# @return bytes The BSON document
+def encode_after(state):
+	return encode_state(state).raw
+
+## Read the engine fields of an object decoded to a dict
+# @param bytes The BSON document
+# @return Object The object
+def object_before(data):
+	it_object = Object()
+	it_object.from_dictionary(BSON(data).decode())
+	it_object.get_current_state()
+	it_object.get_triggers()
+	return it_object
+
+## Read the engine fields of an object backed by raw BSON
+# @param bytes The BSON document
+# @return Object The object
+def object_after(data):
+	it_object = decode_object(RawBSONDocument(data))
+	it_object.get_current_state()
+	it_object.get_triggers()
+	return it_object
+
+## Time a function over every input
+# @return float Calls per second
+def rate(function, inputs, repeat):
+	best = None
+	for index in range(repeat):
+		start = time.time()
+		for item in inputs:
+			function(item)
+		elapsed = time.time() - start
+		best = elapsed if best == None else min(best, elapsed)
+	return len(inputs) / best
+
+def run():
+	parser = argparse.ArgumentParser(description="State codec microbenchmark")
+	parser.add_argument("--states", type=int, default=2000)
+	parser.add_argument("--fanout", type=int, default=4)
+	parser.add_argument("--triggers", type=int, default=4)
+	parser.add_argument("--objects", type=int, default=2000)
+	parser.add_argument("--payload-fields", type=int, default=50)
+	parser.add_argument("--repeat", type=int, default=5)
+	args = parser.parse_args()
+
+	engine = make_engine("memory")
+	engine.load("bench")
+	states = generate_workflow(engine, {"states": args.states, "fanout": args.fanout, "triggers": args.triggers, "objects": 0})
+	encoded = [BSON.encode(state.to_dictionary()) for state in states]
+
+	decoded_before = [decode_before(data) for data in encoded]
+	decoded_after = [decode_after(data) for data in encoded]
+	results = {
+		"decode_before": rate(decode_before, encoded, args.repeat),
+		"decode_after": rate(decode_after, encoded, args.repeat),
+		#Decoding and then walking every transition (the worst case for lazy decoding)
+		"decode_after_transitions": rate(lambda data: decode_after(data).get_transitions(), encoded, args.repeat),
+		"encode_before": rate(encode_before, decoded_before, args.repeat),
+		"encode_after": rate(encode_after, decoded_after, args.repeat),
+	}
+
+	payload = dict(("field%d" % index, {"text": "x" * 200, "values": list(range(20))}) for index in range(args.payload_fields))
+	objects = []
+	for index in range(args.objects):
+		document = {"_id": ObjectId(), "state": "s0", "triggers": ["t0"], "version": "v"}
+		document.update(payload)
+		objects.append(BSON.encode(document))
+	results["object_decode_before"] = rate(object_before, objects, args.repeat)
+	results["object_decode_after"] = rate(object_after, objects, args.repeat)
+	#Activating a trigger and saving merges the overlay into the raw document
+	results["object_update_encode_after"] = rate(lambda data: encode_object(object_after(data)), objects, args.repeat)
+	results["object_update_encode_before"] = rate(lambda data: BSON.encode(object_before(data).to_dictionary()), objects, args.repeat)
+	for name, value in sorted(results.items()):
+		sys.stdout.write(json.dumps({"case": name, "docs_per_sec": round(value)}) + "\n")
+
+if __name__ == "__main__":
+	run()
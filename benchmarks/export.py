@@ -0,0 +1,122 @@
+## @package export
+# Benchmark of workflow export/import throughput and peak memory.
+#
+# Requires a local mongod. Every export and import runs in a fresh process that reports
+# its own peak RSS, which should stay flat as the number of objects grows. Results are
+# written to stdout as one JSON document per run:
+#   $ python benchmarks/export.py --objects 100000,1000000 --format bson --compress
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan
+
+
+## Create an engine configured for the benchmark collections
+# @param argparse.Namespace The command line arguments
+# @param string The database name
+# @return Cocopan The workflow engine
+def engine_for(args, db):
+	engine = Cocopan(args.connection)
+	engine.set_db_name(db)
+	engine.set_state_collection("states")
+	engine.set_object_collection("objects")
+	engine.set_workflow_collection("workflows")
+	engine.set_definition_collection("definitions")
+	return engine
+
+## Write a workflow with one state and the given number of objects straight to MongoDB
+# @param argparse.Namespace The command line arguments
+# @param int The number of objects
+def populate(args, objects):
+	engine = engine_for(args, args.db)
+	conn = engine.db.connect(args.db)
+	conn.client.drop_database(args.db)
+	conn["states"].insert_one({"_id": "s0", "description": "start", "transitions": []})
+	batch = []
+	for index in range(objects):
+		batch.append({"_id": ObjectId(), "workflow_id": "bench", "init_state": "s0", "state": "s0", "triggers": [], "version": None, "n": index})
+		if len(batch) == args.batch:
+			conn["objects"].insert_many(batch, ordered=False)
+			batch = []
+	if batch:
+		conn["objects"].insert_many(batch, ordered=False)
+	conn["objects"].create_index([("workflow_id", 1), ("tokens", 1)])
+	conn["workflows"].insert_one({"_id": "bench", "states": ["s0"]})
+
+## Export the workflow to a file (run in a child process)
+# @param argparse.Namespace The command line arguments
+# @param string Path of the export file
+# @param multiprocessing.Queue Queue receiving (seconds, peak RSS in KB)
+def export_worker(args, path, results):
+	engine = engine_for(args, args.db)
+	start = time.time()
+	with open(path, "wb") as stream:
+		engine.export("bench", stream, args.format, args.compress, args.batch)
+	results.put((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+## Import the workflow from a file into a second database (run in a child process)
+# @param argparse.Namespace The command line arguments
+# @param string Path of the export file
+# @param multiprocessing.Queue Queue receiving (seconds, peak RSS in KB)
+def import_worker(args, path, results):
+	engine = engine_for(args, args.db + "_import")
+	engine.db.connect(args.db + "_import").client.drop_database(args.db + "_import")
+	start = time.time()
+	with open(path, "rb") as stream:
+		engine.import_(stream, args.format, args.compress, args.batch)
+	results.put((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+## Run a phase in a fresh process
+# @return tuple (seconds, peak RSS in KB)
+def measure(target, args, path):
+	results = multiprocessing.Queue()
+	process = multiprocessing.Process(target=target, args=(args, path, results))
+	process.start()
+	result = results.get()
+	process.join()
+	return result
+
+def main():
+	parser = argparse.ArgumentParser(description="Workflow export/import benchmark")
+	parser.add_argument("--connection", default=None, help="MongoDB connection string")
+	parser.add_argument("--db", default="cocopan_bench_export")
+	parser.add_argument("--objects", default="100000,1000000", help="Comma separated object counts")
+	parser.add_argument("--format", default="bson", help="ndjson or bson")
+	parser.add_argument("--compress", action="store_true")
+	parser.add_argument("--batch", type=int, default=1000)
+	args = parser.parse_args()
+
+	handle, path = tempfile.mkstemp(suffix=".cocopan")
+	os.close(handle)
+	try:
+		for objects in [int(value) for value in args.objects.split(",")]:
+			populate(args, objects)
+			export_seconds, export_rss = measure(export_worker, args, path)
+			import_seconds, import_rss = measure(import_worker, args, path)
+			sys.stdout.write(json.dumps({
+				"objects": objects,
+				"format": args.format,
+				"compress": args.compress,
+				"bytes": os.path.getsize(path),
+				"export_objects_per_sec": round(objects / export_seconds),
+				"export_peak_rss_mb": round(export_rss / 1024.0, 1),
+				"import_objects_per_sec": round(objects / import_seconds),
+				"import_peak_rss_mb": round(import_rss / 1024.0, 1),
+			}) + "\n")
+			sys.stdout.flush()
+	finally:
+		os.remove(path)
+
+if __name__ == "__main__":
+	main()
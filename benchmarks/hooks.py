@@ -0,0 +1,142 @@
+## @package hooks
+# Benchmark of advancement throughput with state hooks.
+#
+# Runs on the in memory backend against a local HTTP stub server, so no mongod is
+# needed; the stub runs in a child process at the lowest priority, standing in for a
+# remote host. Every object is advanced two states, each calling an enter hook
+# on the stub, which answers after --delay seconds. The calls of the first advancement
+# are saved to the outbox and handed to the delivery process, which delivers them while
+# the second advancement is timed. Throughput is measured without hooks, with hooks
+# answering at once and with slow hooks (the best of --repeat runs each), and the
+# benchmark fails (exit status 1) if a run with hooks is more than --margin slower than
+# the run without. Delivery and the stub need a spare core to stay out of the way of
+# the engine; on a single core they share it with the timed advancement. Results are written to stdout as one JSON document per mode:
+#   $ python benchmarks/hooks.py --objects 20000 --delay 0.05
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase
+
+
+## HTTP stub answering every POST after the delay given in its path (/<milliseconds>)
+class StubHandler(BaseHTTPRequestHandler):
+
+	#Keep connections alive, as the dispatcher reuses them, and send each response in one write
+	protocol_version = "HTTP/1.1"
+	wbufsize = -1
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers["Content-Length"]))
+		time.sleep(int(self.path.strip("/")) / 1000.0)
+		self.send_response(200)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def log_message(self, *args):
+		pass
+
+## Threaded HTTP stub server
+class StubServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+## Serve the stub until the process is terminated
+# @param multiprocessing.Queue Queue receiving the port of the server
+def serve(ports):
+	#The stub stands in for a remote host, so it yields the CPU to the engine
+	os.nice(19)
+	server = StubServer(("127.0.0.1", 0), StubHandler)
+	ports.put(server.server_address[1])
+	server.serve_forever()
+
+## Time advancing every object of a three state workflow
+#   The objects advance to the second state and are saved (handing the hook calls over
+#   for delivery), then the advancement to the third state is timed while they are delivered
+# @param argparse.Namespace The command line arguments
+# @param string The hook target (None for no hook)
+# @return dict The results
+def run(args, target):
+	engine = Cocopan(database=MemoryDatabase())
+	engine.set_db_name("cocopan_bench_hooks")
+	engine.set_object_collection("objects")
+	engine.set_outbox_collection("outbox")
+	engine.load("bench")
+	states = [engine.new_state("s%d" % index) for index in range(3)]
+	for index in range(2):
+		transition = states[index].add_transition(states[index + 1])
+		transition.trigger_add("t%d" % index)
+		transition.condition_add(["t%d" % index])
+		if target != None:
+			states[index + 1].add_hook("enter", target, args.concurrency)
+	engine.publish()
+	object_ids = [it_object.get_field("_id") for it_object in engine.new_objects(states[0], args.objects)]
+	dispatcher = engine.hooks(args.workers, args.queue) if target != None else None
+
+	for object_id in object_ids:
+		engine.trigger_activate(object_id, "t0")
+	engine.save()
+	start = time.time()
+	for object_id in object_ids:
+		engine.trigger_activate(object_id, "t1")
+	seconds = time.time() - start
+	result = {"objects_per_sec": round(args.objects / seconds)}
+	start = time.time()
+	engine.save()
+	result["save_seconds"] = round(time.time() - start, 2)
+	if dispatcher != None:
+		start = time.time()
+		dispatcher.flush()
+		result["drain_seconds"] = round(time.time() - start, 2)
+		result.update(dispatcher.metrics())
+		dispatcher.close()
+	return result
+
+def main():
+	parser = argparse.ArgumentParser(description="State hook benchmark")
+	parser.add_argument("--objects", type=int, default=20000)
+	parser.add_argument("--delay", type=float, default=0.05, help="Seconds the slow hook takes to answer")
+	parser.add_argument("--workers", type=int, default=8)
+	parser.add_argument("--concurrency", type=int, default=8, help="Concurrent calls per hook")
+	parser.add_argument("--queue", type=int, default=100000)
+	parser.add_argument("--repeat", type=int, default=3, help="Runs per mode, the best is kept")
+	parser.add_argument("--margin", type=float, default=0.15, help="Largest allowed slowdown with hooks (0.15 = 15%%)")
+	args = parser.parse_args()
+
+	ports = multiprocessing.Queue()
+	server = multiprocessing.Process(target=serve, args=(ports,))
+	server.start()
+	base = "http://127.0.0.1:%d" % ports.get()
+	slower = []
+	try:
+		baseline = None
+		for mode, target in (("none", None), ("fast", base + "/0"), ("slow", base + "/%d" % int(args.delay * 1000))):
+			result = max((run(args, target) for index in range(args.repeat)), key=lambda result: result["objects_per_sec"])
+			if baseline == None:
+				baseline = result["objects_per_sec"]
+			result.update({"mode": mode, "objects": args.objects, "ratio": round(result["objects_per_sec"] / baseline, 2)})
+			if result["objects_per_sec"] < baseline * (1 - args.margin):
+				slower.append(mode)
+			sys.stdout.write(json.dumps(result) + "\n")
+			sys.stdout.flush()
+	finally:
+		server.terminate()
+		server.join()
+	if slower:
+		sys.stderr.write("Advancement with %s hooks is more than %d%% slower than without hooks\n" % (" and ".join(slower), round(args.margin * 100)))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,82 @@
+## @package predicates
+# Benchmark of guarded transition evaluation.
+#
+# Runs in process without MongoDB. A state with --transitions guarded transitions is
+# evaluated for --objects objects three ways: interpreting every guard expression per
+# object (eval of the source, the naive approach), the compiled guards one object at
+# a time (Definition.next_state) and the compiled guards in one batch
+# (Definition.next_states). Results are written to stdout as one JSON document per mode:
+#   $ python benchmarks/predicates.py --objects 100000 --transitions 8
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import compile_definition
+
+
+## Build a definition with one state whose transitions are guarded by field predicates
+# @param int The number of transitions
+# @return dict The definition document
+def build_definition(transitions):
+	state = {"_id": "s0", "description": "start", "transitions": []}
+	for index in range(transitions):
+		expression = "gpa >= %.1f and credits > %d and major in ('cs', 'math')" % (4.0 - index * 0.25, 120 - index * 10)
+		state["transitions"].append({"end": "s%d" % (index + 1), "triggers": {"review": False}, "conditions": [["review", {"expr": expression}]]})
+	return {"_id": "bench-predicates-%d" % transitions, "states": [state]}
+
+## Evaluate by interpreting the guard sources for every object
+# @param dict The definition document
+# @param list The object field dictionaries
+# @return list The next state of every object
+def naive(document, objects):
+	transitions = document["states"][0]["transitions"]
+	results = []
+	for fields in objects:
+		next_state = None
+		for transition in transitions:
+			for condition in transition["conditions"]:
+				if all(eval(item["expr"], {"__builtins__": {}}, dict(fields)) for item in condition if isinstance(item, dict)):
+					next_state = transition["end"]
+					break
+			if next_state != None:
+				break
+		results.append(next_state)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description="Guarded transition benchmark")
+	parser.add_argument("--objects", type=int, default=100000)
+	parser.add_argument("--transitions", type=int, default=8)
+	args = parser.parse_args()
+
+	random.seed(0)
+	objects = [{"gpa": round(random.uniform(2.0, 4.0), 2), "credits": random.randint(0, 130), "major": random.choice(["cs", "math", "art"])} for index in range(args.objects)]
+	document = build_definition(args.transitions)
+	definition = compile_definition(document)
+	triggers = set(["review"])
+
+	modes = (
+		("interpreted", lambda: naive(document, objects)),
+		("compiled", lambda: [definition.next_state("s0", triggers, fields.get) for fields in objects]),
+		("batched", lambda: definition.next_states("s0", [(triggers, fields.get) for fields in objects])),
+	)
+	expected = None
+	for mode, run in modes:
+		start = time.time()
+		results = run()
+		seconds = time.time() - start
+		if expected == None:
+			expected = results
+		elif results != expected:
+			raise SystemExit("%s disagrees with the interpreted results" % mode)
+		sys.stdout.write(json.dumps({"mode": mode, "objects": args.objects, "transitions": args.transitions, "objects_per_sec": round(args.objects / seconds)}) + "\n")
+		sys.stdout.flush()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,114 @@
+## @package shards
+# Benchmark of ShardPool events/sec scaling with the number of worker processes.
+#
+# The speedup is against the plain engine advancing the same events. Runs on the in memory
+# backend unless --backend mongo is given. Results are written to stdout as one JSON document per run:
+#   $ python benchmarks/shards.py --objects 20000 --events 1000000
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase, ShardPool
+
+
+## Build a ring shaped workflow where state i advances to state i+1 on trigger "t<i>"
+# @param Cocopan The workflow engine
+# @param int The number of states
+# @param int The number of objects
+def build_workflow(engine, states, objects):
+	ring = [engine.new_state("s%d" % index) for index in range(states)]
+	for index, state in enumerate(ring):
+		transition = state.add_transition(ring[(index + 1) % states])
+		transition.trigger_add("t%d" % index)
+		transition.condition_add(["t%d" % index])
+	engine.publish()
+	for index in range(objects):
+		engine.new_object(ring[0])
+
+## Time a stream of events through the plain engine
+# @param Cocopan The workflow engine
+# @param list The events to activate
+# @param int The number of events per batch
+# @return float Events per second
+def run_engine(engine, events, batch):
+	start = time.time()
+	for offset in range(0, len(events), batch):
+		engine.trigger_activate_many(events[offset:offset + batch])
+	return len(events) / (time.time() - start)
+
+## Time a stream of events through a pool
+#   The events are timed routed by the pool (trigger_activate_many), and routed ahead of
+#   time as a producer would (trigger_activate_sharded)
+# @param Cocopan The workflow engine
+# @param int The number of worker processes
+# @param list The events to activate
+# @param int The number of events per batch
+# @return tuple Events per second routed by the pool, and routed ahead of time
+def run(engine, processes, events, batch):
+	pool = ShardPool(engine, processes)
+	pool.start()
+	batches = [events[offset:offset + batch] for offset in range(0, len(events), batch)]
+	start = time.time()
+	for chunk in batches:
+		pool.trigger_activate_many(chunk)
+	routed = len(events) / (time.time() - start)
+	sharded = [pool.route(chunk) for chunk in batches]
+	start = time.time()
+	for chunk in sharded:
+		pool.trigger_activate_sharded(chunk)
+	presharded = len(events) / (time.time() - start)
+	pool.close()
+	return routed, presharded
+
+def main():
+	parser = argparse.ArgumentParser(description="ShardPool scaling benchmark")
+	parser.add_argument("--backend", default="memory", help="memory or mongo")
+	parser.add_argument("--connection", default=None, help="MongoDB connection string (mongo backend only)")
+	parser.add_argument("--db", default="cocopan_bench_shards")
+	parser.add_argument("--states", type=int, default=16)
+	parser.add_argument("--objects", type=int, default=20000)
+	parser.add_argument("--events", type=int, default=1000000)
+	parser.add_argument("--batch", type=int, default=50000)
+	parser.add_argument("--max-processes", type=int, default=multiprocessing.cpu_count())
+	args = parser.parse_args()
+
+	if args.backend == "memory":
+		engine = Cocopan(database=MemoryDatabase())
+	else:
+		engine = Cocopan(args.connection)
+	engine.set_db_name(args.db)
+	engine.set_state_collection("states")
+	engine.set_object_collection("objects")
+	engine.set_workflow_collection("workflows")
+	engine.set_definition_collection("definitions")
+	if args.backend != "memory":
+		engine.db.connect(args.db).client.drop_database(args.db)
+	engine.load("bench")
+	build_workflow(engine, args.states, args.objects)
+
+	random.seed(0)
+	object_ids = engine.get_object_ids()
+	events = [(random.choice(object_ids), "t%d" % random.randrange(args.states)) for index in range(args.events)]
+
+	#The pools leave the engine's objects as they are (nothing is synced), so the engine advancing
+	#them last starts from the same states
+	processes = 1
+	rates = []
+	while processes <= args.max_processes:
+		rates.append((processes, run(engine, processes, events, args.batch)))
+		processes = processes * 2
+	baseline = run_engine(engine, events, args.batch)
+	sys.stdout.write(json.dumps({"runner": "engine", "events_per_sec": round(baseline)}) + "\n")
+	for processes, (routed, presharded) in rates:
+		sys.stdout.write(json.dumps({"runner": "pool", "processes": processes, "events_per_sec": round(presharded), "speedup": round(presharded / baseline, 2), "routed_events_per_sec": round(routed), "routed_speedup": round(routed / baseline, 2)}) + "\n")
+	sys.stdout.flush()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,250 @@
+## @package suite
+# Benchmark suite for the engine's hot paths.
+#
+# Every case runs against synthetic workflows generated for each combination of
+# the --states, --fanout, --triggers and --objects values, on the in memory
+# stand-in and/or a local mongod. Results are written as JSON and compared
+# against a stored baseline; the exit status is 1 if any case regressed or has no
+# baseline entry (record one with --save-baseline when adding a case).
+#   $ python benchmarks/suite.py --backend memory --baseline benchmarks/baseline.json
+#   $ python benchmarks/suite.py --backend memory --save-baseline benchmarks/baseline.json
+#
+# The baseline is recorded with instrumentation disabled; comparing a run with
+# --stats against it shows the instrumentation overhead.
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import main
+from main import Cocopan, Database, MemoryDatabase, State
+
+
+## Database name used by the benchmarks
+DB_NAME = "cocopan_bench_suite"
+
+## Create an engine on a clean database
+# @param string The backend ("memory" or "mongo")
+# @param string MongoDB connection string (mongo backend only)
+# @return Cocopan The workflow engine
+def make_engine(backend, connection=None):
+	if backend == "memory":
+		database = MemoryDatabase()
+	else:
+		database = Database(connection)
+		database.connect(DB_NAME).client.drop_database(DB_NAME)
+	return configure(Cocopan(database=database))
+
+## Configure the benchmark collections on an engine
+# @param Cocopan The workflow engine
+# @return Cocopan The workflow engine
+def configure(engine):
+	engine.set_db_name(DB_NAME)
+	engine.set_state_collection("states")
+	engine.set_object_collection("objects")
+	engine.set_workflow_collection("workflows")
+	engine.set_definition_collection("definitions")
+	return engine
+
+## Generate a synthetic workflow
+#   State i has `fanout` transitions to the following states, each activated by one
+#   condition over `triggers` trigger keys
+# @param Cocopan The workflow engine (with a loaded workflow)
+# @param dict The generator parameters (states, fanout, triggers, objects)
+# @return list The created states
+def generate_workflow(engine, params):
+	states = [engine.new_state("s%d" % index) for index in range(params["states"])]
+	for index, state in enumerate(states):
+		state.set_name("S%d" % index)
+		for offset in range(1, params["fanout"] + 1):
+			transition = state.add_transition(states[(index + offset) % len(states)])
+			keys = ["t%d_%d_%d" % (index, offset, trigger) for trigger in range(params["triggers"])]
+			for key in keys:
+				transition.trigger_add(key)
+			transition.condition_add(keys)
+			#Half of the triggers are active so evaluation scans whole conditions
+			for key in keys[:len(keys) // 2]:
+				transition.trigger_activate(key)
+	engine.publish()
+	for index in range(params["objects"]):
+		engine.new_object(states[index % len(states)])
+	return states
+
+## Time Transition.isActivated over every transition
+def case_is_activated(engine, states, params):
+	transitions = [trans for state in states for trans in state.get_transitions().values()]
+	start = time.time()
+	for repeat in range(200):
+		for trans in transitions:
+			trans.isActivated()
+	return time.time() - start, 200 * len(transitions)
+
+## Time State.to_dictionary over every state
+def case_state_to_dictionary(engine, states, params):
+	start = time.time()
+	for state in states:
+		state.to_dictionary()
+	return time.time() - start, len(states)
+
+## Time State.from_dictionary over every state
+def case_state_from_dictionary(engine, states, params):
+	documents = [state.to_dictionary() for state in states]
+	start = time.time()
+	for document in documents:
+		State(document).from_dictionary(document)
+	return time.time() - start, len(documents)
+
+## Time Cocopan.save of the whole workflow
+def case_save(engine, states, params):
+	start = time.time()
+	engine.save()
+	return time.time() - start, len(states) + params["objects"]
+
+## Time Cocopan.load of the whole workflow into a fresh engine
+def case_load(engine, states, params):
+	engine.save()
+	loader = configure(Cocopan(database=engine.db))
+	start = time.time()
+	loader.load("bench")
+	return time.time() - start, len(states) + params["objects"]
+
+## Time Cocopan.load with the "engine" projection profile
+def case_load_engine(engine, states, params):
+	engine.save()
+	loader = configure(Cocopan(database=engine.db))
+	start = time.time()
+	loader.load("bench", "engine")
+	return time.time() - start, len(states) + params["objects"]
+
+## Time Cocopan.new_object
+def case_new_object(engine, states, params):
+	start = time.time()
+	for index in range(params["objects"]):
+		engine.new_object(states[index % len(states)])
+	return time.time() - start, params["objects"]
+
+## Time Cocopan.new_objects
+def case_new_objects(engine, states, params):
+	start = time.time()
+	engine.new_objects(states[0], params["objects"])
+	return time.time() - start, params["objects"]
+
+## Time building the Graphviz graph
+def case_graph(engine, states, params):
+	start = time.time()
+	for repeat in range(10):
+		engine.graph()
+	return time.time() - start, 10 * len(states)
+
+## Benchmark cases as (name, function(engine, states, params) returning (seconds, operations))
+CASES = [
+	("transition.isActivated", case_is_activated),
+	("state.to_dictionary", case_state_to_dictionary),
+	("state.from_dictionary", case_state_from_dictionary),
+	("cocopan.save", case_save),
+	("cocopan.load", case_load),
+	("cocopan.load_engine", case_load_engine),
+	("cocopan.new_object", case_new_object),
+	("cocopan.new_objects", case_new_objects),
+	("cocopan.graph", case_graph),
+]
+
+## Run one case, keeping the best of several repeats
+# @param argparse.Namespace The command line arguments
+# @param string The backend
+# @param string The case name
+# @param function The case function
+# @param dict The generator parameters
+# @return dict The result
+def run_case(args, backend, name, case, params):
+	best = None
+	for repeat in range(args.repeat):
+		engine = make_engine(backend, args.connection)
+		engine.load("bench")
+		states = generate_workflow(engine, params)
+		seconds, operations = case(engine, states, params)
+		if best == None or seconds < best[0]:
+			best = (seconds, operations)
+	key = "%s|%s|%s" % (name, backend, ",".join("%s=%d" % item for item in sorted(params.items())))
+	return {"key": key, "case": name, "backend": backend, "params": params, "seconds": best[0], "ops_per_sec": best[1] / best[0] if best[0] > 0 else None}
+
+## Compare results against a baseline
+# @param list The results
+# @param dict The baseline in the form key => seconds
+# @param float Allowed slowdown as a fraction of the baseline
+# @return tuple The keys of the regressed cases and the keys of the cases without a baseline entry
+def compare(results, baseline, tolerance):
+	regressions = []
+	missing = []
+	for result in results:
+		base = baseline.get(result["key"])
+		if base == None:
+			missing.append(result["key"])
+			sys.stderr.write("MISSING %s: no baseline entry\n" % result["key"])
+			continue
+		ratio = result["seconds"] / base if base > 0 else 1.0
+		result["baseline_ratio"] = round(ratio, 3)
+		if ratio > 1 + tolerance:
+			regressions.append(result["key"])
+			sys.stderr.write("REGRESSION %s: %.6fs vs baseline %.6fs (x%.2f)\n" % (result["key"], result["seconds"], base, ratio))
+	return regressions, missing
+
+## Parse a comma separated list of integers
+def int_list(value):
+	return [int(item) for item in value.split(",")]
+
+def run():
+	parser = argparse.ArgumentParser(description="Cocopan benchmark suite")
+	parser.add_argument("--backend", default="memory", help="Comma separated backends: memory, mongo")
+	parser.add_argument("--connection", default=None, help="MongoDB connection string")
+	parser.add_argument("--states", type=int_list, default=[50, 500])
+	parser.add_argument("--fanout", type=int_list, default=[2])
+	parser.add_argument("--triggers", type=int_list, default=[3])
+	parser.add_argument("--objects", type=int_list, default=[1000])
+	parser.add_argument("--cases", default=None, help="Comma separated case names (default: all)")
+	parser.add_argument("--repeat", type=int, default=5)
+	parser.add_argument("--output", default="bench_output.txt", help="File the JSON results are written to")
+	parser.add_argument("--baseline", default=None, help="Baseline file to compare against")
+	parser.add_argument("--tolerance", type=float, default=0.5)
+	parser.add_argument("--save-baseline", default=None, help="Write the results as a new baseline file")
+	parser.add_argument("--stats", action="store_true", help="Run with instrumentation enabled")
+	parser.add_argument("--prometheus", default=None, help="Write the instrumentation statistics to this file")
+	args = parser.parse_args()
+
+	if args.stats:
+		main.enable_stats()
+
+	selected = args.cases.split(",") if args.cases else None
+	results = []
+	for backend in args.backend.split(","):
+		for states, fanout, triggers, objects in itertools.product(args.states, args.fanout, args.triggers, args.objects):
+			params = {"states": states, "fanout": fanout, "triggers": triggers, "objects": objects}
+			for name, case in CASES:
+				if selected == None or name in selected:
+					results.append(run_case(args, backend, name, case, params))
+
+	regressions = []
+	missing = []
+	if args.baseline:
+		with open(args.baseline) as baseline_file:
+			regressions, missing = compare(results, json.load(baseline_file), args.tolerance)
+
+	with open(args.output, "w") as output_file:
+		json.dump({"results": results, "regressions": regressions, "missing": missing, "stats": main.stats_snapshot()}, output_file, indent=1, sort_keys=True)
+
+	if args.prometheus:
+		main.write_prometheus(args.prometheus)
+
+	if args.save_baseline:
+		with open(args.save_baseline, "w") as baseline_file:
+			json.dump(dict((result["key"], result["seconds"]) for result in results), baseline_file, indent=1, sort_keys=True)
+
+	sys.exit(1 if regressions or missing else 0)
+
+if __name__ == "__main__":
+	run()
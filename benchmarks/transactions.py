@@ -0,0 +1,66 @@
+## @package transactions
+# Benchmark of save throughput with and without transactions.
+#
+# Requires a local mongod running as a replica set (a single node one is enough):
+#   $ mongod --replSet rs0 ... && mongo --eval "rs.initiate()"
+# Every run advances all objects one state and then times saving them. Results are
+# written to stdout as one JSON document per mode:
+#   $ python benchmarks/transactions.py --connection "mongodb://localhost/?replicaSet=rs0" --objects 20000
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan
+from shards import build_workflow
+
+
+## Create an engine configured for the benchmark collections
+# @param argparse.Namespace The command line arguments
+# @return Cocopan The workflow engine
+def engine_for(args):
+	engine = Cocopan(args.connection)
+	engine.set_db_name(args.db)
+	engine.set_state_collection("states")
+	engine.set_object_collection("objects")
+	engine.set_workflow_collection("workflows")
+	engine.set_definition_collection("definitions")
+	return engine
+
+## Time saving every object after advancing it
+# @param argparse.Namespace The command line arguments
+# @param bool Save in transactions
+# @param int Number of objects per transaction
+# @return float Objects saved per second
+def run(args, transactional, batch_size):
+	engine = engine_for(args)
+	engine.db.connect(args.db).client.drop_database(args.db)
+	engine.load("bench")
+	build_workflow(engine, args.states, args.objects)
+	engine.save()
+	for object_id in engine.get_object_ids():
+		engine.trigger_activate(object_id, "t0")
+	start = time.time()
+	engine.save(transactional, batch_size)
+	return args.objects / (time.time() - start)
+
+def main():
+	parser = argparse.ArgumentParser(description="Transactional save benchmark")
+	parser.add_argument("--connection", default="mongodb://localhost/?replicaSet=rs0", help="MongoDB connection string (of a replica set)")
+	parser.add_argument("--db", default="cocopan_bench_transactions")
+	parser.add_argument("--states", type=int, default=16)
+	parser.add_argument("--objects", type=int, default=20000)
+	parser.add_argument("--batch", type=int, default=1000)
+	args = parser.parse_args()
+
+	for mode, transactional, batch_size in (("none", False, args.batch), ("batched", True, args.batch), ("per_object", True, 1)):
+		rate = run(args, transactional, batch_size)
+		sys.stdout.write(json.dumps({"mode": mode, "batch": batch_size if transactional else None, "objects_per_sec": round(rate)}) + "\n")
+		sys.stdout.flush()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,82 @@
+## @package work_queue
+# Benchmark of queued trigger processing throughput with competing worker processes.
+#
+# Requires a local mongod. Results are written to stdout as one JSON document per run:
+#   $ python benchmarks/work_queue.py --objects 2000 --events 50000
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan
+from shards import build_workflow
+
+
+## Create an engine configured for the benchmark collections
+# @param argparse.Namespace The command line arguments
+# @return Cocopan The workflow engine
+def engine_for(args):
+	engine = Cocopan(args.connection)
+	engine.set_db_name(args.db)
+	engine.set_state_collection("states")
+	engine.set_object_collection("objects")
+	engine.set_workflow_collection("workflows")
+	engine.set_definition_collection("definitions")
+	engine.set_queue_collection("queue")
+	return engine
+
+## Drain the queue from one worker process
+# @param argparse.Namespace The command line arguments
+def worker(args):
+	engine = engine_for(args)
+	engine.load("bench")
+	while engine.process_queue(args.batch, args.lease) > 0:
+		pass
+
+def main():
+	parser = argparse.ArgumentParser(description="Queue throughput benchmark")
+	parser.add_argument("--connection", default=None, help="MongoDB connection string")
+	parser.add_argument("--db", default="cocopan_bench_queue")
+	parser.add_argument("--states", type=int, default=16)
+	parser.add_argument("--objects", type=int, default=2000)
+	parser.add_argument("--events", type=int, default=50000)
+	parser.add_argument("--batch", type=int, default=500)
+	parser.add_argument("--lease", type=int, default=30)
+	parser.add_argument("--max-workers", type=int, default=multiprocessing.cpu_count())
+	args = parser.parse_args()
+
+	engine = engine_for(args)
+	engine.db.connect(args.db).client.drop_database(args.db)
+	engine.load("bench")
+	build_workflow(engine, args.states, args.objects)
+	engine.save()
+
+	random.seed(0)
+	object_ids = engine.get_object_ids()
+	events = [(random.choice(object_ids), "t%d" % random.randrange(args.states)) for index in range(args.events)]
+
+	baseline = None
+	workers = 1
+	while workers <= args.max_workers:
+		engine.enqueue_many(events)
+		start = time.time()
+		processes = [multiprocessing.Process(target=worker, args=(args,)) for index in range(workers)]
+		for process in processes:
+			process.start()
+		for process in processes:
+			process.join()
+		rate = len(events) / (time.time() - start)
+		if baseline == None:
+			baseline = rate
+		sys.stdout.write(json.dumps({"workers": workers, "events_per_sec": round(rate), "speedup": round(rate / baseline, 2)}) + "\n")
+		sys.stdout.flush()
+		workers = workers * 2
+
+if __name__ == "__main__":
+	main()
@@ -1,16 +1,445 @@
 ## @package Cocopan
 # Workflow engine built on top of MongoDB.
 
-from pymongo import MongoClient
+from pymongo import DeleteOne, MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+from bson import BSON, ObjectId, decode_file_iter, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from graphviz import Digraph
+try:
+	import yaml
+except ImportError:
+	#YAML workflow specs are only supported when PyYAML is installed
+	yaml = None
+try:
+	from httplib import HTTPConnection, HTTPSConnection
+	from urlparse import urlsplit
+except ImportError:
+	from http.client import HTTPConnection, HTTPSConnection
+	from urllib.parse import urlsplit
+
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+import ast
+import copy
+import functools
+import gzip
+import hashlib
+import heapq
+import json
+import logging
+import mmap
+import multiprocessing
+import operator
+import os
+import pickle
+import struct
+import threading
+import time
+import uuid
+import weakref
+import zlib
+
+
+## Upper bounds (in seconds) of the latency histogram buckets
+STATS_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+## The active statistics collector (None while instrumentation is disabled)
+_stats = None
+
+## The active span tracer (None while tracing is disabled)
+_tracer = None
+
+## Per thread stack of the instrumented operations in progress
+_operation = threading.local()
+
+## Call counts, latency histograms and MongoDB round trips per operation
+class Stats:
 
-from datetime import datetime
+	## Class constructor
+	# @param self The object pointer
+	def __init__(self):
+		self._lock = threading.Lock()
+		#Statistics in the form operation => dict of counters
+		self._operations = {}
 
+	#Helper function to get the counters of an operation (called with the lock held)
+	def _counters(self, name):
+		try:
+			return self._operations[name]
+		except KeyError:
+			counters = {"count": 0, "seconds": 0.0, "buckets": [0] * (len(STATS_BUCKETS) + 1), "round_trips": 0, "bytes_sent": 0, "bytes_received": 0}
+			self._operations[name] = counters
+			return counters
 
-f = Digraph('finite_state_machine', filename='fsm.gv')
-f.body.extend(['rankdir=LR', 'size="8,5"'])
-f.attr('node', shape='circle')
+	## Record a call of an operation
+	# @param self The object pointer
+	# @param string The operation name
+	# @param float The duration of the call in seconds
+	def observe(self, name, seconds):
+		bucket = 0
+		while bucket < len(STATS_BUCKETS) and seconds > STATS_BUCKETS[bucket]:
+			bucket = bucket + 1
+		with self._lock:
+			counters = self._counters(name)
+			counters["count"] = counters["count"] + 1
+			counters["seconds"] = counters["seconds"] + seconds
+			counters["buckets"][bucket] = counters["buckets"][bucket] + 1
+
+	## Record MongoDB traffic, attributed to the outermost operation in progress
+	# @param self The object pointer
+	# @param int Number of round trips
+	# @param int Number of bytes sent
+	# @param int Number of bytes received
+	def traffic(self, round_trips, sent=0, received=0):
+		stack = getattr(_operation, "stack", None)
+		name = stack[0] if stack else "other"
+		with self._lock:
+			counters = self._counters(name)
+			counters["round_trips"] = counters["round_trips"] + round_trips
+			counters["bytes_sent"] = counters["bytes_sent"] + sent
+			counters["bytes_received"] = counters["bytes_received"] + received
+
+	## Get a copy of the statistics
+	# @param self The object pointer
+	# @return dict Statistics in the form operation => counters
+	def snapshot(self):
+		with self._lock:
+			return copy.deepcopy(self._operations)
 
+	## Format the statistics in the Prometheus text exposition format
+	# @param self The object pointer
+	# @return string The statistics
+	def to_prometheus(self):
+		operations = self.snapshot()
+		lines = ["# TYPE cocopan_operation_seconds histogram"]
+		for name, counters in sorted(operations.items()):
+			cumulative = 0
+			for bound, count in zip(STATS_BUCKETS + ("+Inf",), counters["buckets"]):
+				cumulative = cumulative + count
+				lines.append('cocopan_operation_seconds_bucket{operation="%s",le="%s"} %d' % (name, bound, cumulative))
+			lines.append('cocopan_operation_seconds_sum{operation="%s"} %f' % (name, counters["seconds"]))
+			lines.append('cocopan_operation_seconds_count{operation="%s"} %d' % (name, counters["count"]))
+		for metric in ("round_trips", "bytes_sent", "bytes_received"):
+			lines.append("# TYPE cocopan_%s_total counter" % metric)
+			for name, counters in sorted(operations.items()):
+				lines.append('cocopan_%s_total{operation="%s"} %d' % (metric, name, counters[metric]))
+		return "\n".join(lines) + "\n"
+
+## Enable instrumentation, discarding previous statistics
+#   The instrumented methods are only wrapped while instrumentation or tracing is enabled
+# @return Stats The statistics collector
+def enable_stats():
+	global _stats
+	_stats = Stats()
+	_install_wrappers()
+	return _stats
+
+## Disable instrumentation
+def disable_stats():
+	global _stats
+	_stats = None
+	_remove_wrappers()
+
+## Get a snapshot of the statistics
+# @return dict Statistics in the form operation => counters (empty while disabled)
+def stats_snapshot():
+	return _stats.snapshot() if _stats != None else {}
+
+## Write the statistics to a file in the Prometheus text format
+#   The file is replaced atomically so a scraper never reads a partial dump
+# @param string Path of the file
+def write_prometheus(path):
+	text = _stats.to_prometheus() if _stats != None else ""
+	with open(path + ".tmp", "w") as stats_file:
+		stats_file.write(text)
+	os.rename(path + ".tmp", path)
+
+## Records nested spans per thread and keeps the traces of slow operations
+class Tracer:
+
+	## Class constructor
+	# @param self The object pointer
+	# @param float Traces of operations taking at least this many seconds are logged and kept
+	# @param int Maximum number of slow traces kept for export
+	def __init__(self, threshold=1.0, max_traces=100):
+		self._threshold = threshold
+		self._max_traces = max_traces
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		#Kept slow traces, oldest first
+		self._traces = []
+		self._logger = logging.getLogger("cocopan")
+
+	## Start a span, nested in the span in progress on the thread
+	# @param self The object pointer
+	# @param string The span name
+	# @return dict The span
+	def start(self, name):
+		stack = getattr(self._local, "stack", None)
+		if stack == None:
+			stack = self._local.stack = []
+		span = {"name": name, "start": time.time(), "duration": None, "children": []}
+		if stack:
+			stack[-1]["children"].append(span)
+		stack.append(span)
+		return span
+
+	## Finish a span; finishing a root span completes its trace
+	# @param self The object pointer
+	# @param dict The span
+	def finish(self, span):
+		span["duration"] = time.time() - span["start"]
+		stack = self._local.stack
+		stack.pop()
+		if not stack and span["duration"] >= self._threshold:
+			self._logger.warning("Slow operation %s\n%s", span["name"], "\n".join(self.format(span)))
+			with self._lock:
+				self._traces.append((threading.current_thread().ident, span))
+				del self._traces[:-self._max_traces]
+
+	## Format a span tree compactly, merging sibling spans with the same name
+	# @param self The object pointer
+	# @param dict The span
+	# @param int The nesting depth
+	# @return list The lines of the tree
+	def format(self, span, depth=0):
+		lines = ["%s%s %.1fms" % ("  " * depth, span["name"], span["duration"] * 1000)]
+		merged = OrderedDict()
+		for child in span["children"]:
+			merged.setdefault(child["name"], []).append(child)
+		for name, children in merged.items():
+			if len(children) == 1:
+				lines.extend(self.format(children[0], depth + 1))
+			else:
+				total = sum(child["duration"] for child in children)
+				lines.append("%s%s x%d %.1fms (max %.1fms)" % ("  " * (depth + 1), name, len(children), total * 1000, max(child["duration"] for child in children) * 1000))
+		return lines
+
+	## Get the kept slow traces
+	# @param self The object pointer
+	# @return list List of root spans
+	def get_traces(self):
+		with self._lock:
+			return [span for thread, span in self._traces]
+
+	## Write the kept slow traces as a Chrome trace (chrome://tracing, Perfetto)
+	# @param self The object pointer
+	# @param string Path of the file
+	def export_chrome(self, path):
+		events = []
+		with self._lock:
+			traces = list(self._traces)
+		for thread, root in traces:
+			pending = [root]
+			while pending:
+				span = pending.pop()
+				events.append({"name": span["name"], "ph": "X", "ts": int(span["start"] * 1e6), "dur": int(span["duration"] * 1e6), "pid": os.getpid(), "tid": thread})
+				pending.extend(span["children"])
+		with open(path, "w") as trace_file:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+## Enable tracing of load and save
+# @param float Operations taking at least this many seconds are logged as a span tree
+# @param int Maximum number of slow traces kept for export
+# @return Tracer The tracer
+def enable_tracing(threshold=1.0, max_traces=100):
+	global _tracer
+	_tracer = Tracer(threshold, max_traces)
+	_install_wrappers()
+	return _tracer
+
+## Disable tracing
+def disable_tracing():
+	global _tracer
+	_tracer = None
+	_remove_wrappers()
+
+## Write the kept slow traces as a Chrome trace
+# @param string Path of the file
+def export_trace(path):
+	if _tracer != None:
+		_tracer.export_chrome(path)
+
+## Decorator marking a method as a public operation recorded by the instrumentation
+#   The method is left untouched, so disabled instrumentation costs nothing
+# @param string The operation name
+def instrumented(name):
+	def decorate(function):
+		function.operation = name
+		function.public = True
+		return function
+	return decorate
+
+## Decorator marking an internal step that is only recorded as a tracing span
+# @param string The span name
+def traced(name):
+	def decorate(function):
+		function.operation = name
+		function.public = False
+		return function
+	return decorate
+
+#Helper function to wrap the marked methods while instrumentation or tracing is enabled
+def _install_wrappers():
+	for cls in (Transition, State, Cocopan):
+		for attribute, function in list(vars(cls).items()):
+			if getattr(function, "operation", None) != None and getattr(function, "original", None) == None:
+				setattr(cls, attribute, _timed(function))
+
+#Helper function to restore the original methods once nothing is enabled
+def _remove_wrappers():
+	if _stats != None or _tracer != None:
+		return
+	for cls in (Transition, State, Cocopan):
+		for attribute, function in list(vars(cls).items()):
+			if getattr(function, "original", None) != None:
+				setattr(cls, attribute, function.original)
+
+#Helper function to wrap a marked method with a timer and a span
+def _timed(function):
+	name = function.operation
+	public = function.public
+	def wrapper(*args, **kwargs):
+		if public:
+			stack = getattr(_operation, "stack", None)
+			if stack == None:
+				stack = _operation.stack = []
+			stack.append(name)
+		tracer = _tracer
+		span = tracer.start(name) if tracer != None else None
+		start = time.time()
+		try:
+			return function(*args, **kwargs)
+		finally:
+			if span != None:
+				tracer.finish(span)
+			if public:
+				stack.pop()
+				if _stats != None:
+					_stats.observe(name, time.time() - start)
+	wrapper.__name__ = function.__name__
+	wrapper.__doc__ = function.__doc__
+	wrapper.original = function
+	return wrapper
+
+#Helper function to get the encoded size of a document
+def _bson_size(document):
+	if document == None:
+		return 0
+	raw = getattr(document, "raw", None)
+	if raw != None:
+		return len(raw)
+	try:
+		return len(BSON.encode(document))
+	except Exception:
+		return 0
+
+## Database wrapper counting the traffic of its collections
+class _InstrumentedDatabase:
+
+	def __init__(self, database):
+		self._database = database
+
+	def __getitem__(self, name):
+		return _InstrumentedCollection(self._database[name], name)
+
+	def __getattr__(self, name):
+		return getattr(self._database, name)
+
+## Collection wrapper counting round trips and bytes and recording storage spans
+class _InstrumentedCollection:
+
+	def __init__(self, collection, name):
+		self._collection = collection
+		self._name = name
+
+	def __getattr__(self, name):
+		return getattr(self._collection, name)
+
+	#Helper function to run a storage call, recording its traffic and span
+	def _call(self, method, sent, *args, **kwargs):
+		tracer = _tracer
+		span = tracer.start("%s.%s" % (self._name, method)) if tracer != None else None
+		try:
+			result = getattr(self._collection, method)(*args, **kwargs)
+		finally:
+			if span != None:
+				tracer.finish(span)
+		if _stats != None:
+			received = _bson_size(result) if method == "find_one" else 0
+			_stats.traffic(1, sum(_bson_size(document) for document in sent), received)
+		return result
+
+	def find(self, *args, **kwargs):
+		return _InstrumentedCursor(self._collection.find(*args, **kwargs), "%s.find" % self._name, _bson_size(args[0] if args else None))
+
+	def find_one(self, *args, **kwargs):
+		return self._call("find_one", args[:1], *args, **kwargs)
+
+	def insert_one(self, document, *args, **kwargs):
+		return self._call("insert_one", [document], document, *args, **kwargs)
+
+	def insert_many(self, documents, *args, **kwargs):
+		return self._call("insert_many", documents, documents, *args, **kwargs)
+
+	def replace_one(self, query, document, *args, **kwargs):
+		return self._call("replace_one", [query, document], query, document, *args, **kwargs)
+
+	def update_one(self, query, update, *args, **kwargs):
+		return self._call("update_one", [query, update], query, update, *args, **kwargs)
+
+	def update_many(self, query, update, *args, **kwargs):
+		return self._call("update_many", [query, update], query, update, *args, **kwargs)
+
+	def delete_many(self, query, *args, **kwargs):
+		return self._call("delete_many", [query], query, *args, **kwargs)
+
+	def bulk_write(self, requests, *args, **kwargs):
+		return self._call("bulk_write", [getattr(request, "_doc", None) for request in requests], requests, *args, **kwargs)
+
+	def aggregate(self, pipeline, *args, **kwargs):
+		return self._call("aggregate", pipeline, pipeline, *args, **kwargs)
+
+	def create_index(self, *args, **kwargs):
+		return self._call("create_index", [], *args, **kwargs)
+
+	def with_options(self, *args, **kwargs):
+		return _InstrumentedCollection(self._collection.with_options(*args, **kwargs), self._name)
+
+## Cursor wrapper counting the round trip and bytes of a query and recording its span
+class _InstrumentedCursor:
+
+	def __init__(self, cursor, name, sent):
+		self._cursor = cursor
+		self._name = name
+		self._sent = sent
+
+	def __getattr__(self, name):
+		attribute = getattr(self._cursor, name)
+		if name in ("sort", "skip", "limit", "batch_size"):
+			#Keep the wrapper on the chained cursor
+			def chained(*args, **kwargs):
+				self._cursor = attribute(*args, **kwargs)
+				return self
+			return chained
+		return attribute
+
+	def __iter__(self):
+		tracer = _tracer
+		span = tracer.start(self._name) if tracer != None else None
+		if _stats != None:
+			_stats.traffic(1, self._sent)
+		try:
+			for document in self._cursor:
+				if _stats != None:
+					_stats.traffic(0, 0, _bson_size(document))
+				yield document
+		finally:
+			if span != None:
+				tracer.finish(span)
 
 
 ## Workflow transitions
@@ -23,9 +452,19 @@ class Transition:
 	_triggers = {}
 
 	#Conditional combinations of triggers that will activate the transition
-	#   Combination in the form [trigger key 1, trigger key 2, ..., trigger key n]
+	#   Combination in the form [trigger key 1, trigger key 2, ..., trigger key n], where
+	#   an item may also be a predicate over the object fields in the form {"expr": "gpa >= 3.0"}
 	_conditions = []
 
+	#Timer triggers in the form key=>seconds after the object enters the state
+	_timers = {}
+
+	#Priority of the transition when several transitions of a state activate (highest wins)
+	_priority = 0
+
+	#The State owning the transition (notified of changes)
+	_owner = None
+
 	## Class constructor
 	# @param self The object pointer
 	# @param State The starting state
@@ -33,15 +472,17 @@ class Transition:
 	def __init__(self, end_state = None, transition_dict=None):
 		if end_state != None:
 			self._end = end_state.get_state_id()
-			self._transitions = {}
+			self._triggers = {}
 			self._conditions = []
+			self._timers = {}
+			self._priority = 0
 		else:
-			#Set the end state
-			self._end = transition_dict["end"]
-			#Set the triggers
-			self._triggers = transition_dict["triggers"]
-			#Set the conditions
-			self._conditons = transition_dict["conditions"]
+			self.from_dictionary(transition_dict)
+
+	#Helper function to notify the owning state of a change
+	def _changed(self):
+		if self._owner != None:
+			self._owner._transition_changed()
 
 	## Get the end state
 	# @param self The object pointer
@@ -53,6 +494,7 @@ class Transition:
 	# @param list The trigger list
 	def set_triggers(self, triggers):
 		self._triggers = triggers
+		self._changed()
 
 	## Create a new transition trigger
 	# @param self The object pointer
@@ -60,6 +502,35 @@ class Transition:
 	def trigger_add(self, key):
 		# Add the trigger to the dictionary and make it false
 		self._triggers[key] = False
+		self._changed()
+
+	## Create a new timer trigger, activated once the object has been in the state long enough
+	# @param self The object pointer
+	# @param string Unique trigger key
+	# @param int Number of seconds after entering the state before the trigger fires
+	def timer_add(self, key, seconds):
+		self.trigger_add(key)
+		self._timers[key] = seconds
+		self._changed()
+
+	## Get the timer triggers
+	# @param self The object pointer
+	# @return dict Timer triggers in the form key=>seconds
+	def get_timers(self):
+		return self._timers
+
+	## Get the priority of the transition
+	# @param self The object pointer
+	# @return int The priority (highest wins when several transitions activate)
+	def get_priority(self):
+		return self._priority
+
+	## Set the priority of the transition
+	# @param self The object pointer
+	# @param int The priority (highest wins when several transitions activate)
+	def set_priority(self, priority):
+		self._priority = priority
+		self._changed()
 
 	## Remove a transition trigger
 	# @param self The object pointer
@@ -67,6 +538,8 @@ class Transition:
 	def trigger_remove(self, key):
 		#Delete the trigger from the dictionary
 		del self._triggers[key]
+		self._timers.pop(key, None)
+		self._changed()
 
 	## Activate a trigger
 	# @param self The object pointer
@@ -74,6 +547,7 @@ class Transition:
 	def trigger_activate(self, key):
 		#Set the trigger to true
 		self._triggers[key] = True
+		self._changed()
 
 	## Get the status of a trigger
 	# @param self The object pointer
@@ -88,12 +562,14 @@ class Transition:
 	def condition_add(self, trigger_list):
 		# Add the trigger list to the combinations
 		self._conditions.append(trigger_list)
+		self._changed()
 
 	## Remove a trigger combination
 	# @param self The object pointer
 	# @param int The index of the condition to remove
 	def condition_remove(self, index):
 		del self._conditions[index]
+		self._changed()
 
 	## Get the conditions list
 	# @param self The object pointer
@@ -105,18 +581,26 @@ class Transition:
 	# @param list The conditions list
 	def set_conditions(self, conditions):
 		self._conditions = conditions
+		self._changed()
 
 	## Check to see if the transition should activate
 	# @param self The object pointer
+	# @param function Getter of the object fields guards are evaluated on (get(key), None for missing)
 	# @return bool True/False if transition should activate
-	def isActivated(self):
+	@instrumented("transition.isActivated")
+	def isActivated(self, fields=None):
 		# Iterate over all conditional combinations
 		for condition in self._conditions:
 			# Number of triggers that are true in the combination
 			num_true = 0
 			for trigger in condition:
+				try:
+					activated = self._triggers[trigger]
+				except TypeError:
+					#Predicate expressions (unhashable dicts) hold or not on the object fields
+					activated = bool(compile_expression(trigger["expr"])(fields or _no_fields))
 				#If the trigger is activated, increment the number of activated triggers
-				if self._triggers[trigger] == True:
+				if activated == True:
 					num_true = num_true + 1
 			#If the number of activated triggers matches the number of triggers in combination, transition is activated
 			if num_true == len(condition):
@@ -137,6 +621,10 @@ class Transition:
 		transition_dict["triggers"] = self._triggers
 		#Set the conditions
 		transition_dict["conditions"] = self._conditions
+		#Set the timers
+		transition_dict["timers"] = self._timers
+		#Set the priority
+		transition_dict["priority"] = self._priority
 		#Return the dictionary
 		return transition_dict
 
@@ -149,19 +637,41 @@ class Transition:
 		#Set the triggers
 		self._triggers = transition_dict["triggers"]
 		#Set the conditions
-		self._conditons = transition_dict["conditions"]
+		self._conditions = transition_dict["conditions"]
+		#Set the timers
+		self._timers = transition_dict.get("timers", {})
+		#Set the priority
+		self._priority = transition_dict.get("priority", 0)
+		self._changed()
+
+#Helper function to get the approximate size of a document in bytes (its encoded BSON length)
+def _document_bytes(document):
+	if isinstance(document, RawBSONDocument):
+		return len(document.raw)
+	return len(BSON.encode(document))
 
 ## Workflow states
 class State:
 
 	#The dictionary that holds the MongoDB document representing the state
+	#   (a raw BSON document until the state is modified)
 	_document = {}
 
 	#The MongoDB document _id of the state object
 	_doc_id = 0
 
-	#State transitions
-	_transitions = {}
+	#State transitions (None until decoded from the document)
+	_transitions = None
+
+	#Revision of the state, incremented on every change
+	_revision = 0
+
+	#Revision the document was last encoded at
+	_encoded = 0
+
+	#Approximate size of the document in bytes, and the revision it was measured at
+	_size = None
+	_sized = 0
 
 	## Class Constructor
 	# @param dict MongoDB document as a dictionary
@@ -171,19 +681,154 @@ class State:
 		self._document = doc
 		#Set the MongoDB document _id
 		self._doc_id = doc['_id']
-		self._transitions = {}
+		self._transitions = None
+		#A new state has not been encoded yet
+		self._revision = 1
+		self._encoded = 0
+
+	#Helper function to get a mutable document (copied from raw BSON on the first write)
+	def _writable(self):
+		if not isinstance(self._document, dict):
+			self._document = dict(self._document)
+		return self._document
+
+	#Helper function to decode the transitions on first access
+	def _decoded_transitions(self):
+		if self._transitions == None:
+			self._transitions = {}
+			document = self._document
+			#Decode raw BSON in one pass to mutable dicts rather than subdocument by subdocument
+			if isinstance(document, RawBSONDocument):
+				document = BSON(document.raw).decode()
+			for transition in document.get("transitions", []):
+				state_transition = Transition(None, transition)
+				state_transition._owner = self
+				self._transitions[state_transition.get_end()] = state_transition
+		return self._transitions
+
+	#Helper function called by the transitions of the state when they change
+	def _transition_changed(self):
+		self._revision = self._revision + 1
+
+	## Get the revision of the state
+	# @param self The object pointer
+	# @return int Number incremented on every change to the state or its transitions
+	def get_revision(self):
+		return self._revision
+
+	## Get the approximate size of the state document in bytes (its encoded BSON length)
+	#   Measured again only after the state changed
+	# @param self The object pointer
+	# @return int The size in bytes
+	def get_size(self):
+		if self._size == None or self._sized != self._revision:
+			self._size = _document_bytes(self.to_dictionary())
+			self._sized = self._revision
+		return self._size
 
     ## Get the State's document _id
     # @param self The object pointer
     # @return string The document _id
 	def get_state_id(self):
-		return self._document['_id']
+		return self._doc_id
 
 	## Set the friendly name of the state
 	# @param self The object pointer
 	# @param string The name for the state
 	def set_name(self, name):
-		self._document['description'] = name
+		self._writable()['description'] = name
+		self._revision = self._revision + 1
+
+	## Get the friendly name of the state
+	# @param self The object pointer
+	# @return string The name of the state (None if not set)
+	def get_name(self):
+		return self._document.get('description')
+
+	## Make the state an AND-split: an object entering it gets a token in the end state
+	#   of every transition, and the branches advance in parallel
+	# @param self The object pointer
+	# @param bool Whether the state forks
+	def set_fork(self, fork):
+		self._set_flag('fork', fork)
+
+	## Check whether the state is an AND-split
+	# @param self The object pointer
+	# @return bool Whether the state forks
+	def is_fork(self):
+		return bool(self._document.get('fork'))
+
+	## Make the state an AND-join: tokens arriving at it wait until a token arrived from
+	#   every state with a transition to it
+	# @param self The object pointer
+	# @param bool Whether the state joins
+	def set_join(self, join):
+		self._set_flag('join', join)
+
+	## Check whether the state is an AND-join
+	# @param self The object pointer
+	# @return bool Whether the state joins
+	def is_join(self):
+		return bool(self._document.get('join'))
+
+	## Make the state invoke another workflow as a sub-process
+	#   An object entering the state enters the start state of the child workflow's
+	#   published definition, and returns to this state when it reaches a terminal state
+	#   (one without transitions) of the child; the terminal state's _id is then activated
+	#   as a trigger of this state's transitions.
+	# @param self The object pointer
+	# @param string The identifier of the child workflow (None to stop invoking)
+	# @param string The _id of the state of the child workflow objects start in
+	def set_invoke(self, workflow_id, start_state_id=None):
+		if workflow_id != None:
+			self._writable()['invoke'] = {"workflow": workflow_id, "start": start_state_id}
+		else:
+			self._writable().pop('invoke', None)
+		self._revision = self._revision + 1
+
+	## Get the workflow the state invokes
+	# @param self The object pointer
+	# @return dict The invocation in the form {"workflow": ..., "start": ...} (None if the state invokes nothing)
+	def get_invoke(self):
+		return self._document.get('invoke')
+
+	## Add a hook called when objects enter or leave the state
+	#   The target is an http(s) URL the event is POSTed to as JSON, or the name of a
+	#   callback registered with HookDispatcher.register
+	# @param self The object pointer
+	# @param string The event ("enter" or "exit")
+	# @param string The hook target
+	# @param int Maximum number of calls to the target delivered at once
+	def add_hook(self, event, target, concurrency=1):
+		if event not in HOOK_EVENTS:
+			raise ValueError("Unknown hook event %r" % (event,))
+		self.remove_hook(event, target)
+		self._writable().setdefault('hooks', []).append({"event": event, "target": target, "concurrency": concurrency})
+		self._revision = self._revision + 1
+
+	## Remove a hook
+	# @param self The object pointer
+	# @param string The event ("enter" or "exit")
+	# @param string The hook target
+	def remove_hook(self, event, target):
+		hooks = [hook for hook in self.get_hooks() if (hook["event"], hook["target"]) != (event, target)]
+		if len(hooks) != len(self.get_hooks()):
+			self._writable()['hooks'] = hooks
+			self._revision = self._revision + 1
+
+	## Get the hooks of the state
+	# @param self The object pointer
+	# @return list List of {"event", "target", "concurrency"} hooks
+	def get_hooks(self):
+		return self._document.get('hooks') or []
+
+	#Helper function to set a flag of the state (only stored while set)
+	def _set_flag(self, key, value):
+		if value:
+			self._writable()[key] = True
+		else:
+			self._writable().pop(key, None)
+		self._revision = self._revision + 1
 		
 	## Get field from state
     # @param string Key 
@@ -196,7 +841,7 @@ class State:
 	# @param self The object pointer
 	# @return Dict of transitions
 	def get_transitions(self):
-		return self._transitions
+		return self._decoded_transitions()
 
     ## Add transition
     # @param self The object pointer
@@ -206,8 +851,10 @@ class State:
 
 		#Create a new transition object
 		state_transition = Transition(end_state)
+		state_transition._owner = self
 		#Add the transition to the state
-		self._transitions.update({end_state.get_state_id(): state_transition})
+		self._decoded_transitions().update({end_state.get_state_id(): state_transition})
+		self._revision = self._revision + 1
 		#Return a pointer to the craeated transition object
 		return self._transitions.get(end_state.get_state_id())
 
@@ -216,50 +863,69 @@ class State:
 	# @param State The transition to be removed
 	def remove_transition(self, end_state):
 
-		del self._transitions[end_state]
+		del self._decoded_transitions()[end_state]
+		self._revision = self._revision + 1
 
 	## Modify a state transition
 	# @param self The object pointer
 	# @param string The id of the next state
 	# @return Transitiion The transition to be modified
 	def transition(self, next_state_id):
-		return self._transitions.get(next_state_id)
+		return self._decoded_transitions().get(next_state_id)
+
+	## Get the transition that activates, resolving simultaneous activations by priority
+	# @param self The object pointer
+	# @param function Getter of the object fields guards are evaluated on (get(key), None for missing)
+	# @param string The resolution policy ("priority" takes the highest priority activated
+	#   transition, "error" raises ConflictError when activated transitions tie on it)
+	# @return Transition The activated transition (None if no transition is activated)
+	def activated_transition(self, fields=None, resolution="priority"):
+		_resolution_policy(resolution)
+		activated = None
+		for trans in sorted(self._decoded_transitions().values(), key=lambda trans: (-trans.get_priority(), str(trans.get_end()))):
+			if activated != None and trans.get_priority() < activated.get_priority():
+				break
+			if trans.isActivated(fields):
+				if activated != None:
+					raise ConflictError(self._doc_id, [activated.get_end(), trans.get_end()])
+				activated = trans
+				if resolution == "priority":
+					break
+		return activated
 
 
 
     ## Get the state as a dictionary to persist to MongoDB
     # @param self The object pointer
     # @return dict The State as a dictionary
+	@traced("state.to_dictionary")
 	def to_dictionary(self):
+			#Unchanged since the last encode (or load): the document is up to date
+			if self._encoded == self._revision:
+				return self._document
+
+			document = self._writable()
 			#Convert the transitions to dicts and then into an array
 			transition_list = []
-
-			for key, trans in self._transitions.items():
-				
+			for key, trans in self._decoded_transitions().items():
 				transition_list.append(trans.to_dictionary())
 
-				for condition in trans.get_conditions():
-					# Workflow visualization simulation using GraphViz
-					
-					f.edge(str(self.get_state_id()), str(trans.to_dictionary()["end"]), label=str(condition))
-
-
 			#Replace the transition list in te state dictionary
-			self._document["transitions"] = transition_list
+			document["transitions"] = transition_list
+			self._encoded = self._revision
     		#Return the state as a dictionary
-			return self._document
+			return document
 
 	## Dictionary to object
-	# @param dict Dictionary representation of object from MongoDB
+	#   Transitions are decoded lazily, when first accessed
+	# @param dict Dictionary representation of object from MongoDB (or a raw BSON document)
 	# @return None
 	def from_dictionary(self, dictionary):
 		self._document = dictionary
-		for transition in self._document["transitions"]:
-			#Add the transition to the transitions list
-			self._transitions[transition["end"]] = Transition(None, transition)
-			self._transitions[transition["end"]].set_conditions(transition["conditions"])
-			self._transitions[transition["end"]].set_triggers(transition["triggers"])
-			print self._transitions[transition["end"]].get_conditions()
+		self._transitions = None
+		#The document is the encoded form of the state
+		self._revision = self._revision + 1
+		self._encoded = self._revision
 
 
 
@@ -267,6 +933,7 @@ class State:
 class Object: 
 
 	## Dictionary representing the object (Dictionary format used by MongoDB document)
+	#   When backed by raw BSON this is the RawBSONDocument the object was loaded from
 	_document = {}
 
     #The MongoDB document _id of the object
@@ -275,38 +942,484 @@ class Object:
 	# The current state of the item
 	_state = None
 
+	#Fields written (or read as mutable values) since the raw BSON document was loaded
+	#   (None when not backed by raw BSON)
+	_overlay = None
+
+	#Immutable field values decoded from the raw BSON document
+	_decoded = None
+
+	#Offsets of the fields in the raw BSON document found so far
+	_spans = None
+
+	#Position the raw BSON document has been scanned up to
+	_scanned = 0
+
+	#Fields loaded from MongoDB (None when the full document was loaded)
+	_fields = None
+
+	#Function returning the full document, to fetch the fields that were not loaded
+	_fetch = None
+
+	#Write-behind buffer notified of changes (None when changes are saved explicitly)
+	_owner = None
+
+	#Whether the object changed since it was loaded or last written by an explicit save
+	_changed = False
+
+	#Approximate size of the document in bytes, measured when first counted
+	_size = None
+
     ## Class constructor. Pass in initial state. 
     # @param string State (_id of state) 
     # @return None
 	def __init__(self, state=None):
+   		self._document = {}
+   		self._overlay = None
    		self._state = state
    		if state != None:
    			self.set_field("init_state", state.get_state_id())
 
+	#Helper function to get a field (decoding it from raw BSON on first access)
+	def _get(self, key, default=None):
+		if self._overlay == None:
+			value = self._document.get(key, _MISSING)
+			if value is _MISSING:
+				return self._missing(key, default)
+			return value
+		if key in self._overlay:
+			return self._overlay[key]
+		try:
+			return self._decoded[key]
+		except KeyError:
+			name = key.encode("utf-8")
+			span = self._spans.get(name)
+			if span == None:
+				#Scan only as far as the field
+				self._scanned = _raw_scan(self._document.raw, self._scanned, self._spans, name)
+				span = self._spans.get(name)
+				if span == None:
+					return self._missing(key, default)
+			value = _raw_element(self._document.raw, span)
+			#Mutable values go to the overlay so in place changes are saved
+			if isinstance(value, (list, dict)):
+				self._overlay[key] = value
+			else:
+				self._decoded[key] = value
+			return value
+
+	#Helper function for fields missing from the document
+	#   A field that was not loaded is fetched (with the rest of the document) first
+	def _missing(self, key, default):
+		if self._fields == None or key in self._fields:
+			return default
+		self._complete()
+		return self._get(key, default)
+
+	#Helper function to fetch the full document of a partially loaded object
+	#   The fields loaded or written so far keep their current values
+	def _complete(self):
+		document = self._fetch()
+		self._fields = None
+		self._fetch = None
+		#The document was deleted meanwhile
+		if document == None:
+			return
+		changes = dict(self.to_dictionary().items())
+		self.from_dictionary(document)
+		for key, value in changes.items():
+			self.set_field(key, value)
+
+	## Mark the object as holding only some fields of its document
+	#   The other fields are fetched on first access
+	# @param self The object pointer
+	# @param list The fields that were loaded
+	# @param function Function returning the full document
+	def set_partial(self, fields, fetch):
+		self._fields = fields
+		self._fetch = fetch
+
+	## Get the approximate size of the object document in bytes (its encoded BSON length)
+	#   The size is measured when first asked for, so later changes are not counted
+	# @param self The object pointer
+	# @return int The size in bytes
+	def get_size(self):
+		if self._size == None:
+			if self._overlay == None:
+				self._size = _document_bytes(self._document)
+			else:
+				self._size = len(self._document.raw) + (_document_bytes(self._overlay) if self._overlay else 0)
+		return self._size
+
+	## Check if the object holds only some fields of its document
+	# @param self The object pointer
+	# @return bool True if some fields were not loaded
+	def is_partial(self):
+		return self._fields != None
+
     ## Get field from object
     # @param string Key 
     # @return Value at key
 	def get_field(self, key):
-		return self._document[key]
+		value = self._get(key, _MISSING)
+		if value is _MISSING:
+			raise KeyError(key)
+		return value
 
     ## Set field in object
     # @param self The object pointer
     # @param string Key
     # @param Value
 	def set_field(self, key, value):
-		self._document[key] = value
+		if self._overlay == None:
+			self._document[key] = value
+		else:
+			self._overlay[key] = value
+		self._changed = True
+		if self._owner != None:
+			self._owner.mark(self)
+
+	#Helper function to give the object a new revision as it is written
+	#   The revision is not a change of the object, so the write-behind buffer is not notified
+	# @return tuple The revision the object was read with (None if never written) and the new one
+	def _revise(self):
+		previous = self._get("rev")
+		revision = ObjectId()
+		self._set_revision(revision)
+		return previous, revision
+
+	#Helper function to set the revision of the object (putting it back when a write did not commit)
+	def _set_revision(self, revision):
+		if self._overlay == None:
+			self._document["rev"] = revision
+		else:
+			self._overlay["rev"] = revision
+
+	## Get the current state of the object
+	# @param self The object pointer
+	# @return string The _id of the current state (None if not placed in a state)
+	def get_current_state(self):
+		return self._get("state")
+
+	## Move the object to a state
+	#   Triggers activated in the previous state do not carry over
+	# @param self The object pointer
+	# @param string The _id of the new state
+	def set_current_state(self, state_id):
+		self.set_field("state", state_id)
+		self.set_field("triggers", [])
+
+	## Get the triggers activated for the object in its current state
+	# @param self The object pointer
+	# @return list List of activated trigger keys
+	def get_triggers(self):
+		return self._get("triggers", [])
+
+	## Get the states holding a token of the object in a parallel region
+	#   The current state stays the fork the region started from until its join completes
+	# @param self The object pointer
+	# @return list List of state _ids (empty outside parallel regions)
+	def get_tokens(self):
+		return self._get("tokens") or []
+
+	## Set the states holding a token of the object
+	# @param self The object pointer
+	# @param list List of state _ids
+	def set_tokens(self, tokens):
+		self.set_field("tokens", tokens)
+
+	## Get the states whose tokens arrived at a join that is still waiting for other branches
+	# @param self The object pointer
+	# @return list List of state _ids
+	def get_arrived(self):
+		return self._get("arrived") or []
+
+	## Set the states whose tokens arrived at a waiting join
+	# @param self The object pointer
+	# @param list List of state _ids
+	def set_arrived(self, arrived):
+		self.set_field("arrived", arrived)
+
+	## Get the mark recorded when the object (or one of its tokens) last entered a state with timers
+	# @param self The object pointer
+	# @param string The _id of the state
+	# @return ObjectId The entry mark (None if not recorded)
+	def get_entry(self, state_id):
+		for entry_state, mark in self._get("entries") or []:
+			if entry_state == state_id:
+				return mark
+		return None
+
+	## Record the mark of an entry into a state with timers, replacing the previous one
+	#   Timers carry the mark of the entry that armed them, so a timer armed before the
+	#   object left and re-entered the state is recognized as stale
+	# @param self The object pointer
+	# @param string The _id of the state
+	# @param ObjectId The entry mark
+	def set_entry(self, state_id, mark):
+		entries = [entry for entry in self._get("entries") or [] if entry[0] != state_id]
+		entries.append([state_id, mark])
+		self.set_field("entries", entries)
+
+	## Get the sub-workflow invocations the object is in, innermost last
+	# @param self The object pointer
+	# @return list List of {"workflow", "state", "version"} frames, holding the invoked workflow
+	#   and the invoking state and definition version to return to
+	def get_calls(self):
+		return self._get("calls") or []
+
+	## Set the sub-workflow invocations the object is in
+	# @param self The object pointer
+	# @param list List of {"workflow", "state", "version"} frames
+	def set_calls(self, calls):
+		self.set_field("calls", calls)
+
+	## Activate a trigger for the object
+	# @param self The object pointer
+	# @param string The trigger key
+	def trigger_activate(self, key):
+		triggers = self._get("triggers")
+		if triggers == None:
+			triggers = []
+			self.set_field("triggers", triggers)
+		if key not in triggers:
+			triggers.append(key)
+			self._changed = True
+			if self._owner != None:
+				self._owner.mark(self)
+
+	## Get the definition version the object runs under
+	# @param self The object pointer
+	# @return string The content hash of the pinned definition (None if unpinned)
+	def get_version(self):
+		return self._get("version")
+
+	## Pin the object to a definition version
+	# @param self The object pointer
+	# @param string The content hash of the definition
+	def set_version(self, version):
+		self.set_field("version", version)
 
     ## Object to dictionary
+    #   An object backed by raw BSON is returned as raw BSON: the fields in the overlay
+    #   are encoded and merged with the untouched fields, which are copied byte for byte
     # @return dict Dictionary representation of object for MongoDB
 	def to_dictionary(self):
+		if not self._overlay:
+			return self._document
+		#The merged document becomes the new base
+		self.from_dictionary(self._merged())
 		return self._document
 
+	## Encode the object as raw BSON without rebasing it
+	#   Unlike to_dictionary the object is left unchanged, so it is safe to call while
+	#   another thread modifies the object
+	# @param self The object pointer
+	# @return RawBSONDocument The object document
+	def snapshot(self):
+		if self._overlay == None:
+			return RawBSONDocument(BSON.encode(self._document))
+		if not self._overlay:
+			return self._document
+		return self._merged()
+
+	#Helper function to merge the overlay with the untouched fields of the raw BSON document
+	def _merged(self):
+		raw = self._document.raw
+		spans = dict(self._spans)
+		_raw_scan(raw, self._scanned, spans)
+		spans = sorted(spans.items(), key=lambda item: item[1][0])
+		#Encoding copies the overlay in one step, so concurrent writes land before or after it
+		encoded = BSON.encode(self._overlay)
+		overlay = RawBSONDocument(encoded)
+		parts = [raw[span[0]:span[1]] for key, span in spans if key.decode("utf-8") not in overlay]
+		parts.append(encoded[4:-1])
+		body = b"".join(parts)
+		return RawBSONDocument(struct.pack("<i", len(body) + 5) + body + b"\x00")
+
+	## Object to update
+	#   A partially loaded object only sets the fields it holds, leaving the others intact
+	# @param self The object pointer
+	# @return dict The update operators for MongoDB
+	def to_update(self):
+		return {"$set": dict((key, value) for key, value in self.to_dictionary().items() if key != "_id")}
+
     ## Dictionary to object
-    # @param dict Dictionary representation of object from MongoDB
+    # @param dict Dictionary representation of object from MongoDB (or a raw BSON document, decoded lazily)
     # @return None
 	def from_dictionary(self, dictionary):
 		self._document = dictionary
-
+		self._spans = {}
+		self._scanned = 4
+		self._overlay = {} if isinstance(dictionary, RawBSONDocument) else None
+		self._decoded = {}
+
+
+## Codec options returning documents as undecoded raw BSON
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+## Object fields fetched by each projection profile (None fetches the full document)
+#   "engine" holds what advancing an object needs
+PROJECTION_PROFILES = {"engine": ["_id", "rev", "state", "triggers", "version", "tokens", "arrived", "calls", "entries"], "full": None}
+
+#Helper function to get the fields fetched by a projection profile (a profile name or a list of fields)
+def _projection_fields(profile):
+	if isinstance(profile, (list, tuple, set)):
+		#The revision is needed to write the object conditionally
+		return ["_id", "rev"] + [field for field in profile if field not in ("_id", "rev")]
+	try:
+		return PROJECTION_PROFILES[profile]
+	except KeyError:
+		raise ValueError("Unknown projection profile %r" % (profile,))
+
+#Helper function to build the MongoDB projection document for a list of fields (None for the full document)
+def _projection_document(fields):
+	if fields == None:
+		return None
+	return dict((field, 1) for field in fields)
+
+## Marker for missing fields
+_MISSING = object()
+
+## Sizes of the fixed size BSON element types
+_RAW_FIXED_SIZES = {b"\x01": 8, b"\x06": 0, b"\x07": 12, b"\x08": 1, b"\x09": 8, b"\x0a": 0, b"\x10": 4, b"\x11": 8, b"\x12": 8, b"\x13": 16, b"\x7f": 0, b"\xff": 0}
+
+#Bytes following the int32 length prefix of variable sized BSON element types
+_RAW_PREFIXED_SIZES = {b"\x02": 4, b"\x03": 0, b"\x04": 0, b"\x05": 5, b"\x0c": 16, b"\x0d": 4, b"\x0e": 4, b"\x0f": 0}
+
+#Helper function to locate the fields of a raw BSON document without decoding them
+#   Scans from position, recording name => (start, end) offsets of each element in
+#   spans (keyed by the encoded field name), until the field named stop is found;
+#   returns where the scan stopped
+def _raw_scan(raw, position, spans, stop=None):
+	end = len(raw) - 1
+	unpack = struct.unpack_from
+	while position < end:
+		kind = raw[position:position + 1]
+		name_end = raw.index(b"\x00", position + 1)
+		name = raw[position + 1:name_end]
+		value = name_end + 1
+		size = _RAW_FIXED_SIZES.get(kind)
+		if size == None:
+			size = _RAW_PREFIXED_SIZES.get(kind)
+			if size != None:
+				size += unpack("<i", raw, value)[0]
+			elif kind == b"\x0b":
+				size = raw.index(b"\x00", raw.index(b"\x00", value) + 1) + 1 - value
+			else:
+				raise ValueError("Unknown BSON element type %r" % kind)
+		position = value + size
+		spans[name] = (name_end - len(name) - 1, position)
+		if name == stop:
+			break
+	return position
+
+#Helper function to decode a single element of a raw BSON document
+def _raw_element(raw, span):
+	element = raw[span[0]:span[1]]
+	document = BSON(struct.pack("<i", len(element) + 5) + element + b"\x00").decode()
+	for value in document.values():
+		return value
+
+#Helper function to read the _id of a raw BSON document without decoding the rest
+def _raw_id(document):
+	#Documents written by drivers start with the _id element, so the scan stops at once
+	spans = {}
+	_raw_scan(document.raw, 4, spans, b"_id")
+	if b"_id" not in spans:
+		raise KeyError("_id")
+	return _raw_element(document.raw, spans[b"_id"])
+
+## Decode a state from a (raw BSON) document
+#   Only the _id is read; the other fields and the transitions are decoded on access
+# @param RawBSONDocument The state document
+# @return State The state
+def decode_state(document):
+	if isinstance(document, RawBSONDocument):
+		state = State({"_id": _raw_id(document)})
+	else:
+		state = State(document)
+	state.from_dictionary(document)
+	return state
+
+## Encode a state to raw BSON
+#   A state that has not changed since it was decoded is returned without re-encoding
+# @param State The state
+# @return RawBSONDocument The state document
+def encode_state(state):
+	document = state.to_dictionary()
+	if isinstance(document, RawBSONDocument):
+		return document
+	return RawBSONDocument(BSON.encode(document))
+
+## Decode a transition from a (raw BSON) document
+# @param RawBSONDocument The transition document
+# @return Transition The transition
+def decode_transition(document):
+	if isinstance(document, RawBSONDocument):
+		document = BSON(document.raw).decode()
+	return Transition(None, document)
+
+## Encode a transition to raw BSON
+# @param Transition The transition
+# @return RawBSONDocument The transition document
+def encode_transition(transition):
+	return RawBSONDocument(BSON.encode(transition.to_dictionary()))
+
+## Decode an object from a (raw BSON) document
+# @param RawBSONDocument The object document
+# @return Object The object
+def decode_object(document):
+	it_object = Object()
+	it_object.from_dictionary(document)
+	return it_object
+
+## Encode an object to raw BSON
+# @param Object The object
+# @return RawBSONDocument The object document
+def encode_object(it_object):
+	document = it_object.to_dictionary()
+	if isinstance(document, RawBSONDocument):
+		return document
+	return RawBSONDocument(BSON.encode(document))
+
+#Helper function to split a list into pages
+def _pages(items, size):
+	return [items[start:start + size] for start in range(0, len(items), size)]
+
+## Formats of exported workflows
+#   "ndjson" is one MongoDB extended JSON record per line, "bson" a sequence of BSON records
+EXPORT_FORMATS = ("ndjson", "bson")
+
+#Helper function to check an export format
+def _export_format(format):
+	if format not in EXPORT_FORMATS:
+		raise ValueError("Unknown export format %r" % (format,))
+	return format
+
+#Helper function to write an export record
+def _write_record(output, format, kind, document):
+	if format == "bson":
+		output.write(BSON.encode({"kind": kind, "document": document}))
+	else:
+		output.write((json_util.dumps({"kind": kind, "document": document}) + "\n").encode("utf-8"))
+
+#Helper function to read the export records of a stream one at a time
+def _read_records(stream, format):
+	if format == "bson":
+		#Documents stay raw BSON, so they are inserted without being decoded
+		for record in decode_file_iter(stream, RAW_CODEC_OPTIONS):
+			yield record["kind"], record["document"]
+	else:
+		for line in stream:
+			if line.strip():
+				record = json_util.loads(line.decode("utf-8"))
+				yield record["kind"], record["document"]
+
+## Process wide pool of MongoDB clients keyed by connection parameters
+#   MongoClient maintains its own connection pool, so every Database sharing the
+#   same parameters also shares the underlying sockets
+_clients = {}
 
 ## Database interface to MongoDB
 class Database:
@@ -326,9 +1439,479 @@ class Database:
 	# @param string The database name
 	# @return MongoClient MongoDB connection instance 
 	def connect(self, db_name):
-		conn = MongoClient(self._connection_params)[db_name]
+		conn = self._client()[db_name]
+		if _stats != None or _tracer != None:
+			return _InstrumentedDatabase(conn)
 		return conn
 
+	## Start a client session (transactions need a replica set or sharded cluster)
+	# @param self The object pointer
+	# @return ClientSession The session
+	def start_session(self):
+		return self._client().start_session()
+
+	#Helper function to get the pooled client for the connection parameters
+	def _client(self):
+		try:
+			return _clients[self._connection_params]
+		except KeyError:
+			client = MongoClient(self._connection_params)
+			_clients[self._connection_params] = client
+			return client
+
+## In memory stand-in for a MongoDB database
+#   Implements the subset of the pymongo collection API used by the engine, so a
+#   Cocopan instance can run (and be benchmarked) without a mongod:
+#   Cocopan(database=MemoryDatabase())
+class MemoryDatabase:
+
+	## Class constructor
+	# @param self The object pointer
+	def __init__(self):
+		#Databases in the form name => {collection name => MemoryCollection}
+		self._databases = {}
+
+	## Connect to the database
+	# @param self The object pointer
+	# @param string The database name
+	# @return dict Collections of the database keyed by name (created on first access)
+	def connect(self, db_name):
+		try:
+			database = self._databases[db_name]
+		except KeyError:
+			database = _MemoryCollections()
+			self._databases[db_name] = database
+		if _stats != None or _tracer != None:
+			return _InstrumentedDatabase(database)
+		return database
+
+	## Start a session
+	# @param self The object pointer
+	# @return MemorySession The session
+	def start_session(self):
+		return MemorySession()
+
+## In memory stand-in for a client session
+#   Transactions run the callback directly: writes are not rolled back on errors
+class MemorySession:
+
+	## Run a callback in a transaction
+	# @param self The object pointer
+	# @param function The callback, called with the session
+	# @return The result of the callback
+	def with_transaction(self, callback, **kwargs):
+		return callback(self)
+
+	## End the session
+	# @param self The object pointer
+	def end_session(self):
+		pass
+
+## Collections of an in memory database, created on first access like pymongo
+class _MemoryCollections(dict):
+
+	def __missing__(self, name):
+		collection = MemoryCollection()
+		self[name] = collection
+		return collection
+
+#Helper function to get a (dotted) field from a document
+def _memory_get(document, path):
+	for key in path.split("."):
+		if not isinstance(document, dict) or key not in document:
+			return None
+		document = document[key]
+	return document
+
+#Helper function to check a single field against a query value
+def _memory_match_value(value, condition):
+	if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+		for op, operand in condition.items():
+			if op == "$in":
+				if not any(_memory_match_value(value, item) for item in operand):
+					return False
+			elif op == "$nin":
+				if any(_memory_match_value(value, item) for item in operand):
+					return False
+			elif op == "$ne":
+				if _memory_match_value(value, operand):
+					return False
+			elif op == "$exists":
+				if (value != None) != bool(operand):
+					return False
+			elif value == None:
+				return False
+			elif op == "$lt" and not value < operand:
+				return False
+			elif op == "$lte" and not value <= operand:
+				return False
+			elif op == "$gt" and not value > operand:
+				return False
+			elif op == "$gte" and not value >= operand:
+				return False
+		return True
+	#Arrays match if any element matches (multikey semantics)
+	if isinstance(value, list) and not isinstance(condition, list):
+		return condition in value
+	return value == condition
+
+#Helper function to check a document against a query
+def _memory_matches(document, query):
+	for key, condition in query.items():
+		if key == "$or":
+			if not any(_memory_matches(document, branch) for branch in condition):
+				return False
+		elif key == "$and":
+			if not all(_memory_matches(document, branch) for branch in condition):
+				return False
+		elif not _memory_match_value(_memory_get(document, key), condition):
+			return False
+	return True
+
+#Helper function to apply a projection to a document
+def _memory_project(document, projection):
+	if not projection:
+		return copy.deepcopy(document)
+	if isinstance(projection, (list, tuple)):
+		projection = dict((key, 1) for key in projection)
+	if any(projection.values()):
+		projected = dict((key, copy.deepcopy(document[key])) for key, value in projection.items() if value and key in document)
+		if projection.get("_id", 1) and "_id" in document:
+			projected["_id"] = document["_id"]
+		return projected
+	return dict((key, copy.deepcopy(value)) for key, value in document.items() if projection.get(key, 1))
+
+#Helper function to apply update operators to a document
+def _memory_update(document, update):
+	for op, fields in update.items():
+		for key, value in fields.items():
+			if op == "$set":
+				document[key] = copy.deepcopy(value)
+			elif op == "$unset":
+				document.pop(key, None)
+			elif op == "$inc":
+				document[key] = document.get(key, 0) + value
+			elif op == "$push":
+				document.setdefault(key, []).append(copy.deepcopy(value))
+			elif op == "$addToSet":
+				if value not in document.setdefault(key, []):
+					document[key].append(copy.deepcopy(value))
+			elif op == "$pull":
+				document[key] = [item for item in document.get(key, []) if item != value]
+			else:
+				raise ValueError("Unsupported update operator %s" % op)
+
+#Helper function to evaluate an aggregation expression against a document
+#   Supports field paths, $literal, $ifNull, $size and $setIntersection
+def _memory_expression(document, expression):
+	if isinstance(expression, _text_types) and expression.startswith("$"):
+		return _memory_get(document, expression[1:])
+	if isinstance(expression, list):
+		return [_memory_expression(document, item) for item in expression]
+	if not isinstance(expression, dict) or len(expression) != 1 or not list(expression.keys())[0].startswith("$"):
+		return expression
+	op, operand = list(expression.items())[0]
+	if op == "$literal":
+		return operand
+	if op == "$ifNull":
+		value = _memory_expression(document, operand[0])
+		return value if value != None else _memory_expression(document, operand[1])
+	if op == "$size":
+		return len(_memory_expression(document, operand))
+	if op == "$setIntersection":
+		values = [_memory_expression(document, item) for item in operand]
+		return list(set(values[0]).intersection(*values[1:]))
+	raise ValueError("Unsupported aggregation operator %s" % op)
+
+#Helper function to run an aggregation pipeline over documents
+#   Supports the $match, $project, $group (with $sum) and $facet stages
+def _memory_aggregate(documents, pipeline):
+	for stage in pipeline:
+		name, spec = list(stage.items())[0]
+		if name == "$match":
+			documents = [document for document in documents if _memory_matches(document, spec)]
+		elif name == "$project":
+			projected = []
+			for document in documents:
+				result = {} if spec.get("_id", 1) == 0 else {"_id": document.get("_id")}
+				for key, expression in spec.items():
+					if key != "_id":
+						result[key] = _memory_get(document, key) if expression == 1 else _memory_expression(document, expression)
+				projected.append(result)
+			documents = projected
+		elif name == "$group":
+			groups = OrderedDict()
+			for document in documents:
+				key = _memory_expression(document, spec["_id"])
+				group = groups.setdefault(key, {"_id": key})
+				for field, accumulator in spec.items():
+					if field == "_id":
+						continue
+					op, operand = list(accumulator.items())[0]
+					if op != "$sum":
+						raise ValueError("Unsupported accumulator %s" % op)
+					group[field] = group.get(field, 0) + _memory_expression(document, operand)
+			documents = list(groups.values())
+		elif name == "$facet":
+			documents = [dict((field, _memory_aggregate(documents, facet)) for field, facet in spec.items())]
+		else:
+			raise ValueError("Unsupported aggregation stage %s" % name)
+	return documents
+
+## Cursor over the results of an in memory query
+class MemoryCursor:
+
+	## Class constructor
+	# @param self The object pointer
+	# @param list The matching documents
+	# @param dict The projection to apply
+	def __init__(self, documents, projection=None):
+		self._documents = documents
+		self._projection = projection
+		self._skip = 0
+		self._limit = 0
+
+	## Sort the results
+	# @param self The object pointer
+	# @param string|list The key (or list of (key, direction) tuples)
+	# @param int The direction (1 or -1)
+	# @return MemoryCursor The cursor
+	def sort(self, key, direction=1):
+		keys = key if isinstance(key, list) else [(key, direction)]
+		for field, field_direction in reversed(keys):
+			#None sorts first, like MongoDB
+			self._documents.sort(key=lambda document: (_memory_get(document, field) != None, _memory_get(document, field)), reverse=field_direction < 0)
+		return self
+
+	## Skip results
+	# @param self The object pointer
+	# @param int Number of results to skip
+	# @return MemoryCursor The cursor
+	def skip(self, count):
+		self._skip = count
+		return self
+
+	## Limit the results
+	# @param self The object pointer
+	# @param int Maximum number of results (0 for no limit)
+	# @return MemoryCursor The cursor
+	def limit(self, count):
+		self._limit = count
+		return self
+
+	## Set the batch size (has no effect in memory)
+	# @param self The object pointer
+	# @param int The batch size
+	# @return MemoryCursor The cursor
+	def batch_size(self, size):
+		return self
+
+	## Count the results
+	# @param self The object pointer
+	# @return int The number of results
+	def count(self, with_limit_and_skip=False):
+		return len(self._window()) if with_limit_and_skip else len(self._documents)
+
+	#Helper function to get the documents after skip and limit
+	def _window(self):
+		end = self._skip + self._limit if self._limit else None
+		return self._documents[self._skip:end]
+
+	def __iter__(self):
+		for document in self._window():
+			yield _memory_project(document, self._projection)
+
+## In memory stand-in for a MongoDB collection
+class MemoryCollection:
+
+	## Class constructor
+	# @param self The object pointer
+	def __init__(self):
+		#Documents in insertion order keyed by _id
+		self._documents = OrderedDict()
+
+	## Insert a document
+	# @param self The object pointer
+	# @param dict The document (an _id is generated if missing)
+	# @return InsertOneResult The result of the insert
+	def insert_one(self, document):
+		#Documents are held decoded in memory
+		if isinstance(document, RawBSONDocument):
+			document = BSON(document.raw).decode()
+		if "_id" not in document:
+			document["_id"] = ObjectId()
+		if document["_id"] in self._documents:
+			raise DuplicateKeyError("E11000 duplicate key error _id: %s" % document["_id"])
+		self._documents[document["_id"]] = copy.deepcopy(document)
+		return InsertOneResult(document["_id"], True)
+
+	## Insert many documents
+	# @param self The object pointer
+	# @param list The documents
+	# @return InsertManyResult The result of the insert
+	def insert_many(self, documents, ordered=True, session=None):
+		return InsertManyResult([self.insert_one(document).inserted_id for document in documents], True)
+
+	## Find documents
+	# @param self The object pointer
+	# @param dict The query
+	# @param dict The projection
+	# @return MemoryCursor Cursor over the matching documents
+	def find(self, query=None, projection=None, **kwargs):
+		query = query or {}
+		#Look up documents by _id directly when possible
+		if "_id" in query and not isinstance(query["_id"], dict):
+			candidates = [self._documents[query["_id"]]] if query["_id"] in self._documents else []
+		elif "_id" in query and list(query["_id"].keys()) == ["$in"]:
+			candidates = [self._documents[_id] for _id in OrderedDict.fromkeys(query["_id"]["$in"]) if _id in self._documents]
+			#The candidates already match the _id condition
+			query = dict((key, value) for key, value in query.items() if key != "_id")
+		else:
+			candidates = self._documents.values()
+		return MemoryCursor([document for document in candidates if _memory_matches(document, query)], projection)
+
+	## Find a single document
+	# @param self The object pointer
+	# @param dict The query
+	# @param dict The projection
+	# @return dict The document (None if nothing matches)
+	def find_one(self, query=None, projection=None, **kwargs):
+		for document in self.find(query, projection).limit(1):
+			return document
+		return None
+
+	## Run an aggregation pipeline
+	#   Only the stages and operators the engine uses are supported (see _memory_aggregate)
+	# @param self The object pointer
+	# @param list The pipeline stages
+	# @return MemoryCursor Cursor over the results
+	def aggregate(self, pipeline, **kwargs):
+		return MemoryCursor(_memory_aggregate(list(self._documents.values()), pipeline))
+
+	## Count the documents matching a query
+	# @param self The object pointer
+	# @param dict The query
+	# @return int The number of matching documents
+	def count_documents(self, query):
+		return self.find(query).count()
+
+	## Replace a document
+	# @param self The object pointer
+	# @param dict The query
+	# @param dict The replacement document
+	# @param bool Insert the document if nothing matches
+	# @return UpdateResult The result of the replace
+	def replace_one(self, query, document, upsert=False, session=None):
+		if isinstance(document, RawBSONDocument):
+			document = BSON(document.raw).decode()
+		for match in self.find(query, {"_id": 1}).limit(1):
+			replacement = copy.deepcopy(document)
+			replacement["_id"] = match["_id"]
+			self._documents[match["_id"]] = replacement
+			return UpdateResult({"n": 1, "nModified": 1}, True)
+		if upsert:
+			document = copy.deepcopy(document)
+			if "_id" in query and not isinstance(query["_id"], dict):
+				document["_id"] = query["_id"]
+			self.insert_one(document)
+			return UpdateResult({"n": 1, "nModified": 0, "upserted": document["_id"]}, True)
+		return UpdateResult({"n": 0, "nModified": 0}, True)
+
+	#Helper function to update the first (or every) matching document
+	def _update(self, query, update, many, upsert):
+		matched = 0
+		for match in self.find(query, {"_id": 1}):
+			_memory_update(self._documents[match["_id"]], update)
+			matched = matched + 1
+			if not many:
+				break
+		if matched == 0 and upsert:
+			document = dict((key, value) for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict))
+			_memory_update(document, update)
+			self.insert_one(document)
+			return UpdateResult({"n": 1, "nModified": 0, "upserted": document["_id"]}, True)
+		return UpdateResult({"n": matched, "nModified": matched}, True)
+
+	## Update the first matching document
+	# @param self The object pointer
+	# @param dict The query
+	# @param dict The update operators
+	# @return UpdateResult The result of the update
+	def update_one(self, query, update, upsert=False):
+		return self._update(query, update, False, upsert)
+
+	## Update every matching document
+	# @param self The object pointer
+	# @param dict The query
+	# @param dict The update operators
+	# @return UpdateResult The result of the update
+	def update_many(self, query, update, upsert=False):
+		return self._update(query, update, True, upsert)
+
+	## Delete every matching document
+	# @param self The object pointer
+	# @param dict The query
+	# @return DeleteResult The result of the delete
+	def delete_many(self, query):
+		matches = [match["_id"] for match in self.find(query, {"_id": 1})]
+		for _id in matches:
+			del self._documents[_id]
+		return DeleteResult({"n": len(matches)}, True)
+
+	## Apply a list of pymongo write operations
+	# @param self The object pointer
+	# @param list List of InsertOne/ReplaceOne/UpdateOne/UpdateMany/DeleteOne/DeleteMany
+	# @return BulkWriteResult The result of the writes
+	def bulk_write(self, requests, ordered=True, session=None):
+		counts = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "nUpserted": 0, "upserted": []}
+		for request in requests:
+			kind = type(request).__name__
+			result = None
+			if kind == "InsertOne":
+				self.insert_one(request._doc)
+				counts["nInserted"] = counts["nInserted"] + 1
+			elif kind == "ReplaceOne":
+				result = self.replace_one(request._filter, request._doc, request._upsert)
+			elif kind == "UpdateOne":
+				result = self.update_one(request._filter, request._doc, request._upsert)
+			elif kind == "UpdateMany":
+				result = self.update_many(request._filter, request._doc, request._upsert)
+			elif kind == "DeleteMany":
+				counts["nRemoved"] = counts["nRemoved"] + self.delete_many(request._filter).deleted_count
+			elif kind == "DeleteOne":
+				for match in self.find(request._filter, {"_id": 1}).limit(1):
+					del self._documents[match["_id"]]
+					counts["nRemoved"] = counts["nRemoved"] + 1
+			else:
+				raise ValueError("Unsupported bulk operation %s" % kind)
+			if result != None:
+				if result.upserted_id != None:
+					counts["nUpserted"] = counts["nUpserted"] + 1
+				else:
+					counts["nMatched"] = counts["nMatched"] + result.matched_count
+					counts["nModified"] = counts["nModified"] + result.modified_count
+		return BulkWriteResult(counts, True)
+
+	## Get the collection with different codec options (documents are always dicts in memory)
+	# @param self The object pointer
+	# @return MemoryCollection The collection
+	def with_options(self, **kwargs):
+		return self
+
+	## Create an index (indexes are not needed in memory)
+	# @param self The object pointer
+	# @param list The index keys
+	# @return string The index name
+	def create_index(self, keys, **kwargs):
+		if isinstance(keys, list):
+			return "_".join("%s_%s" % key for key in keys)
+		return "%s_1" % keys
+
+	## Remove every document
+	# @param self The object pointer
+	def drop(self):
+		self._documents.clear()
+
 ## Workflow data model
 class Workflow:
 
@@ -338,14 +1921,18 @@ class Workflow:
     ## The MongoDB document _id of the object
 	_doc_id = None
 
+	## The MongoDB collection holding the objects (members carry the workflow _id)
+	_object_collection = None
+
 	## Class constructor
 	# @param self The object pointer
 	# @param dict The document from MongoDB
+	# @param Collection The collection holding the objects
 	# @return None
-	def __init__(self, doc={}):
-		self._document = doc
+	def __init__(self, doc=None, objects=None):
+		self._document = doc if doc != None else {}
 		self._states = []
-		self._objects = []
+		self._object_collection = objects
 		self._doc_id = None
 
     ## Dictionary to object
@@ -366,11 +1953,17 @@ class Workflow:
 	def get_states(self):
 		return self._document["states"]
 
-	## Get a list of the objects that are associated with the workflow
+	## Iterate over the objects that are associated with the workflow
+	#   The _ids are streamed from the objects collection (objects hold the workflow
+	#   _id in their workflow_id field) rather than kept in the workflow document
 	# @param self The object pointer
-	# @return list List of object doc _ids associated with the workflow
-	def get_objects(self):
-		return self._document["objects"]
+	# @param int Number of _ids fetched per round trip
+	# @return iterator Object doc _ids associated with the workflow
+	def get_objects(self, batch_size=1000):
+		if self._object_collection == None:
+			return
+		for document in self._object_collection.find({"workflow_id": self.get_id()}, {"_id": 1}).batch_size(batch_size):
+			yield document["_id"]
 
 	## Set the states list
 	# @param self The object pointer
@@ -378,19 +1971,854 @@ class Workflow:
 	def set_states(self, states_list):
 		self._document["states"] = states_list
 
-	## Set the objects list
+	## Get the current definition version of the workflow
+	# @param self The object pointer
+	# @return string The content hash of the published definition (None if never published)
+	def get_version(self):
+		return self._document.get("version")
+
+	## Set the current definition version of the workflow
+	# @param self The object pointer
+	# @param string The content hash of the published definition
+	def set_version(self, version):
+		self._document["version"] = version
+
+	## Get the content hash of the states as last saved
+	#   It is the version of the definition built from them, so when that definition's
+	#   file exists the states can be read from it
+	# @param self The object pointer
+	# @return string The content hash (None if unknown or the states hold more than a definition)
+	def get_states_version(self):
+		return self._document.get("states_version")
+
+	## Set the content hash of the states as last saved
 	# @param self The object pointer
-	# @param list List of objects to save
-	def set_objects(self, objects_list):
-		self._document["objects"] = objects_list	
+	# @param string The content hash (None if unknown)
+	def set_states_version(self, version):
+		self._document["states_version"] = version
 
 	## Get the dictionary representing the workflow
 	# @param self The object pointer
 	# @return dict A dictionary representing the workflow
 	def to_dictionary(self):
+		#Documents saved before objects held their membership embed the object _ids
+		if "objects" in self._document:
+			del self._document["objects"]
+		return self._document
+
+
+## Process wide cache of compiled definitions keyed by content hash
+_definition_cache = {}
+
+## Policies resolving several transitions of a state activating at once
+#   "priority" takes the highest priority activated transition (ties go to the first
+#   end state in order), "error" raises ConflictError when activated transitions tie
+RESOLUTION_POLICIES = ("priority", "error")
+
+## Error raised when several transitions of a state activate with the same priority
+#   under the "error" resolution policy
+class ConflictError(Exception):
+
+	## Class constructor
+	# @param self The object pointer
+	# @param string The _id of the state
+	# @param list The end states of the conflicting transitions
+	def __init__(self, state_id, ends):
+		Exception.__init__(self, "Transitions of state %s to %s activated at the same priority" % (state_id, ", ".join(str(end) for end in ends)))
+		self.state_id = state_id
+		self.ends = ends
+
+	#Rebuild from the constructor arguments when unpickled (errors of shard workers are pickled)
+	def __reduce__(self):
+		return (ConflictError, (self.state_id, self.ends))
+
+## Events states can have hooks for
+HOOK_EVENTS = ("enter", "exit")
+
+#Helper function to check a resolution policy
+def _resolution_policy(policy):
+	if policy not in RESOLUTION_POLICIES:
+		raise ValueError("Unknown resolution policy %r" % (policy,))
+	return policy
+
+## Process wide intern table of compiled per state transition tables
+_compiled_tables = {}
+
+## Process wide cache of compiled predicate expressions keyed by source
+_compiled_expressions = {}
+
+## Comparison operators allowed in predicate expressions
+_EXPRESSION_COMPARISONS = {
+	ast.Eq: operator.eq,
+	ast.NotEq: operator.ne,
+	ast.Lt: operator.lt,
+	ast.LtE: operator.le,
+	ast.Gt: operator.gt,
+	ast.GtE: operator.ge,
+	ast.In: lambda left, right: right != None and left in right,
+	ast.NotIn: lambda left, right: right != None and left not in right,
+}
+
+## Comparisons that never hold when an operand is missing (None)
+_EXPRESSION_ORDERINGS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+## Compile a predicate expression over object fields
+#   Expressions use Python syntax limited to field names, constants (numbers, strings,
+#   True/False/None and lists/tuples of them), comparisons, and/or/not and unary minus,
+#   e.g. "gpa >= 3.0 and credits > 90". The expression is parsed once into an AST,
+#   checked against that subset and turned into nested closures, which are cached by
+#   source. Ordering comparisons with a missing field are false.
+# @param string The expression
+# @return function Predicate taking a field getter (get(key) returning None for missing fields)
+def compile_expression(source):
+	try:
+		return _compiled_expressions[source]
+	except KeyError:
+		pass
+	try:
+		tree = ast.parse(source.strip(), mode="eval")
+	except SyntaxError as error:
+		raise ValueError("Invalid expression %r: %s" % (source, error.msg))
+	predicate = _compile_expression_node(tree.body, source)
+	return _compiled_expressions.setdefault(source, predicate)
+
+#Helper function to get the value of a constant expression node (_MISSING if not a constant)
+def _expression_constant(node):
+	#Python 3.8+ parses every literal to Constant, earlier versions to Num/Str/Name
+	if type(node).__name__ in ("NameConstant", "Constant"):
+		return node.value
+	if type(node).__name__ == "Num":
+		return node.n
+	if type(node).__name__ == "Str":
+		return node.s
+	if isinstance(node, ast.Name) and node.id in ("True", "False", "None"):
+		return {"True": True, "False": False, "None": None}[node.id]
+	if isinstance(node, (ast.List, ast.Tuple)):
+		values = [_expression_constant(element) for element in node.elts]
+		if _MISSING in values:
+			return _MISSING
+		return tuple(values)
+	if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+		value = _expression_constant(node.operand)
+		if isinstance(value, (int, float)) and not isinstance(value, bool):
+			return -value
+	return _MISSING
+
+#Helper function to compile an expression node to a closure over a field getter
+def _compile_expression_node(node, source):
+	value = _expression_constant(node)
+	if value is not _MISSING:
+		return lambda get: value
+	if isinstance(node, ast.Name):
+		field = node.id
+		return lambda get: get(field)
+	if isinstance(node, ast.BoolOp):
+		operands = [_compile_expression_node(operand, source) for operand in node.values]
+		if isinstance(node.op, ast.And):
+			def evaluate(get):
+				for operand in operands:
+					result = operand(get)
+					if not result:
+						return result
+				return result
+		else:
+			def evaluate(get):
+				for operand in operands:
+					result = operand(get)
+					if result:
+						return result
+				return result
+		return evaluate
+	if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+		operand = _compile_expression_node(node.operand, source)
+		return lambda get: not operand(get)
+	if isinstance(node, ast.Compare):
+		operands = [_compile_expression_node(operand, source) for operand in [node.left] + node.comparators]
+		steps = []
+		for index, op in enumerate(node.ops):
+			if type(op) not in _EXPRESSION_COMPARISONS:
+				raise ValueError("Invalid expression %r: unsupported operator %s" % (source, type(op).__name__))
+			steps.append((_EXPRESSION_COMPARISONS[type(op)], isinstance(op, _EXPRESSION_ORDERINGS), operands[index + 1]))
+		first = operands[0]
+		#The common single comparison gets its own closure
+		if len(steps) == 1:
+			compare, ordering, right = steps[0]
+			if ordering:
+				def evaluate(get):
+					left_value = first(get)
+					right_value = right(get)
+					if left_value == None or right_value == None:
+						return False
+					return compare(left_value, right_value)
+			else:
+				evaluate = lambda get: compare(first(get), right(get))
+			return evaluate
+		def evaluate(get):
+			left_value = first(get)
+			for compare, ordering, right in steps:
+				right_value = right(get)
+				if ordering and (left_value == None or right_value == None):
+					return False
+				if not compare(left_value, right_value):
+					return False
+				left_value = right_value
+			return True
+		return evaluate
+	raise ValueError("Invalid expression %r: unsupported syntax %s" % (source, type(node).__name__))
+
+#Helper function to compile the guard of a condition from its {"expr": ...} items (None without any)
+def _condition_guard(condition):
+	guards = tuple(compile_expression(item["expr"]) for item in condition if isinstance(item, dict))
+	if not guards:
+		return None
+	if len(guards) == 1:
+		return guards[0]
+	def guard(get):
+		for predicate in guards:
+			if not predicate(get):
+				return False
+		return True
+	return guard
+
+#Helper function to get the trigger keys of a condition (leaving out its expressions)
+def _condition_triggers(condition):
+	return [key for key in condition if not isinstance(key, dict)]
+
+#Field getter of objects without any fields
+def _no_fields(key):
+	return None
+
+## Compiled condition: the frozenset of its trigger keys, carrying the guard compiled
+#   from its predicate expressions (None for conditions made of triggers only)
+class _Condition(frozenset):
+
+	__slots__ = ("guard",)
+
+	def __new__(cls, triggers, guard=None):
+		condition = frozenset.__new__(cls, triggers)
+		condition.guard = guard
+		return condition
+
+## Immutable, versioned snapshot of a workflow definition
+#   The snapshot is identified by the hash of its content, so two workflows (or two
+#   processes) that publish the same states share a single compiled definition
+class Definition:
+
+	## Class constructor
+	# @param self The object pointer
+	# @param dict The definition document (as produced by definition_from_states)
+	# @param dict Offsets of the encoded states in a mapped definition file, in the form
+	#   state _id => (start, length) (the document then only holds the _id)
+	# @param mmap The mapped definition file
+	def __init__(self, document, index=None, mapped=None):
+		#The definition document, never modified after construction
+		self._document = document
+		#The content hash identifying the definition
+		self._version = document["_id"]
+		#Compiled transition table in the form state _id => ((end, (frozenset, ...)), ...)
+		self._table = {}
+		#Friendly names of the states
+		self._names = {}
+		#Timer triggers armed when entering a state, in the form state _id => ((key, seconds), ...)
+		self._timers = {}
+		#Priorities of the compiled transitions, in table order, in the form state _id => (priority, ...)
+		self._priorities = {}
+		#AND-split and AND-join states
+		self._forks = set()
+		self._joins = set()
+		#Sub-workflow invocations in the form state _id => (workflow, start state _id)
+		self._invocations = {}
+		#Hooks in the form (state _id, event) => ({"event", "target", "concurrency"}, ...)
+		self._hooks = {}
+		#Exit and enter hooks of the transitions taken so far, in the form (from, to) => (hook, ...)
+		self._transition_hooks = {}
+		#Token bits of the states interned on first use, and the states by bit index
+		self._bits = {}
+		self._interned = []
+		#Token masks of the end states of forks and of the incoming states of joins
+		self._fork_masks = {}
+		self._join_masks = {}
+		#States of a mapped definition file are compiled on first use
+		self._index = index
+		self._mapped = mapped
+
+		if index == None:
+			for state in document["states"]:
+				self._compile(state)
+
+	#Helper function to compile a state document into the tables
+	def _compile(self, state):
+		self._names[state["_id"]] = state.get("description")
+		compiled = []
+		timers = []
+		#Highest priority first, so evaluation stops at the first activated transition
+		transitions = sorted(state["transitions"], key=lambda transition: -transition.get("priority", 0))
+		for transition in transitions:
+			conditions = tuple(_Condition(_condition_triggers(condition), _condition_guard(condition)) for condition in transition["conditions"])
+			compiled.append((transition["end"], conditions))
+			timers.extend(sorted(transition.get("timers", {}).items()))
+		if timers:
+			self._timers[state["_id"]] = tuple(timers)
+		self._priorities[state["_id"]] = tuple(transition.get("priority", 0) for transition in transitions)
+		if state.get("fork"):
+			self._forks.add(state["_id"])
+		if state.get("join"):
+			self._joins.add(state["_id"])
+		if state.get("invoke"):
+			self._invocations[state["_id"]] = (state["invoke"]["workflow"], state["invoke"]["start"])
+		for hook in state.get("hooks") or ():
+			self._hooks[(state["_id"], hook["event"])] = self._hooks.get((state["_id"], hook["event"]), ()) + (hook,)
+		#Identical states share one compiled table across every cached definition
+		#   (conditions compare by their triggers, so the guards are part of the key)
+		compiled = tuple(compiled)
+		key = (compiled, tuple(condition.guard for end, conditions in compiled for condition in conditions))
+		self._table[state["_id"]] = _compiled_tables.setdefault(key, compiled)
+		return self._table[state["_id"]]
+
+	#Helper function to get the compiled transitions of a state, compiling a mapped state on first use
+	def _transitions(self, state_id):
+		transitions = self._table.get(state_id)
+		if transitions == None:
+			if self._index == None or state_id not in self._index:
+				return ()
+			transitions = self._compile(self._mapped_state(state_id))
+		return transitions
+
+	#Helper function to decode a state of a mapped definition file
+	def _mapped_state(self, state_id):
+		start, length = self._index[state_id]
+		return BSON(self._mapped[start:start + length]).decode()
+
+	## Get the version of the definition
+	# @param self The object pointer
+	# @return string The content hash of the definition
+	def get_version(self):
+		return self._version
+
+	## Get the states of the definition
+	# @param self The object pointer
+	# @return list List of state _ids in the definition
+	def get_states(self):
+		if self._index != None:
+			return list(self._index.keys())
+		return list(self._table.keys())
+
+	## Get the friendly name of a state
+	# @param self The object pointer
+	# @param string The state _id
+	# @return string The friendly name of the state
+	def get_name(self, state_id):
+		self._transitions(state_id)
+		return self._names.get(state_id)
+
+	## Get the compiled transitions leaving a state
+	# @param self The object pointer
+	# @param string The state _id
+	# @return tuple Tuple of (end state _id, tuple of conditions as frozensets of triggers
+	#   whose guard attribute holds the compiled predicate expressions or None)
+	def get_transitions(self, state_id):
+		return self._transitions(state_id)
+
+	## Get the timer triggers armed when an object enters a state
+	# @param self The object pointer
+	# @param string The state _id
+	# @return tuple Tuple of (trigger key, seconds)
+	def get_timers(self, state_id):
+		self._transitions(state_id)
+		return self._timers.get(state_id, ())
+
+	## Check whether a state is an AND-split
+	# @param self The object pointer
+	# @param string The state _id
+	# @return bool Whether entering the state forks tokens into the end states of its transitions
+	def is_fork(self, state_id):
+		self._transitions(state_id)
+		return state_id in self._forks
+
+	## Check whether a state is an AND-join
+	# @param self The object pointer
+	# @param string The state _id
+	# @return bool Whether tokens arriving at the state wait for every incoming branch
+	def is_join(self, state_id):
+		self._transitions(state_id)
+		return state_id in self._joins
+
+	## Get the sub-workflow a state invokes
+	# @param self The object pointer
+	# @param string The state _id
+	# @return tuple (workflow identifier, start state _id) (None if the state invokes nothing)
+	def get_invocation(self, state_id):
+		self._transitions(state_id)
+		return self._invocations.get(state_id)
+
+	## Get the hooks called when objects enter or leave a state
+	# @param self The object pointer
+	# @param string The state _id
+	# @param string The event ("enter" or "exit")
+	# @return tuple Tuple of {"event", "target", "concurrency"} hooks
+	def get_hooks(self, state_id, event):
+		self._transitions(state_id)
+		return self._hooks.get((state_id, event), ())
+
+	## Get the hooks called when an object moves between two states of the definition
+	# @param self The object pointer
+	# @param string The _id of the state left (None when the object was created)
+	# @param string The _id of the state entered
+	# @return tuple The exit hooks of the first state followed by the enter hooks of the second
+	def get_transition_hooks(self, exited, entered):
+		hooks = self._transition_hooks.get((exited, entered))
+		if hooks == None:
+			hooks = self.get_hooks(entered, "enter")
+			if exited != None:
+				hooks = self.get_hooks(exited, "exit") + hooks
+			self._transition_hooks[(exited, entered)] = hooks
+		return hooks
+
+	## Get the features used by the states of the definition beyond plain trigger conditions
+	# @param self The object pointer
+	# @return set Subset of "guards", "forks", "joins", "invocations", "hooks" and "timers"
+	def get_features(self):
+		features = set()
+		for state_id in self.get_states():
+			for end, conditions in self._transitions(state_id):
+				if any(condition.guard != None for condition in conditions):
+					features.add("guards")
+		if self._forks:
+			features.add("forks")
+		if self._joins:
+			features.add("joins")
+		if self._invocations:
+			features.add("invocations")
+		if self._hooks:
+			features.add("hooks")
+		if self._timers:
+			features.add("timers")
+		return features
+
+	## Get the workflows invoked by the states of the definition
+	# @param self The object pointer
+	# @return set Set of workflow identifiers
+	def get_invoked_workflows(self):
+		return set(self.get_invocation(state_id)[0] for state_id in self.get_states() if self.get_invocation(state_id) != None)
+
+	## Get the bit of a state in the token sets of objects
+	#   State _ids are interned on first use, so a token set is an int with one bit per state
+	# @param self The object pointer
+	# @param string The state _id
+	# @return int The bit of the state
+	def token_bit(self, state_id):
+		bit = self._bits.get(state_id)
+		if bit == None:
+			bit = self._bits.setdefault(state_id, 1 << len(self._interned))
+			self._interned.append(state_id)
+		return bit
+
+	## Get the token set holding a token in each of the states
+	# @param self The object pointer
+	# @param list List of state _ids
+	# @return int The token set
+	def token_mask(self, state_ids):
+		mask = 0
+		for state_id in state_ids:
+			mask |= self.token_bit(state_id)
+		return mask
+
+	## Get the states holding a token in a token set
+	# @param self The object pointer
+	# @param int The token set
+	# @return list List of state _ids, in interning order
+	def token_states(self, mask):
+		states = []
+		index = 0
+		while mask:
+			if mask & 1:
+				states.append(self._interned[index])
+			mask >>= 1
+			index = index + 1
+		return states
+
+	## Get the token set an object entering a fork gets
+	#   Branches starting at another fork are forked in turn
+	# @param self The object pointer
+	# @param string The _id of the fork
+	# @return int The token set of the branches
+	def fork_mask(self, state_id):
+		mask = self._fork_masks.get(state_id)
+		if mask == None:
+			mask = 0
+			for end, conditions in self._transitions(state_id):
+				if self.is_fork(end) and end != state_id:
+					mask |= self.fork_mask(end)
+				else:
+					mask |= self.token_bit(end)
+			self._fork_masks[state_id] = mask
+		return mask
+
+	## Get the token set of the states a join waits for (every state with a transition to it)
+	# @param self The object pointer
+	# @param string The _id of the join
+	# @return int The token set of the incoming states
+	def join_mask(self, state_id):
+		mask = self._join_masks.get(state_id)
+		if mask == None:
+			mask = 0
+			for start in self.get_states():
+				for end, conditions in self._transitions(start):
+					if end == state_id:
+						mask |= self.token_bit(start)
+			self._join_masks[state_id] = mask
+		return mask
+
+	## Find the next state for a set of activated triggers
+	#   The highest priority activated transition wins (the "priority" resolution policy)
+	# @param self The object pointer
+	# @param string The current state _id
+	# @param set The activated trigger keys
+	# @param function Getter of the object fields guards are evaluated on (get(key), None for missing)
+	# @return string The _id of the next state (None if no transition is activated)
+	def next_state(self, state_id, triggers, fields=None):
+		transitions = self._table.get(state_id)
+		if transitions == None:
+			transitions = self._transitions(state_id)
+		for end, conditions in transitions:
+			for condition in conditions:
+				#Guards are only evaluated once the triggers of the condition are activated
+				if condition.issubset(triggers) and (condition.guard == None or condition.guard(fields or _no_fields)):
+					return end
+		return None
+
+	## Find the next state, raising ConflictError when activated transitions tie on priority
+	#   Evaluation stops at the first transition below the priority of the first activated one
+	# @param self The object pointer
+	# @param string The current state _id
+	# @param set The activated trigger keys
+	# @param function Getter of the object fields guards are evaluated on (get(key), None for missing)
+	# @return string The _id of the next state (None if no transition is activated)
+	def next_state_strict(self, state_id, triggers, fields=None):
+		transitions = self._transitions(state_id)
+		priorities = self._priorities.get(state_id, ())
+		activated = []
+		for (end, conditions), priority in zip(transitions, priorities):
+			if activated and priority < activated[0][1]:
+				break
+			for condition in conditions:
+				if condition.issubset(triggers) and (condition.guard == None or condition.guard(fields or _no_fields)):
+					activated.append((end, priority))
+					break
+		if len(activated) > 1:
+			raise ConflictError(state_id, [end for end, priority in activated])
+		return activated[0][0] if activated else None
+
+	## Find the next states of many objects in the same state
+	#   The transitions of the state are looked up once for the batch
+	# @param self The object pointer
+	# @param string The current state _id
+	# @param list List of (set of activated trigger keys, field getter) tuples
+	# @param string The resolution policy (see RESOLUTION_POLICIES)
+	# @return list The _id of the next state of each object (None where no transition is activated)
+	def next_states(self, state_id, objects, resolution="priority"):
+		if _resolution_policy(resolution) == "error":
+			return [self.next_state_strict(state_id, triggers, fields) for triggers, fields in objects]
+		transitions = self._transitions(state_id)
+		results = []
+		for triggers, fields in objects:
+			next_state = None
+			for end, conditions in transitions:
+				for condition in conditions:
+					if condition.issubset(triggers) and (condition.guard == None or condition.guard(fields or _no_fields)):
+						next_state = end
+						break
+				if next_state != None:
+					break
+			results.append(next_state)
+		return results
+
+	## Get the dictionary representing the definition
+	# @param self The object pointer
+	# @return dict A dictionary representing the definition
+	def to_dictionary(self):
+		if self._index != None:
+			#Decoded from the mapped file on every call rather than kept in memory
+			states = sorted(self._index.items(), key=lambda item: item[1][0])
+			return {"_id": self._version, "states": [self._mapped_state(state_id) for state_id, span in states]}
 		return self._document
 
 
+## Marker at the start of definition files
+_DEFINITION_FILE_MAGIC = b"COCODEF1"
+
+## Write a definition to a file that processes can map (see map_definition_file)
+#   The file holds a header indexing the encoded states by offset, followed by the
+#   states. It is written under a temporary name and renamed into place, so readers
+#   only ever see complete files.
+# @param string Path of the file
+# @param dict The definition document
+def write_definition_file(path, document):
+	states = [BSON.encode(state) for state in document["states"]]
+	index = []
+	offset = 0
+	for state, encoded in zip(document["states"], states):
+		index.append([state["_id"], offset, len(encoded)])
+		offset = offset + len(encoded)
+	header = BSON.encode({"_id": document["_id"], "index": index})
+	temporary = "%s.%d.tmp" % (path, os.getpid())
+	with open(temporary, "wb") as output:
+		output.write(_DEFINITION_FILE_MAGIC + struct.pack("<i", len(header)) + header)
+		for encoded in states:
+			output.write(encoded)
+	os.rename(temporary, path)
+
+## Map a definition file read-only
+#   The pages of the file are shared by every process mapping it, and each process
+#   only compiles the states it uses.
+# @param string Path of the file
+# @return Definition The definition
+def map_definition_file(path):
+	with open(path, "rb") as source:
+		mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+	if mapped[:8] != _DEFINITION_FILE_MAGIC:
+		raise ValueError("%s is not a definition file" % path)
+	size = struct.unpack_from("<i", mapped, 8)[0]
+	header = BSON(mapped[12:12 + size]).decode()
+	base = 12 + size
+	index = dict((state_id, (base + offset, length)) for state_id, offset, length in header["index"])
+	return Definition({"_id": header["_id"]}, index, mapped)
+
+## Build a definition document from in memory states
+# @param dict In memory states in the form _id => State
+# @return dict The definition document, with its content hash as _id
+def definition_from_states(states):
+	states_list = []
+	for state_id, state in states.items():
+		transitions_list = []
+		for end, trans in state.get_transitions().items():
+			transition_dict = {
+				"end": trans.get_end(),
+				"triggers": sorted(trans.to_dictionary()["triggers"].keys()),
+				"conditions": [list(condition) for condition in trans.get_conditions()],
+			}
+			#Only hash timers and priorities when present so definitions without them keep their version
+			if trans.get_timers():
+				transition_dict["timers"] = dict(trans.get_timers())
+			if trans.get_priority():
+				transition_dict["priority"] = trans.get_priority()
+			transitions_list.append(transition_dict)
+		transitions_list.sort(key=lambda transition: str(transition["end"]))
+		state_dict = {
+			"_id": state_id,
+			"description": state.get_name(),
+			"transitions": transitions_list,
+		}
+		#Only hash the parallel flags and invocations when set so definitions without them keep their version
+		if state.is_fork():
+			state_dict["fork"] = True
+		if state.is_join():
+			state_dict["join"] = True
+		if state.get_invoke() != None:
+			state_dict["invoke"] = dict(state.get_invoke())
+		if state.get_hooks():
+			state_dict["hooks"] = sorted((dict(hook) for hook in state.get_hooks()), key=lambda hook: (hook["event"], str(hook["target"])))
+		states_list.append(state_dict)
+	states_list.sort(key=lambda state: str(state["_id"]))
+
+	#Hash a canonical encoding of the content (ObjectIds are hashed by their string form)
+	canonical = json.dumps(states_list, sort_keys=True, separators=(",", ":"), default=str)
+	version = hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+	return {"_id": version, "states": states_list}
+
+#Helper function to get the content hash of in memory states (None if a state holds more
+#than its definition keeps, such as other fields or activated triggers)
+def _states_version(states):
+	for state in states.values():
+		document = state.to_dictionary()
+		if not set(document.keys()) <= _DEFINITION_STATE_KEYS:
+			return None
+		for transition in document.get("transitions") or []:
+			if not set(transition.keys()) <= _DEFINITION_TRANSITION_KEYS or any(transition["triggers"].values()):
+				return None
+	return definition_from_states(states)["_id"]
+
+#Helper function to build a state document from a state of a definition document
+def _definition_state_document(state):
+	document = {"_id": state["_id"], "transitions": []}
+	if state.get("description") != None:
+		document["description"] = state["description"]
+	for key in ("fork", "join", "invoke", "hooks"):
+		if state.get(key):
+			document[key] = state[key]
+	for transition in state["transitions"]:
+		document["transitions"].append({
+			"end": transition["end"],
+			"triggers": dict((key, False) for key in transition["triggers"]),
+			"conditions": transition["conditions"],
+			"timers": transition.get("timers", {}),
+			"priority": transition.get("priority", 0),
+		})
+	return document
+
+## Keys of state and transition documents that a definition keeps
+_DEFINITION_STATE_KEYS = frozenset(["_id", "description", "transitions", "fork", "join", "invoke", "hooks"])
+_DEFINITION_TRANSITION_KEYS = frozenset(["end", "triggers", "conditions", "timers", "priority"])
+
+## Get the compiled definition for a definition document
+#   Compiled definitions are cached per process, so a version is only compiled once
+# @param dict The definition document
+# @return Definition The compiled definition
+def compile_definition(document):
+	try:
+		return _definition_cache[document["_id"]]
+	except KeyError:
+		definition = Definition(document)
+		_definition_cache[document["_id"]] = definition
+		return definition
+
+#String types of trigger keys (str and unicode on Python 2)
+_text_types = (str, type(u""))
+
+#Helper function to get a part of a spec, checking its type
+#   A missing part is empty; a part of another type is reported and treated as empty
+def _spec_part(value, kind, where, errors):
+	if value == None:
+		return kind()
+	if kind == list and isinstance(value, tuple):
+		return list(value)
+	if not isinstance(value, kind):
+		errors.append("%s must be a %s, not %s" % (where, "mapping" if kind == dict else "list", type(value).__name__))
+		return kind()
+	return value
+
+## Build the state documents of a declarative workflow spec
+#   A spec has the form
+#     {"states": {state_id: {"name": ..., "fork": false, "join": false, "invoke": {"workflow": ..., "start": ...},
+#       "hooks": [{"event": "enter", "target": ..., "concurrency": 1}], "transitions": {end_id: {"triggers": [...], "conditions": [[...]], "timers": {key: seconds}, "priority": 0}}}}}
+#   Timer keys are triggers too; every trigger of a condition must be declared. A
+#   condition item may also be a predicate over the object fields, {"expr": "credits > 90"}.
+# @param dict|string The spec (or its JSON/YAML text)
+# @param list The _ids of states that exist outside the spec (valid transition ends)
+# @param function Function called once with the list of end _ids found neither in the spec
+#   nor in known_states, returning those that exist elsewhere (such as in MongoDB)
+# @return OrderedDict State documents keyed by _id, in spec order
+def spec_to_documents(spec, known_states=(), lookup=None):
+	if isinstance(spec, (str, bytes, type(u""))):
+		if yaml != None:
+			try:
+				spec = yaml.safe_load(spec)
+			except yaml.YAMLError as error:
+				raise ValueError("The spec is not valid YAML: %s" % error)
+		else:
+			try:
+				spec = json.loads(spec)
+			except ValueError:
+				raise ValueError("The spec is not valid JSON (install PyYAML for YAML specs)")
+	if not isinstance(spec, dict) or not isinstance(spec.get("states"), dict):
+		raise ValueError("The spec must hold a 'states' mapping")
+
+	states = spec["states"]
+	errors = []
+	#Unknown end states as (end, position of their error), checked with the lookup at the end
+	unknown = []
+	documents = OrderedDict()
+	for state_id in states:
+		state_spec = _spec_part(states[state_id], dict, "%s: state" % state_id, errors)
+		transitions = []
+		transition_specs = _spec_part(state_spec.get("transitions"), dict, "%s: transitions" % state_id, errors)
+		for end in transition_specs:
+			where = "%s -> %s" % (state_id, end)
+			transition_spec = _spec_part(transition_specs[end], dict, "%s: transition" % where, errors)
+			if end not in states and end not in known_states:
+				unknown.append((end, len(errors)))
+				errors.append("%s: unknown end state" % where)
+			timers = dict(_spec_part(transition_spec.get("timers"), dict, "%s: timers" % where, errors))
+			for key, seconds in list(timers.items()):
+				if not isinstance(key, _text_types):
+					errors.append("%s: timer %r needs a string key" % (where, key))
+					del timers[key]
+				elif not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or seconds < 0:
+					errors.append("%s: timer %s needs a number of seconds" % (where, key))
+			declared = _spec_part(transition_spec.get("triggers"), list, "%s: triggers" % where, errors)
+			for key in declared:
+				if not isinstance(key, _text_types):
+					errors.append("%s: trigger %r needs a string key" % (where, key))
+			declared = [key for key in declared if isinstance(key, _text_types)]
+			triggers = declared + [key for key in timers if key not in declared]
+			conditions = []
+			for condition in _spec_part(transition_spec.get("conditions"), list, "%s: conditions" % where, errors):
+				if not isinstance(condition, (list, tuple)):
+					errors.append("%s: conditions need to be lists of triggers" % where)
+					continue
+				conditions.append(list(condition))
+				for key in condition:
+					if isinstance(key, dict):
+						try:
+							compile_expression(key.get("expr"))
+						except (ValueError, AttributeError, TypeError) as error:
+							errors.append("%s: %s" % (where, error if isinstance(error, ValueError) else "expression items need an 'expr' string"))
+					elif not isinstance(key, _text_types):
+						errors.append("%s: condition item %r needs to be a trigger or an {'expr': ...} predicate" % (where, key))
+					elif key not in triggers:
+						errors.append("%s: condition uses undeclared trigger %s" % (where, key))
+			priority = transition_spec.get("priority", 0)
+			if not isinstance(priority, int) or isinstance(priority, bool):
+				errors.append("%s: priority needs an integer" % where)
+			transitions.append({"end": end, "triggers": dict((key, False) for key in triggers), "conditions": conditions, "timers": timers, "priority": priority})
+		document = {"_id": state_id, "transitions": transitions}
+		if state_spec.get("name") != None:
+			document["description"] = state_spec["name"]
+		for flag in ("fork", "join"):
+			if state_spec.get(flag):
+				document[flag] = True
+		for hook in _spec_part(state_spec.get("hooks"), list, "%s: hooks" % state_id, errors):
+			if not isinstance(hook, dict) or hook.get("event") not in HOOK_EVENTS or not hook.get("target"):
+				errors.append("%s: hooks need an 'event' (%s) and a 'target'" % (state_id, " or ".join(HOOK_EVENTS)))
+				continue
+			concurrency = hook.get("concurrency", 1)
+			if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+				errors.append("%s: hook %s needs a positive concurrency" % (state_id, hook["target"]))
+				continue
+			document.setdefault("hooks", []).append({"event": hook["event"], "target": hook["target"], "concurrency": concurrency})
+		invoke = state_spec.get("invoke")
+		if invoke != None:
+			if not isinstance(invoke, dict) or invoke.get("workflow") == None or invoke.get("start") == None:
+				errors.append("%s: invoke needs a 'workflow' and a 'start' state" % state_id)
+			else:
+				document["invoke"] = {"workflow": invoke["workflow"], "start": invoke["start"]}
+		documents[state_id] = document
+	if unknown and lookup != None:
+		existing = set(lookup(list(set(end for end, position in unknown))))
+		found = set(position for end, position in unknown if end in existing)
+		errors = [error for position, error in enumerate(errors) if position not in found]
+	if errors:
+		raise ValueError("Invalid workflow spec:\n  " + "\n  ".join(errors))
+	return documents
+
+#Helper function to get a canonical form of a state document, ignoring trigger activation and ordering
+def _state_signature(document):
+	if isinstance(document, RawBSONDocument):
+		document = BSON(document.raw).decode()
+	transitions = []
+	for transition in document.get("transitions", []):
+		transitions.append({
+			"end": transition["end"],
+			"triggers": sorted(transition.get("triggers", {}).keys()),
+			"conditions": [list(condition) for condition in transition.get("conditions", [])],
+			"timers": dict(transition.get("timers", {})),
+			"priority": transition.get("priority", 0),
+		})
+	transitions.sort(key=lambda transition: str(transition["end"]))
+	return json.dumps({"description": document.get("description"), "transitions": transitions, "fork": bool(document.get("fork")), "join": bool(document.get("join")), "invoke": document.get("invoke"), "hooks": sorted((dict(hook) for hook in document.get("hooks") or []), key=lambda hook: (hook["event"], str(hook["target"])))}, sort_keys=True, default=str)
+
+#Helper function to build the aggregation pipeline counting, for each condition, the
+#objects by number of the condition's triggers they activated
+def _condition_pipeline(query, conditions):
+	triggers = {"$ifNull": ["$triggers", []]}
+	project = {"_id": 0}
+	facets = {}
+	for index, condition in enumerate(conditions):
+		project["c%d" % index] = {"$size": {"$setIntersection": [triggers, {"$literal": list(condition)}]}}
+		facets["c%d" % index] = [{"$group": {"_id": "$c%d" % index, "objects": {"$sum": 1}}}]
+	return [{"$match": query}, {"$project": project}, {"$facet": facets}]
+
 ## Workflow engine
 class Cocopan:
 
@@ -406,81 +2834,182 @@ class Cocopan:
 	## The workflow data model representing the Cocopan process
 	_workflow_dm = None
 
-	# In memory dict of states
-	_states = {}
+	# In memory dict of states (created per instance)
+	_states = None
 
 	## The collection that holds all of the states in the system
 	_states_collection = None
 
-	# In memory dicts of objects
-	_objects = {}
+	# In memory dicts of objects (created per instance)
+	_objects = None
 
 	## The collection that holds all of the objects in the system
 	_objects_collection = None
 
+	## The collection that holds the published (immutable) workflow definitions
+	_definitions_collection = None
+
+	## The collection that holds pending trigger events shared by all workers
+	_queue_collection = None
+
+	## The collection that holds the armed timer triggers
+	_timer_collection = None
+
+	## The collection that holds the hook calls until they are delivered
+	_outbox_collection = None
+
+	## The projection profile objects are loaded with ("engine", "full" or a list of fields)
+	_projection = "full"
+
+	## Directory holding definition files shared by the processes of a host (None to disable)
+	_definition_cache_dir = None
+
+	## Policy resolving several transitions activating at once (see RESOLUTION_POLICIES)
+	_resolution = "priority"
+
 	## Class constructor
 	# @param string MongoDB connection parameters
-	def __init__(self, connection=None):
+	# @param Database Database interface to share (overrides the connection parameters)
+	# @param dict Pool of State objects shared with other workflows (keyed by state _id)
+	def __init__(self, connection=None, database=None, state_pool=None):
 		#Initialize the connection to the MongoDB instance
-		self.db = Database(connection)
+		self.db = database if database != None else Database(connection)
 		#Initialize the workflow data model 
 		self._workflow_dm = Workflow()
-
+		#In memory states and objects belong to this instance only
+		self._states = {}
+		self._objects = {}
+		#Approximate size in bytes of the in memory objects, and the objects not yet measured
+		self._object_bytes = 0
+		self._unsized = []
+		#States loaded by other workflows that can be reused instead of fetched
+		self._state_pool = state_pool
+		#Whether the queue indexes have been ensured by this instance
+		self._queue_indexed = False
+		#Whether the workflow membership index on the objects has been ensured by this instance
+		self._membership_indexed = False
+		#Timer documents armed since the last save
+		self._pending_timers = []
+		#Hook calls recorded since the last save, as ((hook, ...), object _id, from, to, timestamp)
+		self._pending_calls = []
+		#Graphviz fragments of the states keyed by (state _id, collapsed edges)
+		self._graph_cache = {}
+		#Write-behind buffer (None while changes are saved explicitly)
+		self._write_behind = None
+		#Published definition versions of the invoked workflows, looked up on first invocation
+		self._child_versions = {}
+		#Hook dispatcher (None while hooks are not dispatched)
+		self._hooks = None
+
+
+	#Helper function to build the states from the shared definition file of the version they were saved as
+	#   Returns False (loading nothing) when there is no file for that version or it holds other states
+	@traced("_load_mapped_states")
+	def _load_mapped_states(self, states_list):
+		version = self._workflow_dm.get_states_version()
+		if self._definition_cache_dir == None or version == None:
+			return False
+		definition = _definition_cache.get(version)
+		if definition == None:
+			if not os.path.exists(self._definition_path(version)):
+				return False
+			definition = _definition_cache.setdefault(version, map_definition_file(self._definition_path(version)))
+		if sorted(definition.get_states(), key=str) != sorted(states_list, key=str):
+			return False
+		for document in definition.to_dictionary()["states"]:
+			state_id = document["_id"]
+			#Reuse the state if another workflow already loaded it
+			state = self._state_pool.get(state_id) if self._state_pool != None else None
+			if state == None:
+				state = decode_state(_definition_state_document(document))
+				if self._state_pool != None:
+					self._state_pool[state_id] = state
+			self._states[state_id] = state
+		return True
 
 	# Helper function to laod state
+	@traced("_load_state")
 	def _load_state(self, state_id):
+			#Reuse the state if another workflow already loaded it
+			if self._state_pool != None:
+				state = self._state_pool.get(state_id)
+				if state != None:
+					self._states[state_id] = state
+					return
 			# Get a connection instance to MongoDB
 			conn = self.db.connect(self._db_name)
 			# Get an instance of the states collection in MongoDB
 			state_collection = conn[self._states_collection]
-			# Get the state from mongoDB as a dictionary
-			doc_dict = conn[self._states_collection].find_one({"_id": state_id})
+			# Get the state from mongoDB as raw BSON (decoded lazily)
+			doc_dict = state_collection.with_options(codec_options=RAW_CODEC_OPTIONS).find_one({"_id": state_id})
 
-    		# Create a new in memory state object from the dictionary
-			self._states[state_id] = State(doc_dict)
-			self._states[state_id].from_dictionary(doc_dict)
+    		# Create a new in memory state object from the document
+			self._states[state_id] = decode_state(doc_dict)
+			if self._state_pool != None:
+				self._state_pool[state_id] = self._states[state_id]
 
 	# Helper function to load object
-	def _load_object(self, object_id):
+	@traced("_load_object")
+	def _load_object(self, object_id, projection=None):
+			fields = _projection_fields(projection if projection != None else self._projection)
 			# Get a connection instance to MongoDB
 			conn = self.db.connect(self._db_name)
 			# Get an instance of the objects collection in MongoDB
 			object_collection = conn[self._objects_collection]
-			# Get the object from mongoDB as a dictionary
-			doc_dict = conn[self._objects_collection].find_one({"_id": object_id})
-
-    		# Create a new in memory object from the dictionary
-			self._objects[object_id] = Object()
-			self._objects[object_id].from_dictionary(doc_dict)
+			# Get the object from mongoDB as raw BSON (fields are decoded on access)
+			doc_dict = object_collection.with_options(codec_options=RAW_CODEC_OPTIONS).find_one({"_id": object_id}, _projection_document(fields))
+
+    		# Create a new in memory object from the document
+			if doc_dict != None:
+				self._hold_object(object_id, self._decode_object(doc_dict, fields))
+				self._objects[object_id]._owner = self._write_behind
+
+	# Helper function to create an object from a (possibly projected) document
+	def _decode_object(self, doc_dict, fields):
+		it_object = decode_object(doc_dict)
+		if fields != None:
+			it_object.set_partial(fields, functools.partial(self._fetch_object, it_object.get_field("_id")))
+		return it_object
+
+	# Helper function to fetch the full document of a partially loaded object
+	@traced("_fetch_object")
+	def _fetch_object(self, object_id):
+		conn = self.db.connect(self._db_name)
+		return conn[self._objects_collection].with_options(codec_options=RAW_CODEC_OPTIONS).find_one({"_id": object_id})
 
 	## Load existing workflow from MongoDB
 	# @param self The object pointer
 	# @param string The workflow identifier
-	def load(self, workflow_id):
+	# @param string|list The projection profile for the objects (defaults to the one set with set_projection)
+	@instrumented("load")
+	def load(self, workflow_id, projection=None):
 
 		#Check to see if the workflow exists
 		# Get a connection instance to MongoDB
 		conn = self.db.connect(self._db_name)
+		#Get the document as a dictionary (None if the workflow does not exist)
+		doc_dict = conn[self._workflow_collection].find_one({"_id": workflow_id})
 		# A workflow exists with that identifier
-		if conn[self._workflow_collection].find({"_id": workflow_id}).limit(1).count() > 0:
+		if doc_dict != None:
 			print "WORKFLOW EXISTS"
-			#Get the document as a dictionary
-			doc_dict = conn[self._workflow_collection].find_one({"_id": workflow_id})
+			object_collection = self._object_membership(conn)
+			#Move the membership of a workflow saved with the object _ids embedded onto
+			#the objects (the array is dropped from the document on the next save)
+			legacy = doc_dict.get("objects") or []
+			for start in range(0, len(legacy), 1000):
+				object_collection.update_many({"_id": {"$in": legacy[start:start + 1000]}}, {"$set": {"workflow_id": workflow_id}})
 			#Create the workflow data model object
-			self._workflow_dm = Workflow(doc_dict)
+			self._workflow_dm = Workflow(doc_dict, object_collection)
 			#Get a list of states associated with the workflow
 			states_list = self._workflow_dm.get_states()
 
-			#Load each state into memory
-			for state in states_list:
-				self._load_state(state)
+			#Load the states from the definition file of their version, or else each from MongoDB
+			if not self._load_mapped_states(states_list):
+				for state in states_list:
+					self._load_state(state)
 
-			#Get a list of objects associated with the workflow
-			objects_list = self._workflow_dm.get_objects()
-
-			#Load each object into memory
-			for it_object in objects_list:
-				self._load_object(it_object)
+			#Load the member objects into memory, a cursor batch at a time
+			self._load_members(projection)
 
 			return True
 		# A workflow does not exist with that identifier
@@ -495,7 +3024,7 @@ class Cocopan:
 			#Get the document as a dictionary
 			doc_dict = conn[self._workflow_collection].find_one({"_id": workflow_id})
 			#Create the workflow data model object
-			self._workflow_dm = Workflow(doc_dict)
+			self._workflow_dm = Workflow(doc_dict, self._object_membership(conn))
 
 			return False
 
@@ -519,10 +3048,58 @@ class Cocopan:
 	def set_workflow_collection(self, collection):
 		self._workflow_collection = collection 	
 
+	## Set the MongoDB collection that holds the published workflow definitions
+	# @param string Collection name that holds the definitions
+	def set_definition_collection(self, collection):
+		self._definitions_collection = collection
+
+	## Set the MongoDB collection that holds the pending trigger events
+	# @param string Collection name that holds the queue
+	def set_queue_collection(self, collection):
+		self._queue_collection = collection
+
+	## Set the MongoDB collection that holds the armed timer triggers
+	# @param string Collection name that holds the timers
+	def set_timer_collection(self, collection):
+		self._timer_collection = collection
+
+	## Set the MongoDB collection that holds the hook calls until they are delivered
+	#   Hook calls are only recorded while an outbox collection is set; they are delivered
+	#   by the dispatcher started with hooks(), or by redeliver() of a dispatcher of another process
+	# @param string Collection name that holds the outbox
+	def set_outbox_collection(self, collection):
+		self._outbox_collection = collection
+
+	## Set the projection profile objects are loaded with
+	#   "engine" loads only the fields needed to advance objects, "full" the whole
+	#   document; a list loads those fields. Other fields are fetched on first access.
+	# @param string|list The projection profile
+	def set_projection(self, profile):
+		_projection_fields(profile)
+		self._projection = profile
+
+	## Set the directory of the definition files shared by the processes of a host
+	#   Definitions are then mapped from a file instead of fetched and compiled by every
+	#   process; the first process needing a version writes its file. A tmpfs such as
+	#   /dev/shm keeps the files in memory.
+	# @param string Path of the directory (None to disable)
+	def set_definition_cache(self, directory):
+		if directory != None and not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._definition_cache_dir = directory
+
+	## Set the policy resolving several transitions of a state activating at once
+	#   "priority" advances along the highest priority activated transition, "error"
+	#   raises ConflictError (leaving the object in its state) when they tie on priority
+	# @param string The resolution policy (see RESOLUTION_POLICIES)
+	def set_resolution(self, policy):
+		self._resolution = _resolution_policy(policy)
+
 	## Create a new workflow state
 	# @param self The object pointer
 	# @param string A unique identifier for the state
 	# @return State Return the created state
+	@instrumented("new_state")
 	def new_state(self, state_id):
 		# Get a connection instance to MongoDB
 		conn = self.db.connect(self._db_name)
@@ -541,49 +3118,655 @@ class Cocopan:
 		#Return the created state object
 		return self._states.get(doc_id)
 
+	## Define states and transitions from a declarative spec
+	#   The spec is validated first (see spec_to_documents). States that differ from
+	#   the stored ones are written with a single bulk upsert, so re-applying an
+	#   unchanged spec writes nothing.
+	# @param self The object pointer
+	# @param dict|string The spec (or its JSON/YAML text)
+	# @return list The _ids of the states that were written
+	@instrumented("define")
+	def define(self, spec):
+		conn = self.db.connect(self._db_name)
+		state_collection = conn[self._states_collection]
+		#Transitions may end in states that are only stored in MongoDB
+		lookup = lambda ends: [document["_id"] for document in state_collection.find({"_id": {"$in": ends}}, {"_id": 1})]
+		documents = spec_to_documents(spec, self._states, lookup)
+
+		#Compare with the states in memory, and fetch the others in one query
+		current = {}
+		missing = []
+		for state_id in documents:
+			if state_id in self._states:
+				current[state_id] = self._states[state_id].to_dictionary()
+			else:
+				missing.append(state_id)
+		if missing:
+			for document in state_collection.find({"_id": {"$in": missing}}):
+				current[document["_id"]] = document
+
+		changed = [state_id for state_id, document in documents.items() if state_id not in current or _state_signature(current[state_id]) != _state_signature(document)]
+		if changed:
+			state_collection.bulk_write([ReplaceOne({"_id": state_id}, documents[state_id], upsert=True) for state_id in changed], ordered=False)
+			#The stored states no longer form the definition recorded on the last save
+			self._workflow_dm.set_states_version(None)
+			conn[self._workflow_collection].update_one({"_id": self._workflow_dm.get_id()}, {"$set": {"states_version": None}})
+
+		for state_id, document in documents.items():
+			if state_id in changed:
+				state = State(document)
+				state.from_dictionary(document)
+			elif state_id not in self._states:
+				state = State(current[state_id])
+				state.from_dictionary(current[state_id])
+			else:
+				continue
+			self._states[state_id] = state
+			if self._state_pool != None:
+				self._state_pool[state_id] = state
+		return changed
+
 	## Retrive a state from the workflow
 	# @param self The object pointer
 	# @param string The _id of the state (MondoDB ID)
 	# @return State The State object
+	@instrumented("get_state")
 	def get_state(self, state_id):
 		#See if the state is in memory
 		try:
 			return self._states[state_id]
     	#If not, retrive from MongoDB (lazy loading of states)
 		except KeyError:
-			# Get a connection instance to MongoDB
-			conn = self.db.connect(self._db_name)
-			# Get an instance of the states collection in MongoDB
-			state_collection = conn[self._states_collection]
-			# Get the state from mongoDB as a dictionary
-    		doc_dict = conn[self._states_collection].find_one({"_id": state_id})
-    		# Create a new in memory state object from the dictionary
-    		self._states[state_id] = State(doc_dict)
+			#Load the state from MongoDB (or the shared pool)
+			self._load_state(state_id)
+			return self._states[state_id]
 
 	## Create the object that will be tracked through the workflow
 	# @param self The object pointer
 	# @param string The ID of the start state
 	# @return Object Return the created object
+	@instrumented("new_object")
 	def new_object(self, start_state):
-		# Get a connection instance to MongoDB
+		return self.new_objects(start_state, 1)[0]
+
+	## Create a batch of objects in a start state
+	#   The _ids are generated client side and the documents written with one
+	#   insert_many per batch, instead of an insert and a read back per object
+	# @param self The object pointer
+	# @param State The start state
+	# @param int|list The number of objects, or a list of payload dicts (one per object) holding their initial fields
+	# @param int Number of documents per insert_many
+	# @return list The created objects, in order
+	@instrumented("new_objects")
+	def new_objects(self, start_state, count_or_payloads, batch_size=1000):
+		if isinstance(count_or_payloads, int):
+			payloads = [{} for index in range(count_or_payloads)]
+		else:
+			payloads = count_or_payloads
+		state_id = start_state.get_state_id()
+		workflow_id = self._workflow_dm.get_id()
+		#Pin the objects to the definition version they run under
+		version = self._workflow_dm.get_version()
+		definition = self.definition(version) if version != None else None
 		conn = self.db.connect(self._db_name)
-		# Get an instance of the objects collection in MongoDB
 		object_collection = conn[self._objects_collection]
-		#Create a blank document in the objects collection and get the document ID back
-		result = object_collection.insert_one({})
-		#Get the _id of the document
-		doc_id = result.inserted_id
-		#Get the document as a dictionary
-		doc_dict = conn[self._objects_collection].find_one({"_id": doc_id})
-		#Create the new object
-		created_object = Object(start_state)
-		#Add the state object to the in memory list of states
-		self._objects[doc_id] = created_object
-		#Return the created state object
-		return created_object
+		created = []
+		documents = []
+		for payload in payloads:
+			document = dict(payload)
+			if "_id" not in document:
+				document["_id"] = ObjectId()
+			document["workflow_id"] = workflow_id
+			document["init_state"] = state_id
+			document["state"] = state_id
+			document["triggers"] = []
+			document["version"] = version
+			documents.append(document)
+			if len(documents) == batch_size:
+				object_collection.insert_many(documents, ordered=False)
+				created.extend(self._register_objects(documents, definition))
+				documents = []
+		if documents:
+			object_collection.insert_many(documents, ordered=False)
+			created.extend(self._register_objects(documents, definition))
+		return created
+
+	#Helper function to add newly inserted object documents to the in memory objects
+	def _register_objects(self, documents, definition):
+		created = []
+		for document in documents:
+			it_object = Object()
+			#The in memory object must not share the lists of the inserted document
+			it_object.from_dictionary(dict(document, triggers=[]))
+			#Entering the start state forks tokens and invokes sub-workflows as entering it later would
+			if definition != None:
+				self._enter_state(it_object, definition, document["state"], True)
+			it_object._owner = self._write_behind
+			self._hold_object(document["_id"], it_object)
+			created.append(it_object)
+		return created
+
+	## Get an object tracked by the workflow
+	# @param self The object pointer
+	# @param ObjectId The _id of the object
+	# @param string|list The projection profile to load the object with if it is not in memory
+	# @return Object The Object (None if the object is not in memory and no profile was given, or does not exist)
+	def get_object(self, object_id, projection=None):
+		it_object = self._objects.get(object_id)
+		if it_object == None and projection != None:
+			self._load_object(object_id, projection)
+			it_object = self._objects.get(object_id)
+		return it_object
+
+	## Get the _ids of the objects held in memory
+	# @param self The object pointer
+	# @return list List of object _ids
+	def get_object_ids(self):
+		return list(self._objects.keys())
+
+	## Activate a trigger for an object and advance it if a transition activates
+	# @param self The object pointer
+	# @param ObjectId The _id of the object
+	# @param string The trigger key
+	# @return string The _id of the state the object moved to (None if it did not move)
+	@instrumented("trigger_activate")
+	def trigger_activate(self, object_id, key):
+		it_object = self._objects[object_id]
+		it_object.trigger_activate(key)
+		#Evaluate against the definition the object is pinned to
+		definition = self.definition(it_object.get_version())
+		if definition == None:
+			raise ValueError("Workflow %s is not published" % self._workflow_dm.get_id())
+		if it_object.get_tokens():
+			return self._advance_tokens(it_object, definition)
+		next_state = self._resolve(definition, it_object.get_current_state(), set(it_object.get_triggers()), it_object)
+		if next_state != None:
+			next_state = self._enter_state(it_object, definition, next_state)
+		return next_state
+
+	#Helper function to find the next state of an object with the resolution policy of the engine
+	def _resolve(self, definition, state_id, triggers, it_object):
+		if self._resolution == "error":
+			return definition.next_state_strict(state_id, triggers, it_object._get)
+		return definition.next_state(state_id, triggers, it_object._get)
+
+	#Helper function to move an object to a state, forking tokens into the branches of a fork
+	#   and entering or returning from sub-workflows
+	#   A created object enters its start state from no state, so only enter hooks are called;
+	#   the start state of an invoked workflow is entered without leaving the invoking state
+	# @return string The state the object ended in
+	def _enter_state(self, it_object, definition, state_id, created=False, invoked=False):
+		if self._outbox_collection != None:
+			self._notify(it_object, None if created else it_object.get_current_state(), state_id, None if invoked else definition, definition)
+		#A created object is already placed in its start state
+		if not created:
+			it_object.set_current_state(state_id)
+		self._arm_timers(it_object, definition)
+		if definition.is_fork(state_id):
+			tokens = definition.token_states(definition.fork_mask(state_id))
+			it_object.set_tokens(tokens)
+			for token in tokens:
+				self._arm_timers(it_object, definition, token)
+			return state_id
+		if it_object.get_tokens():
+			it_object.set_tokens([])
+		invocation = definition.get_invocation(state_id)
+		if invocation != None:
+			return self._invoke(it_object, definition, state_id, invocation)
+		if it_object.get_calls() and not definition.get_transitions(state_id):
+			return self._return(it_object, definition, state_id)
+		return state_id
+
+	#Helper function to record the hook calls of the state an object left and the state it entered
+	#   The exit (enter) hooks are looked up in exit_definition (enter_definition), and not
+	#   called when it is None. The calls are written to the outbox with the next save.
+	def _notify(self, it_object, exited, entered, exit_definition, enter_definition):
+		if exit_definition is enter_definition:
+			hooks = enter_definition.get_transition_hooks(exited, entered)
+		else:
+			hooks = ()
+			if exit_definition != None and exited != None:
+				hooks = exit_definition.get_hooks(exited, "exit")
+			if enter_definition != None:
+				hooks = hooks + enter_definition.get_hooks(entered, "enter")
+		if hooks:
+			self._pending_calls.append((hooks, it_object._get("_id"), exited, entered, time.time()))
+
+	#Helper function to move an object into the start state of an invoked workflow
+	def _invoke(self, it_object, definition, state_id, invocation):
+		workflow_id, start = invocation
+		child = self._child_definition(workflow_id)
+		if child == None:
+			raise ValueError("Workflow %s invoked by state %s has no published definition" % (workflow_id, state_id))
+		it_object.set_calls(it_object.get_calls() + [{"workflow": workflow_id, "state": state_id, "version": definition.get_version()}])
+		it_object.set_version(child.get_version())
+		return self._enter_state(it_object, child, start, invoked=True)
+
+	#Helper function to return an object from the terminal state of an invoked workflow
+	#   to the invoking state, which sees the terminal state as an activated trigger
+	#   The object leaves the terminal state (its exit hooks are called) for the invoking
+	#   state it never left, so no enter hooks are called
+	def _return(self, it_object, child, terminal):
+		calls = it_object.get_calls()
+		frame = calls[-1]
+		if self._outbox_collection != None:
+			self._notify(it_object, terminal, frame["state"], child, None)
+		it_object.set_calls(calls[:-1])
+		it_object.set_version(frame["version"])
+		definition = self.definition(frame["version"])
+		it_object.set_current_state(frame["state"])
+		it_object.trigger_activate(terminal)
+		next_state = self._resolve(definition, frame["state"], set([terminal]), it_object)
+		if next_state != None:
+			return self._enter_state(it_object, definition, next_state)
+		return frame["state"]
+
+	#Helper function to get the compiled definition an invoked workflow runs under
+	#   The version is looked up once per engine (and again after refresh()); the compiled
+	#   definition comes from the process wide cache, so every parent shares it
+	def _child_definition(self, workflow_id):
+		version = self._child_versions.get(workflow_id)
+		if version == None:
+			conn = self.db.connect(self._db_name)
+			doc_dict = conn[self._workflow_collection].find_one({"_id": workflow_id}, {"version": 1})
+			version = doc_dict.get("version") if doc_dict != None else None
+			if version == None:
+				return None
+			self._child_versions[workflow_id] = version
+		return self.definition(version)
+
+	#Helper function to check that the workflows invoked by a definition are published with their
+	#   start states and never invoke this workflow again
+	def _check_invocations(self, document):
+		workflow_id = self._workflow_dm.get_id()
+		#Check against the versions the invoked workflows currently publish
+		self._child_versions = {}
+		invocations = set((state["invoke"]["workflow"], state["invoke"]["start"]) for state in document["states"] if state.get("invoke"))
+		stack = [(child, start, [workflow_id, child]) for child, start in sorted(invocations)]
+		visited = set()
+		while stack:
+			child, start, path = stack.pop()
+			if child == workflow_id:
+				raise ValueError("Invocation cycle: %s" % " -> ".join(str(step) for step in path))
+			definition = self._child_definition(child)
+			if definition == None:
+				raise ValueError("Invoked workflow %s has no published definition" % child)
+			if start not in definition.get_states():
+				raise ValueError("Invoked workflow %s has no start state %s" % (child, start))
+			if child in visited:
+				continue
+			visited.add(child)
+			invocations = set(definition.get_invocation(state_id) for state_id in definition.get_states()) - set([None])
+			for grandchild, grandchild_start in sorted(invocations):
+				stack.append((grandchild, grandchild_start, path + [grandchild]))
+
+	#Helper function to advance the tokens of an object in a parallel region
+	#   The tokens are evaluated as bitsets over the state _ids interned by the definition.
+	#   A token arriving at a join waits there until a token arrived from every incoming
+	#   state; the object leaves the region once a completed join holds its only token.
+	#   Triggers are shared by the branches and only cleared when the object leaves the region.
+	# @return string The state the object left the region to, or else the state the last advanced token entered (None if no token moved)
+	def _advance_tokens(self, it_object, definition):
+		triggers = set(it_object.get_triggers())
+		tokens = definition.token_mask(it_object.get_tokens())
+		arrived = definition.token_mask(it_object.get_arrived())
+		moved = None
+		for state_id in definition.token_states(tokens):
+			#Tokens waiting at a join do not advance
+			if definition.is_join(state_id) and arrived & definition.join_mask(state_id):
+				continue
+			end = self._resolve(definition, state_id, triggers, it_object)
+			if end == None:
+				continue
+			moved = end
+			if self._outbox_collection != None:
+				self._notify(it_object, state_id, end, definition, definition)
+			tokens &= ~definition.token_bit(state_id)
+			if definition.is_join(end):
+				#Timers of the join are armed once it fires
+				arrived |= definition.token_bit(state_id)
+				tokens |= definition.token_bit(end)
+				continue
+			entered = definition.fork_mask(end) if definition.is_fork(end) else definition.token_bit(end)
+			tokens |= entered
+			for token in definition.token_states(entered):
+				self._arm_timers(it_object, definition, token)
+
+		#Joins that a token arrived at from every incoming state fire
+		for state_id in definition.token_states(tokens):
+			if definition.is_join(state_id):
+				inputs = definition.join_mask(state_id)
+				if arrived & inputs == inputs:
+					arrived &= ~inputs
+					if tokens == definition.token_bit(state_id):
+						it_object.set_arrived(definition.token_states(arrived))
+						self._enter_state(it_object, definition, state_id)
+						return state_id
+					#A join nested in a larger region continues as a branch
+					self._arm_timers(it_object, definition, state_id)
+		it_object.set_tokens(definition.token_states(tokens))
+		it_object.set_arrived(definition.token_states(arrived))
+		return moved
+
+	## Get the objects holding a token in a state, such as the objects waiting at a join
+	#   This is an indexed lookup of the saved objects
+	# @param self The object pointer
+	# @param string The state _id
+	# @return list List of object _ids
+	@instrumented("objects_at")
+	def objects_at(self, state_id):
+		conn = self.db.connect(self._db_name)
+		object_collection = self._object_membership(conn)
+		return [document["_id"] for document in object_collection.find({"workflow_id": self._workflow_dm.get_id(), "tokens": state_id}, {"_id": 1})]
+
+	## Activate a batch of triggers
+	# @param self The object pointer
+	# @param list List of (object _id, trigger key) tuples
+	# @return list The result of trigger_activate for each event, in order
+	def trigger_activate_many(self, events):
+		return [self.trigger_activate(object_id, key) for object_id, key in events]
+
+	## Advance the objects whose guarded transitions hold after their fields changed
+	#   Guards are only evaluated when a trigger is activated, so objects whose fields
+	#   were changed directly are re-evaluated here in batches per state and definition
+	# @param self The object pointer
+	# @param string Only advance objects in this state (None for every state)
+	# @return dict The new state _id of each advanced object, keyed by object _id
+	@instrumented("advance")
+	def advance(self, state_id=None):
+		batches = {}
+		for object_id, it_object in self._objects.items():
+			current = it_object.get_current_state()
+			if current == None or (state_id != None and current != state_id):
+				continue
+			batches.setdefault((it_object.get_version(), current), []).append(it_object)
+		advanced = {}
+		for (version, current), objects in batches.items():
+			definition = self.definition(version)
+			if definition == None:
+				continue
+			#Objects in parallel regions advance token by token
+			for it_object in [it_object for it_object in objects if it_object.get_tokens()]:
+				end = self._advance_tokens(it_object, definition)
+				if end != None:
+					advanced[it_object.get_field("_id")] = end
+			objects = [it_object for it_object in objects if not it_object.get_tokens()]
+			ends = definition.next_states(current, [(set(it_object.get_triggers()), it_object._get) for it_object in objects], self._resolution)
+			for it_object, end in zip(objects, ends):
+				if end != None:
+					self._enter_state(it_object, definition, end)
+					advanced[it_object.get_field("_id")] = end
+		return advanced
+
+	## Queue a trigger event for processing by any worker
+	# @param self The object pointer
+	# @param ObjectId The _id of the object
+	# @param string The trigger key
+	def enqueue(self, object_id, key):
+		self.enqueue_many([(object_id, key)])
+
+	## Queue a batch of trigger events
+	# @param self The object pointer
+	# @param list List of (object _id, trigger key) tuples
+	def enqueue_many(self, events):
+		if not events:
+			return
+		now = datetime.utcnow()
+		documents = []
+		for object_id, key in events:
+			documents.append({"workflow": self._workflow_dm.get_id(), "object": object_id, "trigger": key, "created": now, "lease": None, "expires": None})
+		conn = self.db.connect(self._db_name)
+		conn[self._queue_collection].insert_many(documents, ordered=False)
 
+	## Claim a batch of pending trigger events
+	#   Events are leased to the caller until the lease expires; events whose lease
+	#   expired (the worker died) are claimable again.
+	#   Each event is claimed atomically, so of two workers racing for an event only one
+	#   wins it; the loser looks for the next claimable events, up to attempts times.
+	# @param self The object pointer
+	# @param int Maximum number of events to claim
+	# @param int Lease duration in seconds
+	# @param int Number of times to look for more events after losing races for them
+	# @return tuple The lease token and the list of claimed event documents; the token is None
+	#   if no event was claimable, while a worker that lost every race gets its token and no events
+	def claim(self, batch=100, lease=30, attempts=5):
+		conn = self.db.connect(self._db_name)
+		queue_collection = conn[self._queue_collection]
+		if not self._queue_indexed:
+			queue_collection.create_index([("workflow", 1), ("expires", 1)])
+			queue_collection.create_index("lease")
+			self._queue_indexed = True
+
+		now = datetime.utcnow()
+		token = None
+		claimed = 0
+		for attempt in range(attempts):
+			claimable = {"workflow": self._workflow_dm.get_id(), "$or": [{"expires": None}, {"expires": {"$lt": now}}]}
+			#Find candidates, then claim them with a single update; the filter is re-checked
+			#per document, so events another worker claimed meanwhile are left to it
+			candidates = [doc["_id"] for doc in queue_collection.find(claimable, {"_id": 1}).sort("created", 1).limit(batch - claimed)]
+			if not candidates:
+				break
+			if token == None:
+				token = uuid.uuid4().hex
+			claimable["_id"] = {"$in": candidates}
+			won = queue_collection.update_many(claimable, {"$set": {"lease": token, "expires": now + timedelta(seconds=lease)}}).modified_count
+			claimed = claimed + won
+			#Every candidate was won, or the batch is full
+			if won == len(candidates):
+				break
+		if token == None:
+			return None, []
+		return token, list(queue_collection.find({"lease": token}).sort("created", 1))
+
+	## Acknowledge processed events, removing them from the queue
+	#   Events whose lease expired and were claimed by another worker are left alone
+	# @param self The object pointer
+	# @param string The lease token returned by claim
+	# @param list The claimed event documents
+	def ack(self, token, events):
+		conn = self.db.connect(self._db_name)
+		conn[self._queue_collection].delete_many({"_id": {"$in": [event["_id"] for event in events]}, "lease": token})
+
+	## Claim, process and acknowledge one batch of queued trigger events
+	#   The objects are read fresh from MongoDB, advanced through the engine and written back.
+	#   An event that fails (such as one naming an object that does not exist) does not stop
+	#   the batch: it is dead-lettered, staying in the queue with an error field and never
+	#   claimed again. The objects are only written if no other process wrote them since
+	#   they were read; the events of an object that was changed meanwhile are released,
+	#   to be processed again on a fresh copy.
+	# @param self The object pointer
+	# @param int Maximum number of events to claim
+	# @param int Lease duration in seconds
+	# @return int The number of events processed (0 only when no event was claimable)
+	def process_queue(self, batch=100, lease=30):
+		#Losing the race for every event is not an empty queue, so claim again
+		token, events = self.claim(batch, lease)
+		while token != None and not events:
+			token, events = self.claim(batch, lease)
+		if not events:
+			return 0
+
+		object_ids = list(set(event["object"] for event in events))
+		self._load_objects(object_ids)
+
+		processed = []
+		failed = []
+		for event in events:
+			try:
+				self.trigger_activate(event["object"], event["trigger"])
+				processed.append(event)
+			except Exception as exception:
+				failed.append((event, exception))
+		conflicts = set(self._write_objects([_id for _id in object_ids if _id in self._objects], conditional=True))
+		if conflicts:
+			self._forget_objects(conflicts)
+			self._release(token, [event for event in events if event["object"] in conflicts])
+			processed = [event for event in processed if event["object"] not in conflicts]
+			failed = [(event, exception) for event, exception in failed if event["object"] not in conflicts]
+		self._save_timers()
+		self._save_calls()
+		self.ack(token, processed)
+		self._dead_letter(token, failed)
+		return len(events)
+
+	#Helper function to put claimed events back in the queue, claimable at once
+	def _release(self, token, events):
+		conn = self.db.connect(self._db_name)
+		conn[self._queue_collection].update_many({"_id": {"$in": [event["_id"] for event in events]}, "lease": token}, {"$set": {"lease": None, "expires": None}})
+
+	#Helper function to keep failed events in the queue with their error, out of reach of claim
+	def _dead_letter(self, token, failed):
+		if not failed:
+			return
+		requests = []
+		for event, exception in failed:
+			error = "%s: %s" % (type(exception).__name__, exception)
+			requests.append(UpdateOne({"_id": event["_id"], "lease": token}, {"$set": {"error": error, "lease": None, "expires": datetime.max}}))
+		conn = self.db.connect(self._db_name)
+		conn[self._queue_collection].bulk_write(requests, ordered=False)
+
+	#Helper function to read a set of objects fresh from MongoDB with a single query
+	@traced("_load_objects")
+	def _load_objects(self, object_ids, projection=None):
+		self._read_objects({"_id": {"$in": object_ids}}, projection)
+
+	#Helper function to read the objects of the workflow
+	@traced("_load_members")
+	def _load_members(self, projection=None, batch_size=1000):
+		self._read_objects({"workflow_id": self._workflow_dm.get_id()}, projection, batch_size)
+
+	#Helper function to read the objects matching a query into memory
+	#   Objects held with changes that are not written yet are kept, so reading never discards them
+	def _read_objects(self, query, projection, batch_size=1000):
+		fields = _projection_fields(projection if projection != None else self._projection)
+		conn = self.db.connect(self._db_name)
+		object_collection = conn[self._objects_collection].with_options(codec_options=RAW_CODEC_OPTIONS)
+		for doc_dict in object_collection.find(query, _projection_document(fields)).batch_size(batch_size):
+			it_object = self._decode_object(doc_dict, fields)
+			object_id = it_object.get_field("_id")
+			held = self._objects.get(object_id)
+			if held != None and self._unsaved(held):
+				continue
+			it_object._owner = self._write_behind
+			self._hold_object(object_id, it_object)
+
+	#Helper function to check if an object has changes that are not written yet
+	def _unsaved(self, it_object):
+		if self._write_behind != None:
+			return self._write_behind.holds(it_object)
+		return it_object._changed
+
+	#Helper function to get the objects collection, indexed on workflow membership
+	def _object_membership(self, conn):
+		object_collection = conn[self._objects_collection]
+		if not self._membership_indexed:
+			#Multikey index of the states holding the tokens of objects in parallel regions; its
+			#workflow_id prefix also serves the membership queries
+			object_collection.create_index([("workflow_id", 1), ("tokens", 1)])
+			self._membership_indexed = True
+		return object_collection
+
+	#Helper function to arm the timer triggers of the state an object (or one of its tokens) just entered
+	def _arm_timers(self, it_object, definition, state_id=None):
+		if self._timer_collection == None:
+			return
+		if state_id == None:
+			state_id = it_object.get_current_state()
+		timers = definition.get_timers(state_id)
+		if not timers:
+			return
+		now = datetime.utcnow()
+		mark = ObjectId()
+		it_object.set_entry(state_id, mark)
+		for key, seconds in timers:
+			self._pending_timers.append({"workflow": self._workflow_dm.get_id(), "object": it_object.get_field("_id"), "state": state_id, "entry": mark, "trigger": key, "due_at": now + timedelta(seconds=seconds)})
+
+	#Helper function to persist the timers armed since the last save
+	@traced("_save_timers")
+	def _save_timers(self):
+		if self._pending_timers:
+			conn = self.db.connect(self._db_name)
+			conn[self._timer_collection].insert_many(self._pending_timers, ordered=False)
+			self._pending_timers = []
+
+	#Helper function to write the hook calls recorded since the last save to the outbox,
+	#   and hand them over for delivery
+	@traced("_save_calls")
+	def _save_calls(self):
+		calls = self._call_documents()
+		if calls:
+			conn = self.db.connect(self._db_name)
+			conn[self._outbox_collection].insert_many(calls, ordered=False)
+			self._pending_calls = []
+			self._submit_calls(calls)
+
+	#Helper function to turn the hook calls recorded since the last save into outbox documents
+	def _call_documents(self):
+		if not self._pending_calls:
+			return []
+		now = datetime.utcnow()
+		workflow_id = self._workflow_dm.get_id()
+		calls = [{"_id": ObjectId(), "target": hook["target"], "concurrency": hook.get("concurrency", 1), "queued_at": now,
+			"event": {"event": hook["event"], "workflow": workflow_id, "object": object_id, "state": exited if hook["event"] == "exit" else entered, "from": exited, "to": entered, "at": datetime.utcfromtimestamp(at)}}
+			for hooks, object_id, exited, entered, at in self._pending_calls for hook in hooks]
+		return calls
+
+	#Helper function to hand saved hook calls over for delivery
+	#   Without a dispatcher they wait in the outbox for redeliver()
+	def _submit_calls(self, calls):
+		if calls and self._hooks != None:
+			self._hooks.submit(calls)
+
+	#Helper function to write a set of objects with a single bulk write
+	#   Partially loaded objects only set the fields they hold. Every write gives the object a
+	#   new revision; a conditional write only replaces the revision the object was read with,
+	#   so it does not overwrite changes another process wrote meanwhile.
+	# @return list The _ids of the objects not written because they changed meanwhile (conditional writes only)
+	@traced("_write_objects")
+	def _write_objects(self, object_ids, session=None, conditional=False):
+		requests = []
+		revisions = {}
+		for _id in object_ids:
+			it_object = self._objects[_id]
+			previous, revisions[_id] = it_object._revise()
+			query = {"_id": _id, "rev": previous} if conditional else {"_id": _id}
+			if it_object.is_partial():
+				requests.append(UpdateOne(query, it_object.to_update()))
+			else:
+				requests.append(ReplaceOne(query, it_object.to_dictionary()))
+		conflicts = []
+		if requests:
+			conn = self.db.connect(self._db_name)
+			object_collection = conn[self._objects_collection]
+			result = object_collection.bulk_write(requests, ordered=False, session=session)
+			if conditional and result.matched_count < len(requests):
+				#The objects holding another revision were changed meanwhile
+				current = dict((document["_id"], document.get("rev")) for document in object_collection.find({"_id": {"$in": list(object_ids)}}, {"rev": 1}, session=session))
+				conflicts = [_id for _id in object_ids if current.get(_id) != revisions[_id]]
+		#In a transaction the objects count as written once it commits
+		if session == None:
+			self._written([_id for _id in object_ids if _id not in conflicts])
+		return conflicts
+
+	#Helper function to drop objects from memory, with the timers they armed since the last save
+	#   Used for objects whose changes were not written, so they are read again when next needed
+	def _forget_objects(self, object_ids):
+		object_ids = set(object_ids)
+		for _id in object_ids:
+			it_object = self._objects.pop(_id, None)
+			if it_object != None and it_object._size != None:
+				self._object_bytes = self._object_bytes - it_object._size
+		self._pending_timers = [timer for timer in self._pending_timers if timer["object"] not in object_ids]
+		self._pending_calls = [call for call in self._pending_calls if call[1] not in object_ids]
+
+	#Helper function to record that objects were written
+	def _written(self, object_ids):
+		for _id in object_ids:
+			self._objects[_id]._changed = False
 
 	#Helper function to save states
+	@traced("_save_states")
 	def _save_states(self):
 		for _id, it_state in self._states.items():
 			#Temporary variable to hold dictinary representation
@@ -594,17 +3777,25 @@ class Cocopan:
 			state_collection.replace_one({"_id" : _id}, temp_dict)
 
 	#Helper function to save objects
+	@traced("_save_objects")
 	def _save_objects(self):
 		for _id, it_object in self._objects.items():
+			conn = self.db.connect(self._db_name)
+			object_collection = conn[self._objects_collection]
+			it_object._changed = False
+			it_object._revise()
+			#Only set the fields a partially loaded object holds
+			if it_object.is_partial():
+				object_collection.update_one({"_id" : _id}, it_object.to_update())
+				continue
 			#Temporary variable to hold dictinary representation
 			temp_dict = it_object.to_dictionary()
 			#Replace the document in mongo with the new object
-			conn = self.db.connect(self._db_name)
-			object_collection = conn[self._objects_collection]
 			object_collection.replace_one({"_id" : _id}, temp_dict)
 
 	#Helper function to save the workflow
-	def _save_workflow(self):
+	@traced("_save_workflow")
+	def _save_workflow(self, session=None):
 		#Temporary list to hold the _ids of the states associated with the workflow
 		temp_list = []
 		#Iterate and the _ids from each state in memory to the temp list
@@ -612,148 +3803,1668 @@ class Cocopan:
 			temp_list.append(_id)
 		#Set the workflow states to the temporary list (from in memory states)
 		self._workflow_dm.set_states(temp_list)
+		#Record which definition the saved states form, so load can read them from its file
+		self._workflow_dm.set_states_version(_states_version(self._states))
 
-		#Temporary list to hold the _ids of the objects associated with the workflow
-		temp_list = []
-		#Iterate and the _ids from each object in memory to the temp list
-		for _id, it_object in self._objects.items():
-			temp_list.append(_id)
-		#Set the workflow objects to the temporary list (from in memory objects)
-		self._workflow_dm.set_objects(temp_list)
+		#The objects hold their membership (workflow_id), so they are not listed here
 
 		#Replace the document in mongo with the new workflow
 		conn = self.db.connect(self._db_name)
 		workflow_collection = conn[self._workflow_collection]
-		workflow_collection.replace_one({"_id" : self._workflow_dm.get_id()}, self._workflow_dm.to_dictionary())
+		workflow_collection.replace_one({"_id" : self._workflow_dm.get_id()}, self._workflow_dm.to_dictionary(), session=session)
+
+	#Helper function to save in transactions of batch_size objects each
+	#   The states, the workflow document, the timers and the hook calls are written with
+	#   the last batch, so they never refer to objects that were not committed
+	@traced("_save_transactional")
+	def _save_transactional(self, batch_size):
+		object_ids = list(self._objects.keys())
+		batches = _pages(object_ids, batch_size) or [[]]
+		calls = self._call_documents()
+		session = self.db.start_session()
+		try:
+			for index, batch in enumerate(batches):
+				revisions = [(_id, self._objects[_id]._get("rev")) for _id in batch]
+				try:
+					#with_transaction retries the callback on transient errors
+					session.with_transaction(functools.partial(self._save_batch, batch, index == len(batches) - 1, calls))
+				except Exception:
+					#Nothing of the batch was written, so its objects keep the revision they were read with
+					#   and their changes (with the timers and hook calls) are saved again by the next save
+					for _id, previous in revisions:
+						self._objects[_id]._set_revision(previous)
+					raise
+				self._written(batch)
+		finally:
+			session.end_session()
+		self._pending_timers = []
+		self._pending_calls = []
+		self._submit_calls(calls)
+
+	#Helper function to write one batch of objects (and, with the last batch, everything else) in a transaction
+	def _save_batch(self, object_ids, last, calls, session):
+		self._write_objects(object_ids, session)
+		if not last:
+			return
+		conn = self.db.connect(self._db_name)
+		state_requests = [ReplaceOne({"_id": _id}, it_state.to_dictionary()) for _id, it_state in self._states.items()]
+		if state_requests:
+			conn[self._states_collection].bulk_write(state_requests, ordered=False, session=session)
+		self._save_workflow(session)
+		if self._pending_timers:
+			conn[self._timer_collection].insert_many(self._pending_timers, ordered=False, session=session)
+		if calls:
+			conn[self._outbox_collection].insert_many(calls, ordered=False, session=session)
+
+	## Count the objects in a state by how far each transition condition is satisfied
+	#   The counts are computed by MongoDB with an aggregation pipeline (or over the
+	#   stored trigger lists in memory), without loading the objects.
+	# @param self The object pointer
+	# @param string The _id of the state
+	# @return list One {"end", "condition", "histogram"} per condition of the state's transitions,
+	#   where histogram[n] is the number of objects that activated n of the condition's triggers
+	@instrumented("condition_stats")
+	def condition_stats(self, state_id):
+		conditions = []
+		ends = []
+		for end, trans in sorted(self.get_state(state_id).get_transitions().items(), key=lambda item: str(item[0])):
+			for condition in trans.get_conditions():
+				ends.append(end)
+				#Predicate expressions are not counted, as they depend on the object fields
+				conditions.append(_condition_triggers(condition))
+		if not conditions:
+			return []
+
+		query = {"workflow_id": self._workflow_dm.get_id(), "state": state_id}
+		conn = self.db.connect(self._db_name)
+		object_collection = conn[self._objects_collection]
+		histograms = []
+		facets = list(object_collection.aggregate(_condition_pipeline(query, conditions)))[0]
+		for index, condition in enumerate(conditions):
+			histogram = [0] * (len(set(condition)) + 1)
+			for bucket in facets["c%d" % index]:
+				histogram[bucket["_id"]] = bucket["objects"]
+			histograms.append(histogram)
+		return [{"end": end, "condition": condition, "histogram": histogram} for end, condition, histogram in zip(ends, conditions, histograms)]
+
+	## Get the _id of the workflow
+	# @param self The object pointer
+	# @return string The workflow identifier
+	def get_workflow_id(self):
+		return self._workflow_dm.get_id()
+
+	## Get the _ids of the states held in memory
+	# @param self The object pointer
+	# @return list List of state _ids
+	def get_state_ids(self):
+		return list(self._states.keys())
+
+	## Get the number of documents cached in memory by the workflow
+	# @param self The object pointer
+	# @return int Number of in memory states and objects
+	def cache_size(self):
+		return len(self._states) + len(self._objects)
+
+	## Get the approximate size in bytes of the objects cached in memory by the workflow
+	#   Each object is measured (its encoded BSON length) once, the first time it is counted
+	# @param self The object pointer
+	# @return int Size of the in memory objects in bytes
+	def object_bytes(self):
+		for it_object in self._unsized:
+			#Objects replaced before they were measured are not held anymore
+			if it_object._size == None and self._objects.get(it_object.get_field("_id")) is it_object:
+				self._object_bytes = self._object_bytes + it_object.get_size()
+		self._unsized = []
+		return self._object_bytes
+
+	#Helper function to hold an object in memory, keeping the size of the cached objects
+	def _hold_object(self, object_id, it_object):
+		previous = self._objects.get(object_id)
+		if previous != None and previous._size != None:
+			self._object_bytes = self._object_bytes - previous._size
+		self._objects[object_id] = it_object
+		self._unsized.append(it_object)
+
+	## Publish the in memory states as an immutable definition version
+	#   Publishing unchanged states is a no-op, as the version is the content hash.
+	#   Raises ValueError if an invoked workflow is unpublished or invokes this one again.
+	# @param self The object pointer
+	# @return Definition The compiled definition that was published
+	def publish(self):
+		#Snapshot the in memory states
+		document = definition_from_states(self._states)
+		version = document["_id"]
+		#Invoked workflows must be published and must not lead back to this workflow
+		self._check_invocations(document)
+
+		if version != self._workflow_dm.get_version():
+			conn = self.db.connect(self._db_name)
+			#Definitions are immutable, so an existing version never needs to be rewritten
+			if conn[self._definitions_collection].find_one({"_id": version}, {"_id": 1}) == None:
+				conn[self._definitions_collection].insert_one(document)
+			#Point the workflow at the new version
+			self._workflow_dm.set_version(version)
+			conn[self._workflow_collection].update_one({"_id": self._workflow_dm.get_id()}, {"$set": {"version": version}})
+
+		#Write the shared file before any process on the host refreshes to the new version
+		if self._definition_cache_dir != None and not os.path.exists(self._definition_path(version)):
+			write_definition_file(self._definition_path(version), document)
+
+		return compile_definition(document)
+
+	## Get a compiled workflow definition
+	#   Definitions are served from the process wide cache and only fetched from MongoDB on a miss
+	# @param self The object pointer
+	# @param string The definition version (defaults to the current version of the workflow)
+	# @return Definition The compiled definition (None if the version does not exist)
+	def definition(self, version=None):
+		if version == None:
+			version = self._workflow_dm.get_version()
+		if version == None:
+			return None
+		try:
+			return _definition_cache[version]
+		except KeyError:
+			if self._definition_cache_dir != None:
+				return self._shared_definition(version)
+			conn = self.db.connect(self._db_name)
+			document = conn[self._definitions_collection].find_one({"_id": version})
+			if document == None:
+				return None
+			return compile_definition(document)
+
+	#Helper function to get the path of the shared file of a definition version
+	def _definition_path(self, version):
+		return os.path.join(self._definition_cache_dir, "%s.definition" % version)
+
+	#Helper function to map a definition from the shared directory, writing its file on a miss
+	def _shared_definition(self, version):
+		path = self._definition_path(version)
+		if not os.path.exists(path):
+			conn = self.db.connect(self._db_name)
+			document = conn[self._definitions_collection].find_one({"_id": version})
+			if document == None:
+				return None
+			#Processes racing on a miss each write their own file and the last rename wins
+			write_definition_file(path, document)
+		return _definition_cache.setdefault(version, map_definition_file(path))
+
+	## Check the workflow for a newly published definition version
+	# @param self The object pointer
+	# @return bool True if the version changed since the last check
+	def refresh(self):
+		conn = self.db.connect(self._db_name)
+		doc_dict = conn[self._workflow_collection].find_one({"_id": self._workflow_dm.get_id()}, {"version": 1})
+		version = doc_dict.get("version") if doc_dict != None else None
+		#Invoked workflows are looked up again on their next invocation
+		self._child_versions = {}
+		if version == self._workflow_dm.get_version():
+			return False
+		self._workflow_dm.set_version(version)
+		#Warm the cache with the new version
+		self.definition(version)
+		return True
+
+	## Export a workflow (its document, states, objects and definitions) to a stream
+	#   Documents are read through cursors and written one record at a time, so memory
+	#   use does not grow with the number of states and objects
+	# @param self The object pointer
+	# @param string The workflow identifier
+	# @param file Binary stream to write to
+	# @param string The format ("ndjson" or "bson")
+	# @param bool Compress the stream with gzip
+	# @param int Number of documents read per query
+	# @return dict The number of documents exported per kind
+	def export(self, workflow_id, stream, format="ndjson", compress=False, batch_size=1000):
+		_export_format(format)
+		conn = self.db.connect(self._db_name)
+		workflow = conn[self._workflow_collection].find_one({"_id": workflow_id})
+		if workflow == None:
+			raise KeyError("Workflow %s does not exist" % workflow_id)
+		output = gzip.GzipFile(fileobj=stream, mode="wb") if compress else stream
+		counts = {"workflow": 1, "state": 0, "object": 0, "definition": 0}
+		#Definition versions the workflow and its objects run under
+		versions = set([workflow.get("version")])
+		try:
+			_write_record(output, format, "workflow", workflow)
+			#Objects of a workflow saved with the object _ids embedded are read by _id
+			legacy = workflow.get("objects") or []
+			queries = [("state", self._states_collection, {"_id": {"$in": ids}}) for ids in _pages(workflow.get("states", []), batch_size)]
+			queries += [("object", self._objects_collection, {"_id": {"$in": ids}}) for ids in _pages(legacy, batch_size)]
+			queries.append(("object", self._objects_collection, {"workflow_id": workflow_id}))
+			exported = set(legacy)
+			for kind, collection, query in queries:
+				collection = conn[collection]
+				#BSON records embed the documents as read, without decoding them
+				if format == "bson":
+					collection = collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+				for document in collection.find(query).batch_size(batch_size):
+					if kind == "object":
+						it_object = decode_object(document)
+						#Skip members already exported from the embedded _ids
+						if exported and "workflow_id" in query and it_object.get_field("_id") in exported:
+							continue
+						versions.add(it_object.get_version())
+					_write_record(output, format, kind, document)
+					counts[kind] = counts[kind] + 1
+			versions.discard(None)
+			if versions and self._definitions_collection != None:
+				for document in conn[self._definitions_collection].find({"_id": {"$in": list(versions)}}):
+					_write_record(output, format, "definition", document)
+					counts["definition"] = counts["definition"] + 1
+		finally:
+			if compress:
+				output.close()
+		return counts
+
+	## Import a workflow exported with export()
+	#   States and objects are written with bulk inserts of batch_size documents; the
+	#   workflow document is written last, so the workflow only appears once complete.
+	#   The target database must not hold the workflow's states or objects yet.
+	# @param self The object pointer
+	# @param file Binary stream to read from
+	# @param string The format ("ndjson" or "bson")
+	# @param bool The stream is compressed with gzip
+	# @param int Number of documents inserted per bulk insert
+	# @return string The identifier of the imported workflow
+	def import_(self, stream, format="ndjson", compress=False, batch_size=1000):
+		_export_format(format)
+		source = gzip.GzipFile(fileobj=stream, mode="rb") if compress else stream
+		conn = self.db.connect(self._db_name)
+		collections = {"state": conn[self._states_collection], "object": conn[self._objects_collection]}
+		pending = {"state": [], "object": []}
+		workflow = None
+		for kind, document in _read_records(source, format):
+			if kind == "workflow":
+				workflow = document
+				continue
+			#Definitions are immutable, so one already present is identical
+			if kind == "definition":
+				conn[self._definitions_collection].replace_one({"_id": document["_id"]}, document, upsert=True)
+				continue
+			batch = pending[kind]
+			batch.append(document)
+			if len(batch) >= batch_size:
+				collections[kind].insert_many(batch, ordered=False)
+				del batch[:]
+		for kind, batch in pending.items():
+			if batch:
+				collections[kind].insert_many(batch, ordered=False)
+		if workflow == None:
+			raise ValueError("The stream holds no workflow document")
+		conn[self._workflow_collection].replace_one({"_id": workflow["_id"]}, workflow, upsert=True)
+		return workflow["_id"]
+
+	## Switch to write-behind persistence
+	#   Changed objects are written in the background; call flush() on the returned
+	#   buffer for a durability point and close() to go back to explicit saves
+	# @param self The object pointer
+	# @param int Number of pending objects that triggers a write
+	# @param float Seconds a change may wait before it is written
+	# @param int Number of pending objects at which changes block until written
+	# @return WriteBehind The started write-behind buffer
+	def write_behind(self, flush_size=1000, interval=1.0, max_pending=100000):
+		if self._write_behind != None:
+			raise ValueError("Write-behind is already enabled")
+		self._write_behind = WriteBehind(self, flush_size, interval, max_pending)
+		for it_object in self._objects.values():
+			it_object._owner = self._write_behind
+		self._write_behind.start()
+		return self._write_behind
+
+	## Dispatch the hooks of the states objects enter and leave
+	#   Hook calls are recorded as objects advance, written to the outbox collection by
+	#   save() and delivered from there by a separate process (see HookDispatcher).
+	#   Raises ValueError if no outbox collection is set.
+	# @param self The object pointer
+	# @param int Number of threads delivering calls
+	# @param int Number of calls being delivered beyond which saved calls wait in the outbox
+	# @param int Number of retries of a failed call
+	# @param float Seconds before the first retry (doubled for every further retry)
+	# @param float Seconds to wait for a hook target to respond
+	# @param int Niceness of the delivery process (0 to run it at the priority of the engine)
+	# @return HookDispatcher The dispatcher (close() it to stop dispatching)
+	def hooks(self, workers=4, queue_size=10000, retries=3, backoff=0.5, timeout=5.0, niceness=10):
+		if self._hooks != None:
+			raise ValueError("Hooks are already dispatched")
+		if self._outbox_collection == None:
+			raise ValueError("Hooks need an outbox collection (set_outbox_collection)")
+		self._hooks = HookDispatcher(self, workers, queue_size, retries, backoff, timeout, niceness)
+		self._hooks.start()
+		return self._hooks
+
+	#Helper function called when a hook dispatcher is closed
+	def _detach_hooks(self, dispatcher):
+		if self._hooks is dispatcher:
+			self._hooks = None
+
+	#Helper function called when a write-behind buffer is closed
+	def _detach_write_behind(self, buffer):
+		if self._write_behind is buffer:
+			self._write_behind = None
+			for it_object in self._objects.values():
+				it_object._owner = None
 
 	## Persist changes to Mongo
+	#   In transactional mode the objects are written in transactions of batch_size
+	#   objects (amortizing the commit cost), the last one also holding the states,
+	#   the workflow document and the armed timers. It needs MongoDB sessions, so a
+	#   replica set (a single node one is enough) or a sharded cluster.
 	# @param self The object pointer
-	def save(self):
+	# @param bool Write in transactions
+	# @param int Number of objects per transaction
+	@instrumented("save")
+	def save(self, transactional=False, batch_size=1000):
+		#Write everything in transactions (on a replica set) instead of step by step
+		if transactional:
+			self._save_transactional(batch_size)
+			return
 		#Save the states
 		self._save_states()
 		#Save the objects
 		self._save_objects()
 		#Save the workflow
 		self._save_workflow()
+		#Save the armed timers
+		self._save_timers()
+		#Save the hook calls to the outbox and hand them over for delivery
+		self._save_calls()
 
 	## Visualize the workflow using Graphviz
 	# @param self The object pointer
+	# @param dict Options passed to graph()
 	# @return None
-	def visualize_it(self): #I'll give you somethin' to do
-		f = Digraph('finite_state_machine', filename='fsm.gv')
-		f.body.extend(['rankdir=LR', 'size="8,5"'])
-		f.attr('node', shape='circle')
-		#Iterate through each state
-		for key, state in self._states.items():
-			#Create a node for each state
-			f.node(str(state.get_state_id()), label=state.get_field("description"))
-			
-			#Iterate over each transition in the state
-			if state != None:
-				for key, trans in state.get_transitions().items():
-					if trans != None:
-						print trans.get_end()
-						for condition in trans.get_conditions():
-							f.edge(str(state.get_state_id()), str(trans.to_dictionary()["end"]), label=str(condition))
-		f.view()
-
-
-
-workflow = Cocopan()
-workflow.set_db_name("test10")
-workflow.set_state_collection("states")
-workflow.set_object_collection("objects")
-workflow.set_workflow_collection("workflowss")
-if workflow.load("test_test8"):
-	#workflow.get_state("m1").remove_transition("m2")
-	workflow.get_state("m1").transition("m2").condition_remove(1)
-	workflow.get_state("m1").transition("m2").condition_remove(0)
-	workflow.visualize_it()
-	#workflow.save()
-else:
-	#M1 state
-	state1 = workflow.new_state("m1")
-	state1.set_name("M1")
-	#M2 state
-	state2 = workflow.new_state("m2")
-	state2.set_name("M2")
-	#M3 state
-	state3 = workflow.new_state("m3")
-	state3.set_name("M3")
-	#M4 state
-	state4 = workflow.new_state("m4")
-	state4.set_name("M4")
-	#M5 state
-	state5 = workflow.new_state("m5")
-	state5.set_name("M5")
-
-	workflow.new_object(state1)
-
-	#Create a new transition from state1 to state 2
-	state1.add_transition(state2)
-
-	state1.transition(state2).trigger_add("signature_advisor")
-	state1.transition(state2).trigger_add("signature_dean")
-
-	state1.transition(state2).condition_add(["signature_advisor", "signature_dean"])
-
-	#Create a new transition from state 2 to state 3
-	state2.add_transition(state3)
-
-	state2.transition(state3).trigger_add("test_completed")
-	state2.transition(state3).trigger_add("test_grade_accepted")
-	state2.transition(state3).condition_add(["test_completed", "test_grade_accepted"])
-
-	state2.transition(state3).trigger_add("test_exmempted")
-	state2.transition(state3).condition_add(["test_exempted"])
-
-	#Create a new fork transition from 3 to 4 or 5
-	state3.add_transition(state4)
-	state3.add_transition(state5)
-
-	state3.transition(state4).trigger_add("assessment_soft_skills_complete")
-	state3.transition(state4).trigger_add("advisor_signature")
-	state3.transition(state4).trigger_add("system_override")
-	state3.transition(state4).condition_add(["assessment_soft_skills_complete", "assessment_soft_skills_complete"])
-	state3.transition(state4).condition_add(["system_override"])
-
-	state3.transition(state5).trigger_add("career_change_decision")
-	state3.transition(state5).trigger_add("advisor_signature")
-	state3.transition(state5).trigger_add("dean_signature")
-	state3.transition(state5).trigger_add("system_override")
-	state3.transition(state5).condition_add(["career_change_decision", "advisor_signature", "dean_signature"])
-	state3.transition(state5).condition_add(["system_override"])
-
-
-
-	#Should the student move on?
-	print state1.transition(state2).isActivated()
-
-	#Create a new object in the workflow
-	#workflow.new_object(state1.get_state_id())
-
-	workflow.save()
-
-
-
+	def visualize_it(self, **options): #I'll give you somethin' to do
+		self.graph(**options).view()
 
+	## Render the graph of the workflow without opening a viewer
+	# @param self The object pointer
+	# @param string|file Path of the file to write, or a file-like object to write to
+	# @param string The output format ("dot" writes the DOT source without running Graphviz)
+	# @param dict Options passed to graph()
+	def render(self, target, format="svg", **options):
+		graph = self.graph(**options)
+		if format in ("dot", "gv"):
+			data = graph.source.encode("utf-8")
+		else:
+			data = graph.pipe(format=format)
+		if hasattr(target, "write"):
+			target.write(data)
+		else:
+			with open(target, "wb") as output:
+				output.write(data)
 
+	## Build the Graphviz graph of the workflow
+	#   The DOT fragments of each state are cached and rebuilt only when the state's
+	#   revision changes, so redrawing a large workflow after a few edits is cheap.
+	# @param self The object pointer
+	# @param string Only draw the states within hops of this state (None for every state)
+	# @param int Number of hops (in either direction) from the center state
+	# @param bool Draw one edge per transition, labelled with all its conditions
+	# @param bool Shade each state by the number of objects in it
+	# @return Digraph The graph of the states and transitions
+	def graph(self, center=None, hops=1, collapse=False, heat=False):
+		fragments = {}
+		for state_id, state in self._states.items():
+			fragments[state_id] = self._graph_fragment(state, collapse)
+		#Forget the states that were removed
+		if len(self._graph_cache) > 2 * len(fragments):
+			for key in [key for key in self._graph_cache if key[0] not in fragments]:
+				del self._graph_cache[key]
+
+		included = set(fragments)
+		if center != None:
+			included = self._graph_neighborhood(fragments, center, hops)
+
+		counts = {}
+		if heat:
+			for it_object in self._objects.values():
+				state_id = it_object.get_current_state()
+				counts[state_id] = counts.get(state_id, 0) + 1
+		busiest = max(counts.values()) if counts else 0
 
+		f = Digraph('finite_state_machine', filename='fsm.gv')
+		f.body.extend(['rankdir=LR', 'size="8,5"'])
+		f.attr('node', shape='circle')
+		for state_id, fragment in fragments.items():
+			if state_id not in included:
+				continue
+			if heat:
+				count = counts.get(state_id, 0)
+				label = "%s\\n%d" % (self._states[state_id].get_name() or state_id, count)
+				#Shade from the lightest to the darkest red of the colour scheme
+				level = 1 + (8 * count) // busiest if busiest else 1
+				f.node(str(state_id), label=label, style="filled", colorscheme="reds9", fillcolor=str(level))
+			else:
+				f.body.append(fragment[2])
+			for end, line in fragment[3]:
+				if end in included:
+					f.body.append(line)
+		return f
+
+	#Helper function to get the cached DOT fragment of a state, rebuilding it if the state changed
+	#   A fragment is (state, revision, node line, [(end state _id, edge line)])
+	def _graph_fragment(self, state, collapse):
+		key = (state.get_state_id(), collapse)
+		fragment = self._graph_cache.get(key)
+		if fragment != None and fragment[0] is state and fragment[1] == state.get_revision():
+			return fragment
+
+		scratch = Digraph()
+		scratch.node(str(state.get_state_id()), label=state.get_name())
+		edges = []
+		for end, trans in state.get_transitions().items():
+			if trans == None:
+				continue
+			conditions = [str(condition) for condition in trans.get_conditions()]
+			if collapse:
+				conditions = [" | ".join(conditions)] if conditions else []
+			for condition in conditions:
+				scratch.edge(str(state.get_state_id()), str(trans.get_end()), label=condition)
+				edges.append((trans.get_end(), scratch.body[-1]))
+		fragment = (state, state.get_revision(), scratch.body[0], edges)
+		self._graph_cache[key] = fragment
+		return fragment
+
+	#Helper function to get the states within hops of a state, following transitions either way
+	def _graph_neighborhood(self, fragments, center, hops):
+		neighbors = {}
+		for state_id, fragment in fragments.items():
+			for end, line in fragment[3]:
+				neighbors.setdefault(state_id, set()).add(end)
+				neighbors.setdefault(end, set()).add(state_id)
+		included = set([center])
+		frontier = included
+		for hop in range(hops):
+			frontier = set(near for state_id in frontier for near in neighbors.get(state_id, ())) - included
+			included |= frontier
+		return included
+
+
+
+## Registry hosting many workflows in one process
+#   Every hosted workflow shares the registry's database interface (and so its
+#   connection pool) and the pool of loaded states, while keeping its own in memory
+#   states and objects. The least recently used workflows are saved and released
+#   whenever the cached documents of all workflows exceed the memory budget, their
+#   approximate size in bytes (the encoded BSON length of each document).
+class Registry:
+
+	## MongoDB database instance shared by the hosted workflows
+	db = None
 
+	## Class constructor
+	# @param self The object pointer
+	# @param string MongoDB connection parameters
+	# @param int Maximum approximate size in bytes of the documents cached across all workflows (None for unbounded)
+	def __init__(self, connection=None, memory_budget=None):
+		self.db = Database(connection)
+		self._memory_budget = memory_budget
+		#Hosted workflows in least recently used order
+		self._workflows = OrderedDict()
+		#States shared between the hosted workflows (released with the last workflow using them)
+		self._state_pool = weakref.WeakValueDictionary()
+		#Collection configuration applied to every hosted workflow
+		self._db_name = None
+		self._collections = {}
+		self._projection = Cocopan._projection
+		self._definition_cache_dir = Cocopan._definition_cache_dir
+		self._resolution = Cocopan._resolution
 
+	## Set the MongoDB database name
+	# @param string MongoDB database name
+	def set_db_name(self, database):
+		self._db_name = database
 
+	## Set the MongoDB collection that holds the states
+	# @param string Collection name that holds the states
+	def set_state_collection(self, collection):
+		self._collections["state"] = collection
 
+	## Set the MongoDB collection that holds the objects
+	# @param string Collection name that holds the objects
+	def set_object_collection(self, collection):
+		self._collections["object"] = collection
 
+	## Set the MongoDB collection that holds the workflow documents
+	# @param string Collection name that holds the workflows
+	def set_workflow_collection(self, collection):
+		self._collections["workflow"] = collection
+
+	## Set the MongoDB collection that holds the published workflow definitions
+	# @param string Collection name that holds the definitions
+	def set_definition_collection(self, collection):
+		self._collections["definition"] = collection
+
+	## Set the MongoDB collection that holds the pending trigger events
+	# @param string Collection name that holds the queue
+	def set_queue_collection(self, collection):
+		self._collections["queue"] = collection
+
+	## Set the MongoDB collection that holds the armed timer triggers
+	# @param string Collection name that holds the timers
+	def set_timer_collection(self, collection):
+		self._collections["timer"] = collection
+
+	## Set the MongoDB collection that holds the hook calls until they are delivered
+	# @param string Collection name that holds the outbox
+	def set_outbox_collection(self, collection):
+		self._collections["outbox"] = collection
+
+	## Set the projection profile the hosted workflows load objects with
+	# @param string|list The projection profile ("engine", "full" or a list of fields)
+	def set_projection(self, profile):
+		_projection_fields(profile)
+		self._projection = profile
+
+	## Set the directory of the definition files shared by the processes of a host
+	# @param string Path of the directory (None to disable)
+	def set_definition_cache(self, directory):
+		if directory != None and not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._definition_cache_dir = directory
+
+	## Set the policy the hosted workflows resolve simultaneously activated transitions with
+	# @param string The resolution policy (see RESOLUTION_POLICIES)
+	def set_resolution(self, policy):
+		self._resolution = _resolution_policy(policy)
+
+	## Get a hosted workflow, loading it on first use
+	# @param self The object pointer
+	# @param string The workflow identifier
+	# @return Cocopan The workflow engine instance for the workflow
+	def workflow(self, workflow_id):
+		try:
+			engine = self._workflows.pop(workflow_id)
+		except KeyError:
+			engine = Cocopan(database=self.db, state_pool=self._state_pool)
+			engine.set_db_name(self._db_name)
+			for kind, collection in self._collections.items():
+				getattr(engine, "set_%s_collection" % kind)(collection)
+			engine.set_projection(self._projection)
+			engine.set_definition_cache(self._definition_cache_dir)
+			engine.set_resolution(self._resolution)
+			engine.load(workflow_id)
+		#Mark the workflow as the most recently used
+		self._workflows[workflow_id] = engine
+		self._enforce_budget()
+		return engine
+
+	## Get the identifiers of the hosted workflows
+	# @param self The object pointer
+	# @return list Workflow identifiers, least recently used first
+	def get_workflows(self):
+		return list(self._workflows.keys())
 
+	## Save and stop hosting a workflow
+	# @param self The object pointer
+	# @param string The workflow identifier
+	def release(self, workflow_id):
+		engine = self._workflows.pop(workflow_id, None)
+		if engine != None:
+			engine.save()
 
+	## Save every hosted workflow
+	# @param self The object pointer
+	def save(self):
+		for workflow_id, engine in self._workflows.items():
+			engine.save()
 
+	## Get the number of documents cached by all hosted workflows
+	#   States shared between workflows are only counted once
+	# @param self The object pointer
+	# @return int Number of cached documents
+	def cache_size(self):
+		state_ids = set()
+		size = 0
+		for workflow_id, engine in self._workflows.items():
+			engine_state_ids = engine.get_state_ids()
+			size = size + engine.cache_size() - len(engine_state_ids)
+			state_ids.update(engine_state_ids)
+		return size + len(state_ids)
+
+	## Get the approximate size in bytes of the documents cached by all hosted workflows
+	#   States shared between workflows are only counted once
+	# @param self The object pointer
+	# @return int Size of the cached documents in bytes (their encoded BSON length)
+	def cache_bytes(self):
+		states = {}
+		size = 0
+		for workflow_id, engine in self._workflows.items():
+			size = size + engine.object_bytes()
+			for state_id in engine.get_state_ids():
+				states[state_id] = engine.get_state(state_id)
+		return size + sum(state.get_size() for state in states.values())
+
+	#Helper function to release workflows until the memory budget is met
+	def _enforce_budget(self):
+		if self._memory_budget == None:
+			return
+		#Never release the most recently used workflow
+		while len(self._workflows) > 1 and self.cache_bytes() > self._memory_budget:
+			workflow_id = next(iter(self._workflows))
+			self.release(workflow_id)
+
+
+## Scheduler firing the timer triggers of a workflow
+#   Only the timers due within the next window are read (through the due_at index)
+#   and kept in a heap; due timers are fired in batches. A timer is ignored if its
+#   object already left the state the timer was armed in.
+class Scheduler:
 
+	## Class constructor
+	# @param self The object pointer
+	# @param Cocopan The workflow engine
+	# @param int Number of seconds ahead of now to load timers for
+	# @param int Maximum number of timers loaded and fired at once
+	# @param int Number of times a timer whose trigger fails is re-armed before it is dead-lettered
+	# @param float Seconds before the first retry of a failed timer, doubled on every further retry
+	def __init__(self, engine, window=60, batch=1000, retries=3, backoff=5.0):
+		self._engine = engine
+		self._window = window
+		self._batch = batch
+		self._retries = retries
+		self._backoff = backoff
+		#Heap of (due_at, timer _id, timer document)
+		self._heap = []
+		#The _ids of the timers in the heap
+		self._queued = set()
+		#When the heap has to be refilled from MongoDB
+		self._next_refill = None
+		self._indexed = False
+
+	#Helper function to get the timers collection
+	def _collection(self):
+		engine = self._engine
+		return engine.db.connect(engine._db_name)[engine._timer_collection]
+
+	#Helper function to load the timers due within the window
+	def _refill(self, now):
+		timer_collection = self._collection()
+		if not self._indexed:
+			timer_collection.create_index([("workflow", 1), ("due_at", 1)])
+			self._indexed = True
+		horizon = now + timedelta(seconds=self._window)
+		cursor = timer_collection.find({"workflow": self._engine.get_workflow_id(), "due_at": {"$lte": horizon}}).sort("due_at", 1).limit(self._batch)
+		loaded = 0
+		for timer in cursor:
+			loaded = loaded + 1
+			if timer["_id"] not in self._queued:
+				self._queued.add(timer["_id"])
+				heapq.heappush(self._heap, (timer["due_at"], timer["_id"], timer))
+		#A full batch means more timers are waiting within the window
+		if loaded == self._batch:
+			self._next_refill = now
+		else:
+			self._next_refill = now + timedelta(seconds=self._window / 2.0)
 
+	## Fire the timers that are due
+	#   Each timer is fired on its own: a trigger that fails (such as one raising a
+	#   ConflictError) leaves the other timers of the batch alone. The failed timer is
+	#   re-armed with exponential backoff, and once its retries are used up it is
+	#   dead-lettered, staying in the timer collection with an error field and never due.
+	# @param self The object pointer
+	# @param datetime The current time (defaults to now)
+	# @return int The number of timers fired
+	def run_pending(self, now=None):
+		if now == None:
+			now = datetime.utcnow()
+		if self._next_refill == None or now >= self._next_refill:
+			self._refill(now)
+
+		due = []
+		while self._heap and self._heap[0][0] <= now and len(due) < self._batch:
+			due.append(heapq.heappop(self._heap)[2])
+			self._queued.discard(due[-1]["_id"])
+		if not due:
+			return 0
+
+		engine = self._engine
+		object_ids = list(set(timer["object"] for timer in due))
+		engine._load_objects(object_ids)
+		requests = []
+		#The timers with a request in requests
+		handled = []
+		#The objects a trigger was activated on; a failed trigger stays recorded, as with trigger_activate
+		touched = set()
+		for timer in due:
+			it_object = engine.get_object(timer["object"])
+			#Skip timers armed in a state the object (and its tokens) has since left, even if it
+			#entered the state again (the entry marks then differ)
+			if it_object != None and (it_object.get_current_state() == timer["state"] or timer["state"] in it_object.get_tokens()) and it_object.get_entry(timer["state"]) == timer.get("entry"):
+				touched.add(timer["object"])
+				try:
+					engine.trigger_activate(timer["object"], timer["trigger"])
+				except Exception as exception:
+					requests.append(self._retry(timer, exception, now))
+					handled.append(timer)
+					continue
+			requests.append(DeleteOne({"_id": timer["_id"]}))
+			handled.append(timer)
+		conflicts = set(engine._write_objects(list(touched), conditional=True))
+		if conflicts:
+			#Another process changed the objects meanwhile: their timers stay in place and are
+			#fired again on fresh copies, with the next refill
+			engine._forget_objects(conflicts)
+			requests = [request for timer, request in zip(handled, requests) if timer["object"] not in conflicts]
+			self._next_refill = now
+		engine._save_timers()
+		engine._save_calls()
+		if requests:
+			self._collection().bulk_write(requests, ordered=False)
+		return len(due)
+
+	#Helper function to re-arm a failed timer with backoff, or dead-letter it once its retries are used up
+	def _retry(self, timer, exception, now):
+		attempts = timer.get("attempts", 0) + 1
+		error = "%s: %s" % (type(exception).__name__, exception)
+		if attempts > self._retries:
+			due_at = datetime.max
+		else:
+			due_at = now + timedelta(seconds=self._backoff * 2 ** (attempts - 1))
+		return UpdateOne({"_id": timer["_id"]}, {"$set": {"attempts": attempts, "error": error, "due_at": due_at}})
 
+	## Fire timers until stopped
+	# @param self The object pointer
+	# @param threading.Event Event that stops the scheduler when set (None to run forever)
+	# @param float Maximum number of seconds to sleep between checks
+	def run(self, stop=None, interval=1.0):
+		while stop == None or not stop.is_set():
+			#Keep firing while full batches are due
+			if self.run_pending() == self._batch:
+				continue
+			delay = interval
+			if self._heap:
+				until_due = self._heap[0][0] - datetime.utcnow()
+				delay = max(0, min(interval, until_due.days * 86400 + until_due.seconds + until_due.microseconds / 1e6))
+			time.sleep(delay)
+
+
+## Get the shard that owns an object
+#   The hash must be stable across processes, so the builtin hash() is not used
+# @param ObjectId The _id of the object
+# @param int The number of shards
+# @return int The index of the owning shard
+def shard_of(object_id, shards):
+	return (zlib.crc32(str(object_id).encode("utf-8")) & 0xffffffff) % shards
+
+#Helper function to get the key a shard worker holds an object under
+#   ObjectIds are sent as their 12 bytes, which pickle several times faster
+def _shard_key(object_id):
+	if isinstance(object_id, ObjectId):
+		return object_id.binary
+	return object_id
+
+## Main loop of a shard worker process
+#   The worker holds its shard of object state as shard key => [state, set of triggers, version]
+#   and the compiled definitions the objects are pinned to. Events arrive as a list of
+#   shard keys and the list of their trigger keys.
+#   Events that fail are answered with their error, so one bad event neither stops the
+#   batch nor the worker
+# @param Connection The pipe to the coordinator
+def _shard_worker(pipe):
+	definitions = {}
+	objects = {}
+	resolution = "priority"
+	while True:
+		message = pipe.recv()
+		command = message[0]
+		if command == "events":
+			results = []
+			errors = []
+			object_keys, trigger_keys = message[1]
+			for position, (object_id, key) in enumerate(zip(object_keys, trigger_keys)):
+				try:
+					record = objects[object_id]
+					record[1].add(key)
+					if resolution == "error":
+						next_state = definitions[record[2]].next_state_strict(record[0], record[1])
+					else:
+						next_state = definitions[record[2]].next_state(record[0], record[1])
+				except Exception as exception:
+					results.append(None)
+					errors.append((position, _picklable(exception)))
+					continue
+				if next_state != None:
+					record[0] = next_state
+					record[1] = set()
+				results.append(next_state)
+			pipe.send((results, errors))
+		elif command == "definition":
+			definitions[message[1]["_id"]] = compile_definition(message[1])
+		elif command == "resolution":
+			resolution = message[1]
+		elif command == "objects":
+			for object_id, state, triggers, version in message[1]:
+				objects[object_id] = [state, set(triggers), version]
+		elif command == "collect":
+			pipe.send([(object_id, record[0], list(record[1])) for object_id, record in objects.items()])
+		elif command == "stop":
+			pipe.close()
+			return
+
+#Helper function to get an exception that can be sent over a pipe
+def _picklable(exception):
+	try:
+		pickle.loads(pickle.dumps(exception))
+		return exception
+	except Exception:
+		return RuntimeError("%s: %s" % (type(exception).__name__, exception))
+
+## Pool of worker processes advancing the objects of a workflow
+#   Objects are partitioned across the workers by a hash of their _id. The pool has
+#   the same trigger API as Cocopan; call sync() to copy the shard state back into
+#   the engine before saving it. Routing events to their shards costs the coordinator
+#   more than the workers spend advancing them, so producers that can route events
+#   ahead of time (route()) hand them over with trigger_activate_sharded(). Workers only evaluate trigger conditions (with the
+#   engine's priorities and resolution policy), so start() refuses definitions with
+#   guards, parallel regions, sub-workflows, hooks or timers.
+class ShardPool:
 
+	## Class constructor
+	# @param self The object pointer
+	# @param Cocopan The workflow engine holding the objects
+	# @param int The number of worker processes (defaults to the number of cores)
+	def __init__(self, engine, processes=None):
+		self._engine = engine
+		self._processes = processes if processes != None else multiprocessing.cpu_count()
+		self._pipes = []
+		self._workers = []
+		#The _ids of the objects by their shard key
+		self._ids = {}
+
+	## Start the workers and hand each its shard of objects
+	#   Objects created before the workflow was published run under its current version.
+	#   Raises ValueError if the workflow is not published or the objects need features
+	#   the workers do not evaluate.
+	# @param self The object pointer
+	def start(self):
+		shards = [[] for index in range(self._processes)]
+		versions = set()
+		current = self._engine._workflow_dm.get_version()
+		for object_id in self._engine.get_object_ids():
+			it_object = self._engine.get_object(object_id)
+			version = it_object.get_version() if it_object.get_version() != None else current
+			if version == None:
+				raise ValueError("Workflow %s is not published" % self._engine.get_workflow_id())
+			if it_object.get_tokens() or it_object.get_calls():
+				raise ValueError("Object %s is in a parallel region or sub-workflow, which shard workers do not evaluate" % object_id)
+			versions.add(version)
+			key = _shard_key(object_id)
+			self._ids[key] = object_id
+			shards[shard_of(object_id, self._processes)].append((key, it_object.get_current_state(), it_object.get_triggers(), version))
+
+		definitions = []
+		for version in versions:
+			definition = self._engine.definition(version)
+			if definition == None:
+				raise ValueError("Definition %s does not exist" % version)
+			features = definition.get_features()
+			if features:
+				raise ValueError("Definition %s uses %s, which shard workers do not evaluate (use Cocopan.trigger_activate)" % (version, ", ".join(sorted(features))))
+			definitions.append(definition.to_dictionary())
+
+		for shard in shards:
+			pipe, worker_pipe = multiprocessing.Pipe()
+			worker = multiprocessing.Process(target=_shard_worker, args=(worker_pipe,))
+			worker.daemon = True
+			worker.start()
+			#Every worker holds the compiled transition tables
+			for document in definitions:
+				pipe.send(("definition", document))
+			pipe.send(("resolution", self._engine._resolution))
+			pipe.send(("objects", shard))
+			self._pipes.append(pipe)
+			self._workers.append(worker)
+
+	## Activate a trigger for an object and advance it if a transition activates
+	# @param self The object pointer
+	# @param ObjectId The _id of the object
+	# @param string The trigger key
+	# @return string The _id of the state the object moved to (None if it did not move)
+	def trigger_activate(self, object_id, key):
+		return self.trigger_activate_many([(object_id, key)])[0]
 
+	## Activate a batch of triggers on the owning shards in parallel
+	#   Every event is processed; the error of the first failed event (such as a KeyError
+	#   for an unknown object) is then raised
+	# @param self The object pointer
+	# @param list List of (object _id, trigger key) tuples
+	# @return list The result of trigger_activate for each event, in order
+	def trigger_activate_many(self, events):
+		batches, positions = self._route(events)
+		shard_results, errors = self._activate(batches)
+		if errors:
+			position, error = min((positions[shard][index], error) for shard, index, error in errors)
+			#Name an unknown object by its _id rather than by its shard key
+			if isinstance(error, KeyError) and error.args == (_shard_key(events[position][0]),):
+				error = KeyError(events[position][0])
+			raise error
+
+		#Gather the results back into the order of the events
+		results = [None] * len(events)
+		for shard_positions, batch_results in zip(positions, shard_results):
+			for position, result in zip(shard_positions, batch_results):
+				results[position] = result
+		return results
+
+	## Split events by the shard owning their object
+	#   The batches are in the form trigger_activate_sharded() sends as is, so a producer can
+	#   route events as it creates them, off the advancing path
+	# @param self The object pointer
+	# @param list List of (object _id, trigger key) tuples
+	# @return list One batch per worker, holding the shard keys of the objects and the trigger keys
+	def route(self, events):
+		return self._route(events)[0]
+
+	#Helper function to split events by shard, with the positions of the events of each batch
+	def _route(self, events):
+		batches = [([], []) for pipe in self._pipes]
+		positions = [[] for pipe in self._pipes]
+		for position, (object_id, key) in enumerate(events):
+			shard = shard_of(object_id, self._processes)
+			batches[shard][0].append(_shard_key(object_id))
+			batches[shard][1].append(key)
+			positions[shard].append(position)
+		return batches, positions
+
+	## Activate batches of triggers already split by shard (see route()) in parallel
+	#   Every event is processed; the error of the first failed event of the first shard
+	#   with a failure is then raised
+	# @param self The object pointer
+	# @param list One batch per worker, as returned by route()
+	# @return list For each shard, the result of trigger_activate for each of its events, in order
+	def trigger_activate_sharded(self, batches):
+		results, errors = self._activate(batches)
+		if errors:
+			raise errors[0][2]
+		return results
+
+	#Helper function to send batches split by shard to the workers
+	# @return tuple The results of each shard, and (shard, index in its batch, error) for each failed event
+	def _activate(self, batches):
+		for pipe, batch in zip(self._pipes, batches):
+			if batch[0]:
+				pipe.send(("events", batch))
+
+		results = []
+		errors = []
+		for shard, (pipe, batch) in enumerate(zip(self._pipes, batches)):
+			if not batch[0]:
+				results.append([])
+				continue
+			shard_results, shard_errors = pipe.recv()
+			results.append(shard_results)
+			errors.extend((shard, index, error) for index, error in shard_errors)
+		return results, errors
+
+	## Copy the state held by the shards back into the engine's objects
+	# @param self The object pointer
+	def sync(self):
+		for pipe in self._pipes:
+			pipe.send(("collect",))
+		for pipe in self._pipes:
+			for key, state, triggers in pipe.recv():
+				it_object = self._engine.get_object(self._ids[key])
+				it_object.set_current_state(state)
+				for key in triggers:
+					it_object.trigger_activate(key)
+
+	## Stop the workers
+	# @param self The object pointer
+	def close(self):
+		for pipe in self._pipes:
+			pipe.send(("stop",))
+		for worker in self._workers:
+			worker.join()
+		self._pipes = []
+		self._workers = []
+		self._ids = {}
+
+## Write-behind persistence for a workflow engine
+#   Objects notify the buffer when they change; the buffer holds each changed object
+#   once, so repeated changes collapse into one write. A background thread writes the
+#   pending objects with a bulk write once flush_size of them are pending or the oldest
+#   change is interval seconds old. Callers only wait on the database when more than
+#   max_pending objects are pending (backpressure) or at flush()/close(), which also
+#   write the changed states, the workflow document and the armed timers.
+#   Create one with Cocopan.write_behind().
+class WriteBehind:
 
+	## Class constructor
+	# @param self The object pointer
+	# @param Cocopan The workflow engine
+	# @param int Number of pending objects that triggers a write
+	# @param float Seconds a change may wait before it is written
+	# @param int Number of pending objects at which changes block until written
+	def __init__(self, engine, flush_size=1000, interval=1.0, max_pending=100000):
+		self._engine = engine
+		self._flush_size = flush_size
+		self._interval = interval
+		self._max_pending = max_pending
+		self._condition = threading.Condition()
+		#Changed objects keyed by id(), and when the oldest of them changed
+		self._pending = {}
+		self._oldest = None
+		self._writing = False
+		#The objects being written by the flusher, keyed by id()
+		self._batch = {}
+		self._flush_requested = False
+		self._stopping = False
+		self._error = None
+		#State revisions as last written, keyed by state _id
+		self._revisions = {}
+		self._metrics = {"flushes": 0, "written": 0, "errors": 0, "blocked": 0, "last_flush_seconds": 0.0}
+		self._thread = None
+
+	## Start the background flusher
+	# @param self The object pointer
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name="cocopan-write-behind")
+		self._thread.daemon = True
+		self._thread.start()
 
+	## Record a changed object (called by the object)
+	# @param self The object pointer
+	# @param Object The changed object
+	def mark(self, it_object):
+		key = id(it_object)
+		if key in self._pending:
+			return
+		with self._condition:
+			if not self._pending:
+				self._oldest = time.time()
+			self._pending[key] = it_object
+			if len(self._pending) >= self._flush_size:
+				self._condition.notify_all()
+			if len(self._pending) >= self._max_pending and not self._stopping:
+				self._metrics["blocked"] = self._metrics["blocked"] + 1
+				while len(self._pending) >= self._max_pending and self._error == None:
+					self._condition.wait()
+
+	## Check if an object has changes the buffer has not written yet
+	# @param self The object pointer
+	# @param Object The object
+	# @return bool True if the object is pending or being written
+	def holds(self, it_object):
+		key = id(it_object)
+		return key in self._pending or key in self._batch
+
+	## Write everything pending, and the changed states, workflow document and timers
+	#   Raises the error of the last failed background write, if any
+	# @param self The object pointer
+	def flush(self):
+		with self._condition:
+			self._error = None
+			self._flush_requested = True
+			self._condition.notify_all()
+			while (self._pending or self._writing) and self._error == None:
+				self._condition.wait()
+			self._flush_requested = False
+			error = self._error
+		if error != None:
+			raise error
+		self._write_states()
+		self._engine._save_workflow()
+		self._engine._save_timers()
+		self._engine._save_calls()
+
+	## Flush and stop the background flusher
+	#   The engine goes back to explicit saves
+	# @param self The object pointer
+	def close(self):
+		try:
+			self.flush()
+		finally:
+			with self._condition:
+				self._stopping = True
+				self._condition.notify_all()
+			if self._thread != None:
+				self._thread.join()
+				self._thread = None
+			self._engine._detach_write_behind(self)
+
+	## Get the buffer metrics
+	# @param self The object pointer
+	# @return dict Pending objects (queue depth), lag (seconds since the oldest pending change), and write counters
+	def metrics(self):
+		with self._condition:
+			metrics = dict(self._metrics)
+			metrics["pending"] = len(self._pending)
+			metrics["lag"] = time.time() - self._oldest if self._oldest != None else 0.0
+		return metrics
+
+	#Helper function run by the background flusher
+	def _run(self):
+		while True:
+			with self._condition:
+				while True:
+					if self._pending and (self._flush_requested or len(self._pending) >= self._flush_size or time.time() - self._oldest >= self._interval):
+						break
+					if self._stopping:
+						return
+					self._condition.wait(self._interval)
+				batch = self._pending
+				self._batch = batch
+				self._pending = {}
+				self._oldest = None
+				self._writing = True
+				#Wake the callers waiting for room
+				self._condition.notify_all()
+			start = time.time()
+			error = None
+			try:
+				self._write_objects(list(batch.values()))
+			except Exception as exception:
+				error = exception
+				logging.getLogger("cocopan").warning("Write-behind flush of %d objects failed: %s", len(batch), exception)
+			with self._condition:
+				self._writing = False
+				self._batch = {}
+				if error != None:
+					#Keep the objects pending (after newer changes) and retry after the interval
+					self._metrics["errors"] = self._metrics["errors"] + 1
+					self._error = error
+					for key, it_object in batch.items():
+						self._pending.setdefault(key, it_object)
+					self._oldest = time.time()
+				else:
+					self._metrics["flushes"] = self._metrics["flushes"] + 1
+					self._metrics["written"] = self._metrics["written"] + len(batch)
+					self._metrics["last_flush_seconds"] = time.time() - start
+					if _stats != None:
+						_stats.observe("write_behind.flush", time.time() - start)
+				self._condition.notify_all()
+			if error != None:
+				time.sleep(self._interval)
+
+	#Helper function to write objects with a single bulk write
+	def _write_objects(self, objects):
+		requests = []
+		for it_object in objects:
+			it_object._revise()
+			document = it_object.snapshot()
+			_id = document["_id"]
+			if it_object.is_partial():
+				requests.append(UpdateOne({"_id": _id}, {"$set": dict((key, value) for key, value in document.items() if key != "_id")}))
+			else:
+				requests.append(ReplaceOne({"_id": _id}, document))
+		engine = self._engine
+		conn = engine.db.connect(engine._db_name)
+		conn[engine._objects_collection].bulk_write(requests, ordered=False)
+
+	#Helper function to write the states changed since they were last written
+	def _write_states(self):
+		engine = self._engine
+		changed = [(state_id, state) for state_id, state in engine._states.items() if self._revisions.get(state_id) != state.get_revision()]
+		if not changed:
+			return
+		conn = engine.db.connect(engine._db_name)
+		conn[engine._states_collection].bulk_write([ReplaceOne({"_id": state_id}, state.to_dictionary()) for state_id, state in changed], ordered=False)
+		for state_id, state in changed:
+			self._revisions[state_id] = state.get_revision()
+
+
+## Dispatcher of the on-enter/on-exit hooks of the states
+#   The engine records a call for every hook as objects advance, and writes the calls
+#   to the outbox collection when it saves (in the same transaction as the objects in a
+#   transactional save), so calls survive the process and are delivered at least once.
+#   Saved calls to http(s) targets are handed, encoded as BSON in one message per save,
+#   to a delivery process whose threads POST them, so delivery never competes with the
+#   engine for the interpreter; callbacks registered with register() run on threads of
+#   the engine process. A target receives at most the concurrency of its hook calls at
+#   once, and failed calls are retried with exponential backoff. Delivered calls are
+#   removed from the outbox; calls that still fail keep their error there for redeliver().
+class HookDispatcher:
 
+	## Class constructor
+	# @param self The object pointer
+	# @param Cocopan The workflow engine
+	# @param int Number of threads delivering calls (in the delivery process, and for callbacks)
+	# @param int Number of calls handed over and not finished beyond which saved calls wait in the outbox
+	# @param int Number of retries of a failed call
+	# @param float Seconds before the first retry (doubled for every further retry)
+	# @param float Seconds to wait for a hook target to respond
+	# @param int Niceness of the delivery process, so it yields the CPU to the engine when they share one
+	def __init__(self, engine, workers=4, queue_size=10000, retries=3, backoff=0.5, timeout=5.0, niceness=10):
+		self._engine = engine
+		self._workers = workers
+		self._queue_size = queue_size
+		self._retries = retries
+		self._backoff = backoff
+		self._timeout = timeout
+		self._niceness = niceness
+		#Outbox _ids of the calls handed over and not finished
+		self._in_flight = set()
+		#Saved calls waiting for queue_size to leave room
+		self._backlog = deque()
+		#Callbacks keyed by the target name hooks refer to them with
+		self._callbacks = {}
+		#Calls finished by the callback threads, as (outbox _id, error, attempts)
+		self._reports = []
+		self._lock = threading.Lock()
+		self._metrics = {"dispatched": 0, "delivered": 0, "retried": 0, "failed": 0, "overflowed": 0}
+		self._pipe = None
+		self._process = None
+		self._delivery = None
+		#Whether the delivery process stopped
+		self._stopped = False
+
+	## Start the delivery process and the callback threads
+	# @param self The object pointer
+	def start(self):
+		self._pipe, worker_pipe = multiprocessing.Pipe()
+		self._process = multiprocessing.Process(target=_hook_process, args=(worker_pipe, self._workers, self._retries, self._backoff, self._timeout, self._niceness), name="cocopan-hooks")
+		self._process.daemon = True
+		self._process.start()
+		worker_pipe.close()
+		self._delivery = _HookDelivery(self._call_back, self._report, self._workers, self._retries, self._backoff, "cocopan-hooks")
+		self._delivery.start()
+
+	## Register a callback hooks can refer to by name
+	# @param self The object pointer
+	# @param string The target name
+	# @param function The callback, called with the event dictionary
+	def register(self, name, callback):
+		self._callbacks[name] = callback
 
+	## Hand calls written to the outbox over for delivery (called by the engine when it saves)
+	# @param self The object pointer
+	# @param list The outbox documents of the calls
+	def submit(self, calls):
+		self._collect()
+		self._metrics["dispatched"] = self._metrics["dispatched"] + len(calls)
+		room = self._queue_size - len(self._in_flight) - len(self._backlog)
+		self._metrics["overflowed"] = self._metrics["overflowed"] + max(0, len(calls) - max(0, room))
+		self._backlog.extend(calls)
+		self._send()
+
+	## Write the calls not saved yet to the outbox, and wait until every call handed over was delivered or failed
+	# @param self The object pointer
+	def flush(self):
+		self._engine._save_calls()
+		self._wait()
 
+	## Stop dispatching
+	#   The calls not saved yet are written to the outbox and calls being delivered are
+	#   finished; the calls not delivered yet stay in the outbox for redeliver()
+	# @param self The object pointer
+	def close(self):
+		try:
+			self._engine._save_calls()
+		finally:
+			self._pipe.send_bytes(b"")
+			self._delivery.close()
+			while not self._stopped:
+				self._pipe.poll(0.05)
+				self._collect()
+			self._process.join()
+			self._pipe.close()
+			self._in_flight = set()
+			self._backlog = deque()
+			self._engine._detach_hooks(self)
+
+	## Retry the calls in the outbox that are not being delivered
+	#   Each call is attempted (with the retries of the dispatcher); delivered calls are
+	#   removed from the outbox, such as calls left there by a process that stopped
+	# @param self The object pointer
+	# @param int Maximum number of calls to retry
+	# @return int Number of calls delivered
+	def redeliver(self, limit=1000):
+		self._collect()
+		busy = list(self._in_flight) + [call["_id"] for call in self._backlog]
+		calls = list(self._outbox().find({"_id": {"$nin": busy}}).limit(limit))
+		if not calls:
+			return 0
+		ids = set(call["_id"] for call in calls)
+		self._backlog.extend(calls)
+		self._send()
+		return len(ids & self._wait())
+
+	## Get the dispatcher metrics
+	# @param self The object pointer
+	# @return dict Calls handed over or waiting for room (queue depth) and delivery counters
+	def metrics(self):
+		self._collect()
+		metrics = dict(self._metrics)
+		metrics["queued"] = len(self._in_flight) + len(self._backlog)
+		metrics["unfinished"] = metrics["queued"]
+		return metrics
+
+	#Helper function to hand the waiting calls over while there is room
+	def _send(self):
+		remote = []
+		while self._backlog and len(self._in_flight) < self._queue_size:
+			call = self._backlog.popleft()
+			self._in_flight.add(call["_id"])
+			target = call["target"]
+			if target in self._callbacks:
+				self._delivery.put(call)
+			elif target.startswith("http://") or target.startswith("https://"):
+				remote.append({"_id": call["_id"], "target": target, "concurrency": call.get("concurrency", 1), "event": call["event"]})
+			else:
+				self._report(call, "Unknown hook target %s" % target, 1)
+		if remote:
+			#One encoding of the whole batch, in C
+			self._pipe.send_bytes(BSON.encode({"calls": remote}))
+
+	#Helper function to wait until every call handed over finished
+	# @return set The outbox _ids of the calls delivered meanwhile
+	def _wait(self):
+		delivered = self._collect()
+		while (self._in_flight or self._backlog) and not self._stopped:
+			self._pipe.poll(0.01)
+			delivered.update(self._collect())
+		return delivered
+
+	#Helper function to apply the finished calls to the outbox
+	# @return set The outbox _ids of the delivered calls
+	def _collect(self):
+		reports = []
+		while not self._stopped and self._pipe.poll():
+			try:
+				message = self._pipe.recv()
+			except EOFError:
+				message = None
+			#The delivery process stopped
+			if message == None:
+				self._stopped = True
+				break
+			reports.extend(message)
+		with self._lock:
+			reports.extend(self._reports)
+			self._reports = []
+		if not reports:
+			return set()
+		delivered = set()
+		requests = []
+		for _id, error, attempts in reports:
+			self._in_flight.discard(_id)
+			self._metrics["retried"] = self._metrics["retried"] + attempts - 1
+			if error == None:
+				delivered.add(_id)
+				continue
+			self._metrics["failed"] = self._metrics["failed"] + 1
+			requests.append(UpdateOne({"_id": _id}, {"$set": {"error": error, "attempts": attempts}}))
+		self._metrics["delivered"] = self._metrics["delivered"] + len(delivered)
+		outbox = self._outbox()
+		if delivered:
+			outbox.delete_many({"_id": {"$in": list(delivered)}})
+		if requests:
+			logging.getLogger("cocopan").warning("%d hook calls failed, kept in the outbox: %s", len(requests), reports[-1][1])
+			outbox.bulk_write(requests, ordered=False)
+		#Finished calls left room for waiting ones
+		self._send()
+		return delivered
+
+	#Helper function called by the callback threads when a call finished
+	def _report(self, call, error, attempts):
+		with self._lock:
+			self._reports.append((call["_id"], error, attempts))
+
+	#Helper function to call a registered callback
+	def _call_back(self, call):
+		self._callbacks[call["target"]](call["event"])
+
+	#Helper function to get the outbox collection
+	def _outbox(self):
+		engine = self._engine
+		return engine.db.connect(engine._db_name)[engine._outbox_collection]
+
+## Main loop of the hook delivery process
+#   Receives batches of calls encoded as BSON (an empty message stops it), delivers them
+#   and sends back lists of (outbox _id, error, attempts) for the finished calls, error
+#   None when it was delivered, and None once it stopped. Calls not started when it
+#   stops are not reported. Batches are received on a thread of their own, so a large
+#   batch is never held up by reports the dispatcher has not read yet.
+# @param Connection The pipe to the dispatcher
+# @param int Number of delivery threads
+# @param int Number of retries of a failed call
+# @param float Seconds before the first retry
+# @param float Seconds to wait for a hook target to respond
+# @param int Niceness added to the process, so delivery yields the CPU to the engine
+def _hook_process(pipe, workers, retries, backoff, timeout, niceness):
+	if niceness:
+		os.nice(niceness)
+	reports = []
+	lock = threading.Lock()
+	def report(call, error, attempts):
+		with lock:
+			reports.append((call["_id"], error, attempts))
+	poster = _HookPoster(timeout)
+	delivery = _HookDelivery(poster.call, report, workers, retries, backoff, "cocopan-hooks-delivery")
+	delivery.start()
+	stopped = threading.Event()
+	def receive():
+		try:
+			while True:
+				data = pipe.recv_bytes()
+				if not data:
+					break
+				for call in BSON(data).decode()["calls"]:
+					delivery.put(call)
+		except EOFError:
+			pass
+		delivery.close()
+		stopped.set()
+	receiver = threading.Thread(target=receive, name="cocopan-hooks-receiver")
+	receiver.daemon = True
+	receiver.start()
+	while True:
+		done = stopped.wait(0.05)
+		with lock:
+			finished = reports[:]
+			del reports[:]
+		if finished:
+			pipe.send(finished)
+		if done:
+			break
+	pipe.send(None)
+	pipe.close()
+
+#Helper class POSTing calls to http(s) targets over keep-alive connections of each thread
+class _HookPoster:
+
+	def __init__(self, timeout):
+		self._timeout = timeout
+		#Connections of each thread keyed by (scheme, host)
+		self._local = threading.local()
+
+	#Helper function to POST the event of a call as JSON
+	def call(self, call):
+		url = call["target"]
+		body = json_util.dumps(call["event"]).encode("utf-8")
+		parts = urlsplit(url)
+		connections = getattr(self._local, "connections", None)
+		if connections == None:
+			connections = self._local.connections = {}
+		key = (parts.scheme, parts.netloc)
+		connection = connections.get(key)
+		if connection == None:
+			factory = HTTPSConnection if parts.scheme == "https" else HTTPConnection
+			connection = connections[key] = factory(parts.netloc, timeout=self._timeout)
+		path = parts.path or "/"
+		if parts.query:
+			path = path + "?" + parts.query
+		try:
+			connection.request("POST", path, body, {"Content-Type": "application/json"})
+			response = connection.getresponse()
+			response.read()
+		except Exception:
+			#Reconnect on the next call
+			connection.close()
+			del connections[key]
+			raise
+		if response.status >= 400:
+			raise ValueError("%s answered %d %s" % (url, response.status, response.reason))
+
+#Helper class delivering calls with a bounded pool of threads
+#   A target receives at most the concurrency of its calls at once: further calls wait for
+#   a thread already delivering to it, so they never hold up the other targets. Every call
+#   finished (delivered, or failed after the retries) is passed to report.
+class _HookDelivery:
+
+	def __init__(self, deliver, report, workers, retries, backoff, name):
+		self._deliver_call = deliver
+		self._report = report
+		self._workers = workers
+		self._retries = retries
+		self._backoff = backoff
+		self._name = name
+		self._condition = threading.Condition()
+		#Calls waiting for a thread, and calls waiting for a slot of their target keyed by target
+		self._queue = deque()
+		self._waiting = {}
+		#Calls being delivered keyed by target
+		self._active = {}
+		self._stopping = False
+		self._threads = []
+
+	#Helper function to start the threads
+	def start(self):
+		for index in range(self._workers):
+			thread = threading.Thread(target=self._run, name="%s-%d" % (self._name, index))
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	#Helper function to queue a call
+	def put(self, call):
+		with self._condition:
+			self._queue.append(call)
+			self._condition.notify()
+
+	#Helper function to finish the calls being delivered and stop the threads
+	#   Calls not started are dropped (they stay in the outbox)
+	def close(self):
+		with self._condition:
+			self._stopping = True
+			self._queue.clear()
+			self._waiting = {}
+			self._condition.notify_all()
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+
+	#Helper function run by the threads
+	def _run(self):
+		while True:
+			with self._condition:
+				while not self._queue:
+					if self._stopping:
+						return
+					self._condition.wait()
+				call = self._queue.popleft()
+				target = call["target"]
+				#Calls beyond the concurrency of the target wait for a thread delivering to it
+				if self._active.get(target, 0) >= call.get("concurrency", 1):
+					self._waiting.setdefault(target, deque()).append(call)
+					call = None
+				else:
+					self._active[target] = self._active.get(target, 0) + 1
+			while call != None:
+				self._deliver(call)
+				with self._condition:
+					waiting = self._waiting.get(target)
+					call = waiting.popleft() if waiting and not self._stopping else None
+					if call == None:
+						self._waiting.pop(target, None)
+						self._active[target] = self._active[target] - 1
+
+	#Helper function to deliver a call, retrying with backoff
+	def _deliver(self, call):
+		attempt = 0
+		while True:
+			try:
+				self._deliver_call(call)
+			except Exception as exception:
+				if attempt < self._retries and not self._stopping:
+					time.sleep(self._backoff * (2 ** attempt))
+					attempt = attempt + 1
+					continue
+				self._report(call, "%s: %s" % (type(exception).__name__, exception), attempt + 1)
+				return
+			self._report(call, None, attempt + 1)
+			return
+
+if __name__ == "__main__":
+	workflow = Cocopan()
+	workflow.set_db_name("test10")
+	workflow.set_state_collection("states")
+	workflow.set_object_collection("objects")
+	workflow.set_workflow_collection("workflowss")
+	workflow.set_definition_collection("definitions")
+	workflow.set_queue_collection("queue")
+	workflow.set_timer_collection("timers")
+	if workflow.load("test_test8"):
+		#workflow.get_state("m1").remove_transition("m2")
+		workflow.get_state("m1").transition("m2").condition_remove(1)
+		workflow.get_state("m1").transition("m2").condition_remove(0)
+		workflow.visualize_it()
+		#workflow.save()
+	else:
+		#M1 state
+		state1 = workflow.new_state("m1")
+		state1.set_name("M1")
+		#M2 state
+		state2 = workflow.new_state("m2")
+		state2.set_name("M2")
+		#M3 state
+		state3 = workflow.new_state("m3")
+		state3.set_name("M3")
+		#M4 state
+		state4 = workflow.new_state("m4")
+		state4.set_name("M4")
+		#M5 state
+		state5 = workflow.new_state("m5")
+		state5.set_name("M5")
+
+		workflow.new_object(state1)
+
+		#Create a new transition from state1 to state 2
+		state1.add_transition(state2)
+
+		state1.transition(state2).trigger_add("signature_advisor")
+		state1.transition(state2).trigger_add("signature_dean")
+
+		state1.transition(state2).condition_add(["signature_advisor", "signature_dean"])
+
+		#Create a new transition from state 2 to state 3
+		state2.add_transition(state3)
+
+		state2.transition(state3).trigger_add("test_completed")
+		state2.transition(state3).trigger_add("test_grade_accepted")
+		state2.transition(state3).condition_add(["test_completed", "test_grade_accepted"])
+
+		state2.transition(state3).trigger_add("test_exmempted")
+		state2.transition(state3).condition_add(["test_exempted"])
+
+		#Create a new fork transition from 3 to 4 or 5
+		state3.add_transition(state4)
+		state3.add_transition(state5)
+
+		state3.transition(state4).trigger_add("assessment_soft_skills_complete")
+		state3.transition(state4).trigger_add("advisor_signature")
+		state3.transition(state4).trigger_add("system_override")
+		state3.transition(state4).condition_add(["assessment_soft_skills_complete", "assessment_soft_skills_complete"])
+		state3.transition(state4).condition_add(["system_override"])
+
+		state3.transition(state5).trigger_add("career_change_decision")
+		state3.transition(state5).trigger_add("advisor_signature")
+		state3.transition(state5).trigger_add("dean_signature")
+		state3.transition(state5).trigger_add("system_override")
+		state3.transition(state5).condition_add(["career_change_decision", "advisor_signature", "dean_signature"])
+		state3.transition(state5).condition_add(["system_override"])
+		#system_override activates both forks, M4 takes precedence
+		state3.transition(state4).set_priority(1)
+
+
+
+		#Should the student move on?
+		print state1.transition(state2).isActivated()
+
+		#Create a new object in the workflow
+		#workflow.new_object(state1.get_state_id())
+
+		workflow.publish()
+		workflow.save()
@@ -0,0 +1,42 @@
+## @package test_condition_stats
+# Tests of the condition fan-in histograms on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase
+
+
+class ConditionStatsTest(unittest.TestCase):
+
+	def test_histogram_counts_activated_triggers(self):
+		engine = Cocopan(database=MemoryDatabase())
+		engine.set_db_name("cocopan_test")
+		engine.set_workflow_collection("workflows")
+		engine.set_state_collection("states")
+		engine.set_object_collection("objects")
+		engine.load("stats")
+		start_state = engine.new_state("start")
+		end_state = engine.new_state("end")
+		transition = start_state.add_transition(end_state)
+		for key in ("signed", "paid", "shipped"):
+			transition.trigger_add(key)
+		transition.condition_add(["signed", "paid"])
+		transition.condition_add(["shipped"])
+		engine.publish()
+		objects = engine.new_objects(start_state, 4)
+		objects[0].trigger_activate("signed")
+		objects[1].trigger_activate("signed")
+		objects[1].trigger_activate("shipped")
+		engine.save()
+
+		stats = engine.condition_stats("start")
+		self.assertEqual([(entry["condition"], entry["histogram"]) for entry in stats], [(["signed", "paid"], [2, 2, 0]), (["shipped"], [3, 1])])
+
+
+if __name__ == "__main__":
+	unittest.main()
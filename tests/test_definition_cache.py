@@ -0,0 +1,69 @@
+## @package test_definition_cache
+# Tests of loading states from the shared definition files on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase
+
+
+class MappedLoadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.database = MemoryDatabase()
+		engine = self.engine()
+		draft = engine.new_state("draft")
+		draft.set_name("Draft")
+		review = engine.new_state("review")
+		transition = draft.add_transition(review)
+		transition.trigger_add("submit")
+		transition.condition_add(["submit"])
+		transition.timer_add("expire", 60)
+		engine.publish()
+		engine.save()
+		self.states = self.database.connect("cocopan_test")["states"]
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	#Helper function to get an engine loading the workflow with the definition files enabled
+	def engine(self):
+		engine = Cocopan(database=self.database)
+		engine.set_db_name("cocopan_test")
+		engine.set_workflow_collection("workflows")
+		engine.set_state_collection("states")
+		engine.set_object_collection("objects")
+		engine.set_definition_collection("definitions")
+		engine.set_definition_cache(self.directory)
+		engine.load("mapped")
+		return engine
+
+	def test_states_are_read_from_the_file(self):
+		#Without the state documents the states can only come from the definition file
+		self.states.delete_many({})
+		engine = self.engine()
+		self.assertEqual(sorted(engine.get_state_ids()), ["draft", "review"])
+		draft = engine.get_state("draft")
+		self.assertEqual(draft.get_name(), "Draft")
+		self.assertEqual(draft.get_transitions()["review"].get_timers(), {"expire": 60})
+		self.assertEqual(engine.publish().get_version(), engine.definition().get_version())
+
+	def test_states_changed_since_are_read_from_mongodb(self):
+		self.engine().define({"states": {"draft": {"name": "Changed", "transitions": {"review": {"triggers": ["submit"], "conditions": [["submit"]]}}}}})
+		self.assertEqual(self.engine().get_state("draft").get_name(), "Changed")
+
+	def test_missing_file_reads_mongodb(self):
+		for name in os.listdir(self.directory):
+			os.remove(os.path.join(self.directory, name))
+		self.assertEqual(self.engine().get_state("draft").get_name(), "Draft")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,153 @@
+## @package test_hooks
+# Tests of state hooks written to the outbox and dispatched to registered callbacks on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase
+
+
+class CreationHooksTest(unittest.TestCase):
+
+	def setUp(self):
+		self.engine = Cocopan(database=MemoryDatabase())
+		self.engine.set_db_name("cocopan_test")
+		self.engine.set_outbox_collection("outbox")
+		self.engine.load("hooks")
+		self.events = []
+
+	def tearDown(self):
+		self.dispatcher.close()
+
+	#Helper function to hook both events of a state, publish and start dispatching to a callback
+	def dispatch(self, state):
+		state.add_hook("enter", "record")
+		state.add_hook("exit", "record")
+		self.engine.publish()
+		self.dispatcher = self.engine.hooks(workers=1)
+		self.dispatcher.register("record", self.events.append)
+
+	def test_creation_enters_start_state(self):
+		start_state = self.engine.new_state("start")
+		end_state = self.engine.new_state("end")
+		transition = start_state.add_transition(end_state)
+		transition.trigger_add("go")
+		transition.condition_add(["go"])
+		self.dispatch(start_state)
+		self.engine.new_object(start_state)
+		self.dispatcher.flush()
+		self.assertEqual([(event["event"], event["from"], event["to"]) for event in self.events], [("enter", None, "start")])
+
+	def test_creation_enters_fork_start_state(self):
+		fork = self.engine.new_state("fork")
+		fork.set_fork(True)
+		for branch in ("left", "right"):
+			transition = fork.add_transition(self.engine.new_state(branch))
+			transition.trigger_add("go")
+			transition.condition_add(["go"])
+		self.dispatch(fork)
+		it_object = self.engine.new_object(fork)
+		self.dispatcher.flush()
+		self.assertEqual([(event["event"], event["from"], event["to"]) for event in self.events], [("enter", None, "fork")])
+		self.assertEqual(sorted(it_object.get_tokens()), ["left", "right"])
+
+
+class OutboxTest(unittest.TestCase):
+
+	def setUp(self):
+		self.database = MemoryDatabase()
+		self.engine = self.new_engine("hooks")
+		self.engine.set_outbox_collection("outbox")
+		self.outbox = self.database.connect("cocopan_test")["outbox"]
+		self.events = []
+		self.failures = 0
+
+	#Helper function to get an engine on the shared database
+	def new_engine(self, workflow_id):
+		engine = Cocopan(database=self.database)
+		engine.set_db_name("cocopan_test")
+		engine.load(workflow_id)
+		return engine
+
+	#Helper function to publish a two state workflow calling a hook on entering its end state
+	# @return string The _id of an object in the start state
+	def publish(self):
+		start_state = self.engine.new_state("start")
+		end_state = self.engine.new_state("end")
+		transition = start_state.add_transition(end_state)
+		transition.trigger_add("go")
+		transition.condition_add(["go"])
+		end_state.add_hook("enter", "record")
+		self.engine.publish()
+		return self.engine.new_object(start_state).get_field("_id")
+
+	#Helper function to start dispatching to the record callback
+	def dispatch(self, retries=3):
+		dispatcher = self.engine.hooks(workers=1, retries=retries, backoff=0)
+		self.addCleanup(dispatcher.close)
+		dispatcher.register("record", self.record)
+		return dispatcher
+
+	#Helper function recording an event, failing while failures are left
+	def record(self, event):
+		if self.failures:
+			self.failures = self.failures - 1
+			raise RuntimeError("unavailable")
+		self.events.append(event)
+
+	def test_hooks_need_an_outbox(self):
+		engine = self.new_engine("no_outbox")
+		self.assertRaises(ValueError, engine.hooks)
+
+	def test_calls_are_written_on_save_and_removed_once_delivered(self):
+		object_id = self.publish()
+		self.engine.trigger_activate(object_id, "go")
+		self.assertEqual(list(self.outbox.find({})), [])
+		self.engine.save()
+		calls = list(self.outbox.find({}))
+		self.assertEqual([(call["target"], call["event"]["object"], call["event"]["to"]) for call in calls], [("record", object_id, "end")])
+		#Calls saved without a dispatcher are delivered by redeliver()
+		dispatcher = self.dispatch()
+		self.assertEqual(dispatcher.redeliver(), 1)
+		self.assertEqual([(event["event"], event["from"], event["to"]) for event in self.events], [("enter", "start", "end")])
+		self.assertEqual(list(self.outbox.find({})), [])
+
+	def test_failed_calls_stay_in_the_outbox(self):
+		object_id = self.publish()
+		dispatcher = self.dispatch(retries=1)
+		self.failures = 2
+		self.engine.trigger_activate(object_id, "go")
+		dispatcher.flush()
+		self.assertEqual(self.events, [])
+		calls = list(self.outbox.find({}))
+		self.assertEqual([(call["attempts"], call["error"]) for call in calls], [(2, "RuntimeError: unavailable")])
+		self.assertEqual(dispatcher.metrics()["failed"], 1)
+		self.assertEqual(dispatcher.redeliver(), 1)
+		self.assertEqual(len(self.events), 1)
+		self.assertEqual(list(self.outbox.find({})), [])
+
+	def test_return_calls_exit_hooks_of_terminal_state(self):
+		child = self.new_engine("child")
+		review = child.new_state("review")
+		approved = child.new_state("approved")
+		transition = review.add_transition(approved)
+		transition.trigger_add("approve")
+		transition.condition_add(["approve"])
+		approved.add_hook("exit", "record")
+		child.publish()
+		invoking = self.engine.new_state("invoking")
+		invoking.set_invoke("child", "review")
+		self.engine.publish()
+		dispatcher = self.dispatch()
+		it_object = self.engine.new_object(invoking)
+		self.assertEqual(self.engine.trigger_activate(it_object.get_field("_id"), "approve"), "invoking")
+		dispatcher.flush()
+		self.assertEqual([(event["event"], event["state"], event["from"], event["to"]) for event in self.events], [("exit", "approved", "approved", "invoking")])
+
+
+if __name__ == "__main__":
+	unittest.main()
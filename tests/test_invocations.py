@@ -0,0 +1,58 @@
+## @package test_invocations
+# Tests of sub-workflow invocations on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase
+
+
+class InvocationTest(unittest.TestCase):
+
+	def setUp(self):
+		self.database = MemoryDatabase()
+		child = self.engine("child")
+		review = child.new_state("review")
+		approved = child.new_state("approved")
+		transition = review.add_transition(approved)
+		transition.trigger_add("approve")
+		transition.condition_add(["approve"])
+		child.publish()
+		self.parent = self.engine("parent")
+
+	#Helper function to get an engine on the shared database
+	def engine(self, workflow_id):
+		engine = Cocopan(database=self.database)
+		engine.set_db_name("cocopan_test")
+		engine.load(workflow_id)
+		return engine
+
+	def test_creation_in_invoking_state_starts_child(self):
+		invoking = self.parent.new_state("invoking")
+		invoking.set_invoke("child", "review")
+		self.parent.publish()
+		it_object = self.parent.new_object(invoking)
+		self.assertEqual(it_object.get_current_state(), "review")
+		self.assertEqual([frame["state"] for frame in it_object.get_calls()], ["invoking"])
+
+		#The child's terminal state returns the object to the invoking state
+		self.assertEqual(self.parent.trigger_activate(it_object.get_field("_id"), "approve"), "invoking")
+		self.assertEqual(it_object.get_calls(), [])
+
+	def test_publish_checks_child_start_state(self):
+		invoking = self.parent.new_state("invoking")
+		invoking.set_invoke("child", "missing")
+		self.assertRaises(ValueError, self.parent.publish)
+
+	def test_publish_checks_child_exists(self):
+		invoking = self.parent.new_state("invoking")
+		invoking.set_invoke("unknown", "review")
+		self.assertRaises(ValueError, self.parent.publish)
+
+
+if __name__ == "__main__":
+	unittest.main()
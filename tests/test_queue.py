@@ -0,0 +1,106 @@
+## @package test_queue
+# Tests of the trigger event queue on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase
+
+
+class ProcessQueueTest(unittest.TestCase):
+
+	def setUp(self):
+		self.engine = Cocopan(database=MemoryDatabase())
+		self.engine.set_db_name("cocopan_test")
+		self.engine.set_queue_collection("queue")
+		self.engine.load("queue")
+		start_state = self.engine.new_state("start")
+		end_state = self.engine.new_state("end")
+		transition = start_state.add_transition(end_state)
+		transition.trigger_add("go")
+		transition.condition_add(["go"])
+		self.engine.publish()
+		self.object_id = self.engine.new_object(start_state).get_field("_id")
+		self.engine.save()
+		self.queue = self.engine.db.connect("cocopan_test")["queue"]
+
+	def test_missing_object_is_dead_lettered(self):
+		self.engine.enqueue("missing", "go")
+		self.engine.enqueue(self.object_id, "go")
+		self.assertEqual(self.engine.process_queue(), 2)
+		self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "end")
+
+		#Only the failed event is left, with its error, and it is not claimed again
+		remaining = list(self.queue.find({}))
+		self.assertEqual(len(remaining), 1)
+		self.assertEqual(remaining[0]["object"], "missing")
+		self.assertTrue(remaining[0]["error"].startswith("KeyError"))
+		self.assertEqual(self.engine.process_queue(), 0)
+
+	#Helper function making a rival worker win the candidates of the next claim attempts
+	def rival_claims(self, attempts):
+		update_many = self.queue.update_many
+		attempts = [attempts]
+		def racing(query, update, upsert=False):
+			if attempts[0] > 0:
+				attempts[0] = attempts[0] - 1
+				update_many({"_id": query["_id"]}, {"$set": {"lease": "rival", "expires": datetime.max}})
+			return update_many(query, update, upsert)
+		self.queue.update_many = racing
+		self.addCleanup(delattr, self.queue, "update_many")
+
+	def test_lost_race_is_not_an_empty_queue(self):
+		self.engine.enqueue(self.object_id, "go")
+		self.rival_claims(1)
+		token, events = self.engine.claim()
+		self.assertNotEqual(token, None)
+		self.assertEqual(events, [])
+		self.assertEqual(self.engine.claim(), (None, []))
+
+	def test_claim_retries_after_losing_races(self):
+		self.engine.enqueue_many([(self.object_id, "first"), (self.object_id, "go")])
+		self.rival_claims(1)
+		token, events = self.engine.claim(batch=1)
+		self.assertEqual([event["trigger"] for event in events], ["go"])
+
+	def test_process_queue_claims_again_after_losing_every_race(self):
+		self.engine.enqueue_many([(self.object_id, "t%d" % index) for index in range(5)] + [(self.object_id, "go")])
+		self.rival_claims(5)
+		self.assertEqual(self.engine.process_queue(batch=1), 1)
+		self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "end")
+	def test_object_changed_by_another_worker_is_not_overwritten(self):
+		transition = self.engine.get_state("start").get_transitions()["end"]
+		transition.trigger_add("ok")
+		transition.set_conditions([["go", "ok"]])
+		self.engine.publish()
+		self.engine.get_object(self.object_id).set_version(self.engine.definition().get_version())
+		self.engine.save()
+
+		#A second worker processes an event for the same object between the read and the write of the first
+		other = Cocopan(database=self.engine.db)
+		other.set_db_name("cocopan_test")
+		other.set_queue_collection("queue")
+		other.load("queue")
+		load_objects = self.engine._load_objects
+		def racing(object_ids, projection=None):
+			load_objects(object_ids, projection)
+			other.enqueue(self.object_id, "ok")
+			self.assertEqual(other.process_queue(), 1)
+		self.engine._load_objects = racing
+		self.engine.enqueue(self.object_id, "go")
+		self.assertEqual(self.engine.process_queue(), 1)
+		del self.engine._load_objects
+
+		#The first worker's event was released rather than overwriting the other's change
+		self.assertEqual(self.queue.find_one({})["trigger"], "go")
+		self.assertEqual(self.engine.process_queue(), 1)
+		self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "end")
+
+
+if __name__ == "__main__":
+	unittest.main()
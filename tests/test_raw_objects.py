@@ -0,0 +1,124 @@
+## @package test_raw_objects
+# Tests of objects read as raw BSON, with their changes layered on top, on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from main import Cocopan, MemoryCollection, MemoryDatabase
+
+
+## In memory collection returning raw BSON to readers asking for it, like pymongo
+#   (MemoryCollection itself always returns decoded documents)
+class RawCollection(MemoryCollection):
+
+	def with_options(self, codec_options=None, **kwargs):
+		if codec_options != None and codec_options.document_class is RawBSONDocument:
+			return RawView(self)
+		return self
+
+## View of a collection encoding the documents it reads as raw BSON
+class RawView:
+
+	def __init__(self, collection):
+		self._collection = collection
+
+	def find(self, *args, **kwargs):
+		return RawCursor(self._collection.find(*args, **kwargs))
+
+	def find_one(self, *args, **kwargs):
+		document = self._collection.find_one(*args, **kwargs)
+		return None if document == None else RawBSONDocument(BSON.encode(document))
+
+	def __getattr__(self, name):
+		return getattr(self._collection, name)
+
+## Cursor encoding the documents it yields as raw BSON
+class RawCursor:
+
+	def __init__(self, cursor):
+		self._cursor = cursor
+
+	def batch_size(self, size):
+		return self
+
+	def __iter__(self):
+		for document in self._cursor:
+			yield RawBSONDocument(BSON.encode(document))
+
+
+class RawObjectTest(unittest.TestCase):
+
+	def setUp(self):
+		self.database = MemoryDatabase()
+		self.objects = RawCollection()
+		self.database.connect("cocopan_test")["objects"] = self.objects
+		engine = self.new_engine()
+		start_state = engine.new_state("start")
+		end_state = engine.new_state("end")
+		transition = start_state.add_transition(end_state)
+		transition.trigger_add("go")
+		transition.condition_add(["go"])
+		engine.publish()
+		it_object = engine.new_object(start_state)
+		it_object.set_field("note", "kept")
+		engine.save()
+		self.object_id = it_object.get_field("_id")
+		self.stored = self.objects.find_one({"_id": self.object_id})
+
+	#Helper function to get an engine on the shared database, reading the objects of the workflow
+	def new_engine(self, projection=None):
+		engine = Cocopan(database=self.database)
+		engine.set_db_name("cocopan_test")
+		engine.set_object_collection("objects")
+		if projection != None:
+			engine.set_projection(projection)
+		engine.load("raw")
+		return engine
+
+	def test_reads_keep_the_raw_document(self):
+		it_object = self.new_engine().get_object(self.object_id)
+		self.assertTrue(isinstance(it_object._document, RawBSONDocument))
+		self.assertEqual(it_object.get_current_state(), "start")
+		self.assertEqual(it_object.get_field("note"), "kept")
+		self.assertEqual(it_object.get_field("rev"), self.stored["rev"])
+
+	def test_changes_are_layered_on_the_raw_document(self):
+		engine = self.new_engine()
+		it_object = engine.get_object(self.object_id)
+		self.assertEqual(engine.trigger_activate(self.object_id, "go"), "end")
+		it_object.set_field("note", "changed")
+		self.assertTrue(isinstance(it_object._document, RawBSONDocument))
+		self.assertEqual(it_object.get_current_state(), "end")
+		self.assertEqual(it_object.get_field("note"), "changed")
+		#A snapshot merges the changes with the untouched fields, leaving the object as it is
+		snapshot = it_object.snapshot()
+		self.assertEqual((snapshot["state"], snapshot["note"], snapshot["init_state"]), ("end", "changed", "start"))
+		self.assertEqual(sorted(snapshot.keys()), sorted(set(self.stored.keys()) | set(["triggers"])))
+		self.assertEqual(BSON(it_object._document.raw).decode()["state"], "start")
+
+	def test_saves_merge_the_changes_into_the_document(self):
+		engine = self.new_engine()
+		engine.trigger_activate(self.object_id, "go")
+		engine.get_object(self.object_id).set_field("note", "changed")
+		engine.save()
+		stored = self.objects.find_one({"_id": self.object_id})
+		self.assertEqual((stored["state"], stored["note"], stored["init_state"]), ("end", "changed", "start"))
+		self.assertNotEqual(stored["rev"], self.stored["rev"])
+		self.assertEqual(self.new_engine().get_object(self.object_id).get_current_state(), "end")
+
+	def test_saves_of_projected_objects_keep_the_fields_not_loaded(self):
+		engine = self.new_engine("engine")
+		self.assertEqual(engine.trigger_activate(self.object_id, "go"), "end")
+		engine.save()
+		stored = self.objects.find_one({"_id": self.object_id})
+		self.assertEqual((stored["state"], stored["note"], stored["init_state"]), ("end", "kept", "start"))
+
+
+if __name__ == "__main__":
+	unittest.main()
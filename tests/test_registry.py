@@ -0,0 +1,51 @@
+## @package test_registry
+# Tests of the Registry hosting several workflows on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import MemoryDatabase, Registry
+
+
+class MemoryBudgetTest(unittest.TestCase):
+
+	#Helper function to get a registry on the in memory backend
+	def registry(self, memory_budget=None):
+		registry = Registry(memory_budget=memory_budget)
+		registry.db = MemoryDatabase()
+		registry.set_db_name("cocopan_test")
+		registry.set_workflow_collection("workflows")
+		registry.set_state_collection("states")
+		registry.set_object_collection("objects")
+		return registry
+
+	#Helper function to give a hosted workflow objects with a payload of the given size
+	def populate(self, registry, workflow_id, objects, payload):
+		engine = registry.workflow(workflow_id)
+		start_state = engine.new_state("%s-start" % workflow_id)
+		engine.new_objects(start_state, [{"payload": "x" * payload} for index in range(objects)])
+		return engine
+
+	def test_cache_bytes_counts_encoded_documents(self):
+		registry = self.registry()
+		self.populate(registry, "small", 10, 10)
+		small = registry.cache_bytes()
+		self.populate(registry, "large", 10, 1000)
+		self.assertGreater(registry.cache_bytes() - small, 10 * 1000)
+
+	def test_budget_releases_least_recently_used_by_size(self):
+		#Few large objects outweigh many small ones, which a document count would miss
+		registry = self.registry(memory_budget=50000)
+		self.populate(registry, "large", 20, 2000)
+		self.populate(registry, "small", 300, 10)
+		registry.workflow("small")
+		self.assertEqual(registry.get_workflows(), ["small"])
+		self.assertLessEqual(registry.cache_bytes(), 50000)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,77 @@
+## @package test_scheduler
+# Tests of timer triggers fired by the Scheduler on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase, Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.engine = Cocopan(database=MemoryDatabase())
+		self.engine.set_db_name("cocopan_test")
+		self.engine.set_timer_collection("timers")
+		self.engine.load("timers")
+		waiting = self.engine.new_state("waiting")
+		working = self.engine.new_state("working")
+		expired = self.engine.new_state("expired")
+		transition = waiting.add_transition(working)
+		transition.trigger_add("start")
+		transition.condition_add(["start"])
+		transition = waiting.add_transition(expired)
+		transition.trigger_add("timeout")
+		transition.condition_add(["timeout"])
+		transition.timer_add("timeout", 60)
+		transition = working.add_transition(waiting)
+		transition.trigger_add("pause")
+		transition.condition_add(["pause"])
+		self.engine.publish()
+		self.object_id = self.engine.new_object(waiting).get_field("_id")
+		self.engine.save()
+		self.timers = self.engine.db.connect("cocopan_test")["timers"]
+
+	def test_timer_fires_in_armed_state(self):
+		self.assertEqual(Scheduler(self.engine).run_pending(datetime.utcnow() + timedelta(seconds=61)), 1)
+		self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "expired")
+
+	def test_timer_of_left_and_reentered_state_is_stale(self):
+		#The timer armed on creation is due, the one armed on re-entry is not
+		self.timers.update_many({}, {"$set": {"due_at": datetime.utcnow() - timedelta(seconds=1)}})
+		self.engine.trigger_activate(self.object_id, "start")
+		self.engine.trigger_activate(self.object_id, "pause")
+		self.engine.save()
+		self.assertEqual(Scheduler(self.engine).run_pending(), 1)
+		self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "waiting")
+		self.assertEqual(self.timers.count_documents({}), 1)
+
+	def test_failed_timer_is_retried_then_dead_lettered(self):
+		#The second object is pinned to a definition that does not exist, so its trigger fails
+		broken = self.engine.new_object(self.engine.get_state("waiting"))
+		broken.set_version("missing")
+		self.engine.save()
+		self.timers.update_many({}, {"$set": {"due_at": datetime.utcnow() - timedelta(seconds=1)}})
+		scheduler = Scheduler(self.engine, retries=1, backoff=10)
+		self.assertEqual(scheduler.run_pending(), 2)
+		self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "expired")
+		timer = self.timers.find_one({})
+		self.assertEqual(self.timers.count_documents({}), 1)
+		self.assertEqual(timer["object"], broken.get_field("_id"))
+		self.assertEqual(timer["attempts"], 1)
+		self.assertTrue(timer["error"].startswith("ValueError"))
+		#Re-armed with backoff, then dead-lettered once the retry failed too
+		self.assertEqual(scheduler.run_pending(timer["due_at"] - timedelta(seconds=1)), 0)
+		self.assertEqual(scheduler.run_pending(timer["due_at"] + timedelta(seconds=31)), 1)
+		timer = self.timers.find_one({})
+		self.assertEqual(timer["attempts"], 2)
+		self.assertEqual(timer["due_at"], datetime.max)
+
+
+if __name__ == "__main__":
+	unittest.main()
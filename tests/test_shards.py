@@ -0,0 +1,54 @@
+## @package test_shards
+# Tests of ShardPool worker processes advancing objects of an in memory workflow.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase, ShardPool, shard_of
+
+
+class ShardPoolTest(unittest.TestCase):
+
+	def setUp(self):
+		self.engine = Cocopan(database=MemoryDatabase())
+		self.engine.set_db_name("cocopan_test")
+		self.engine.load("shards")
+		start_state = self.engine.new_state("start")
+		end_state = self.engine.new_state("end")
+		transition = start_state.add_transition(end_state)
+		transition.trigger_add("go")
+		transition.condition_add(["go"])
+		self.engine.publish()
+		self.object_ids = [it_object.get_field("_id") for it_object in self.engine.new_objects(start_state, 20)]
+		self.pool = ShardPool(self.engine, 2)
+		self.pool.start()
+		self.addCleanup(self.pool.close)
+
+	def test_results_keep_the_order_of_the_events(self):
+		events = [(object_id, "go" if index % 2 else "other") for index, object_id in enumerate(self.object_ids)]
+		self.assertEqual(self.pool.trigger_activate_many(events), [("end" if index % 2 else None) for index in range(20)])
+
+	def test_events_routed_ahead_of_time(self):
+		batches = self.pool.route([(object_id, "go") for object_id in self.object_ids])
+		self.assertEqual([len(keys) for keys, triggers in batches], [len([object_id for object_id in self.object_ids if shard_of(object_id, 2) == shard]) for shard in range(2)])
+		results = self.pool.trigger_activate_sharded(batches)
+		self.assertEqual(sum(len(shard_results) for shard_results in results), 20)
+		self.assertEqual(set(result for shard_results in results for result in shard_results), set(["end"]))
+		self.pool.sync()
+		self.assertEqual(set(self.engine.get_object(object_id).get_current_state() for object_id in self.object_ids), set(["end"]))
+
+	def test_unknown_object_is_named_by_its_id(self):
+		with self.assertRaises(KeyError) as raised:
+			self.pool.trigger_activate_many([(self.object_ids[0], "go"), ("missing", "go")])
+		self.assertEqual(raised.exception.args, ("missing",))
+		#The other events were still processed
+		self.pool.sync()
+		self.assertEqual(self.engine.get_object(self.object_ids[0]).get_current_state(), "end")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,82 @@
+## @package test_spec
+# Tests of the validation of declarative workflow specs.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase, spec_to_documents
+
+
+class SpecValidationTest(unittest.TestCase):
+
+	#Helper function to get the error message of an invalid spec
+	def errors(self, spec):
+		with self.assertRaises(ValueError) as context:
+			spec_to_documents(spec)
+		return str(context.exception)
+
+	def test_valid_spec(self):
+		documents = spec_to_documents({"states": {
+			"draft": {"transitions": {"review": {"triggers": ["submit"], "conditions": [["submit"]], "timers": {"expire": 60}}}},
+			"review": {},
+		}})
+		self.assertEqual(sorted(documents.keys()), ["draft", "review"])
+		self.assertEqual(documents["draft"]["transitions"][0]["conditions"], [["submit"]])
+
+	def test_states_must_be_mapping(self):
+		self.assertIn("'states' mapping", self.errors({"states": ["draft", "review"]}))
+
+	def test_state_must_be_mapping(self):
+		self.assertIn("draft: state must be a mapping", self.errors({"states": {"draft": ["review"]}}))
+
+	def test_transitions_must_be_mapping_of_mappings(self):
+		self.assertIn("draft: transitions must be a mapping", self.errors({"states": {"draft": {"transitions": ["review"]}, "review": {}}}))
+		self.assertIn("draft -> review: transition must be a mapping", self.errors({"states": {"draft": {"transitions": {"review": "submit"}}, "review": {}}}))
+
+	def test_transition_parts_must_have_their_types(self):
+		message = self.errors({"states": {"draft": {"transitions": {"review": {"triggers": "submit", "conditions": [["submit"], "submit", [["nested"]]], "timers": [60]}}}, "review": {}, "done": {"hooks": {"event": "enter"}}}})
+		self.assertIn("draft -> review: triggers must be a list", message)
+		self.assertIn("draft -> review: timers must be a mapping", message)
+		self.assertIn("draft -> review: conditions need to be lists of triggers", message)
+		self.assertIn("draft -> review: condition item ['nested']", message)
+		self.assertIn("done: hooks must be a list", message)
+
+	def test_every_problem_is_reported(self):
+		message = self.errors({"states": {"draft": {"transitions": {"missing": {}, "review": 1}}, "review": 2}})
+		self.assertEqual(len(message.splitlines()), 4)
+
+	def test_unparsable_text_raises_value_error(self):
+		#Invalid as YAML (with PyYAML installed) and as JSON
+		self.assertRaises(ValueError, spec_to_documents, "states: {draft: [")
+
+	def test_lookup_accepts_ends_stored_elsewhere(self):
+		spec = {"states": {"draft": {"transitions": {"archived": {}, "missing": {}}}}}
+		message = self.errors(spec)
+		self.assertIn("draft -> archived: unknown end state", message)
+		with self.assertRaises(ValueError) as context:
+			spec_to_documents(spec, lookup=lambda ends: [end for end in ends if end == "archived"])
+		self.assertNotIn("archived", str(context.exception))
+		self.assertIn("draft -> missing: unknown end state", str(context.exception))
+
+
+class DefineTest(unittest.TestCase):
+
+	def test_end_state_stored_only_in_mongodb(self):
+		database = MemoryDatabase()
+		for workflow_id in ("other", "defined"):
+			engine = Cocopan(database=database)
+			engine.set_db_name("cocopan_test")
+			engine.set_workflow_collection("workflows")
+			engine.set_state_collection("states")
+			engine.load(workflow_id)
+			if workflow_id == "other":
+				engine.new_state("archived")
+		self.assertEqual(engine.define({"states": {"draft": {"transitions": {"archived": {}}}}}), ["draft"])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,81 @@
+## @package test_tokens
+# Tests of AND-split and AND-join states advancing the tokens of objects on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase
+
+
+class TokenTest(unittest.TestCase):
+
+	def setUp(self):
+		self.engine = Cocopan(database=MemoryDatabase())
+		self.engine.set_db_name("cocopan_test")
+		self.engine.set_object_collection("objects")
+		self.engine.load("tokens")
+		self.start_state = self.engine.new_state("start")
+		fork = self.engine.new_state("fork")
+		fork.set_fork(True)
+		join = self.engine.new_state("join")
+		join.set_join(True)
+		self.connect(self.start_state, fork, "go")
+		for branch in ("left", "right"):
+			state = self.engine.new_state(branch)
+			self.connect(fork, state, "go")
+			self.connect(state, join, branch + "_done")
+		self.connect(join, self.engine.new_state("end"), "finish")
+		self.engine.publish()
+
+	#Helper function to add a transition activated by a single trigger
+	def connect(self, state, end_state, key):
+		transition = state.add_transition(end_state)
+		transition.trigger_add(key)
+		transition.condition_add([key])
+
+	#Helper function to create an object and move it into the fork
+	# @return string The _id of the object
+	def forked(self):
+		object_id = self.engine.new_object(self.start_state).get_field("_id")
+		self.assertEqual(self.engine.trigger_activate(object_id, "go"), "fork")
+		return object_id
+
+	def test_fork_creates_one_token_per_branch(self):
+		it_object = self.engine.get_object(self.forked())
+		self.assertEqual(it_object.get_current_state(), "fork")
+		self.assertEqual(sorted(it_object.get_tokens()), ["left", "right"])
+		self.assertEqual(it_object.get_arrived(), [])
+
+	def test_join_fires_once_every_branch_arrived(self):
+		object_id = self.forked()
+		it_object = self.engine.get_object(object_id)
+		self.assertEqual(self.engine.trigger_activate(object_id, "left_done"), "join")
+		#The left token waits at the join for the right one
+		self.assertEqual(it_object.get_current_state(), "fork")
+		self.assertEqual(sorted(it_object.get_tokens()), ["join", "right"])
+		self.assertEqual(it_object.get_arrived(), ["left"])
+		self.assertEqual(self.engine.trigger_activate(object_id, "finish"), None)
+		self.assertEqual(self.engine.trigger_activate(object_id, "right_done"), "join")
+		self.assertEqual(it_object.get_current_state(), "join")
+		self.assertEqual((it_object.get_tokens(), it_object.get_arrived()), ([], []))
+
+	def test_objects_at_finds_the_tokens_of_saved_objects(self):
+		waiting = self.forked()
+		running = self.forked()
+		self.engine.trigger_activate(waiting, "left_done")
+		self.engine.save()
+		self.assertEqual(self.engine.objects_at("join"), [waiting])
+		self.assertEqual(sorted(self.engine.objects_at("right")), sorted([waiting, running]))
+		self.assertEqual(self.engine.objects_at("left"), [running])
+		self.engine.trigger_activate(waiting, "right_done")
+		self.engine.save()
+		self.assertEqual(self.engine.objects_at("join"), [])
+		self.assertEqual(self.engine.objects_at("right"), [running])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,111 @@
+## @package test_transactions
+# Tests of transactional saves on the in memory backend, with sessions that roll back failed transactions.
+#   $ python -m unittest discover tests
+
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryCollection, MemoryDatabase, MemorySession
+
+
+## In memory database whose transactions put every collection back when they fail
+#   (MemorySession runs transactions without rolling them back)
+class RollbackDatabase(MemoryDatabase):
+
+	def start_session(self):
+		return RollbackSession(self)
+
+## Session rolling back the collections of a failed transaction
+class RollbackSession(MemorySession):
+
+	def __init__(self, database):
+		self._database = database
+
+	def with_transaction(self, callback, **kwargs):
+		collections = self._database.connect("cocopan_test")
+		saved = dict((name, copy.deepcopy(collection._documents)) for name, collection in collections.items())
+		try:
+			return callback(self)
+		except Exception:
+			for name, collection in collections.items():
+				collection._documents = saved.get(name, collection._documents.__class__())
+			raise
+
+## Collection failing every write while failing is set
+class FailingCollection(MemoryCollection):
+
+	failing = False
+
+	def replace_one(self, *args, **kwargs):
+		if self.failing:
+			raise RuntimeError("write failed")
+		return MemoryCollection.replace_one(self, *args, **kwargs)
+
+
+class TransactionalSaveTest(unittest.TestCase):
+
+	def setUp(self):
+		self.database = RollbackDatabase()
+		collections = self.database.connect("cocopan_test")
+		self.workflows = collections["workflows"] = FailingCollection()
+		self.engine = Cocopan(database=self.database)
+		self.engine.set_db_name("cocopan_test")
+		self.engine.set_workflow_collection("workflows")
+		self.engine.set_object_collection("objects")
+		self.engine.set_timer_collection("timers")
+		self.engine.load("transactions")
+		start_state = self.engine.new_state("start")
+		end_state = self.engine.new_state("end")
+		transition = start_state.add_transition(end_state)
+		transition.trigger_add("go")
+		transition.condition_add(["go"])
+		transition = end_state.add_transition(start_state)
+		transition.trigger_add("expire")
+		transition.condition_add(["expire"])
+		transition.timer_add("expire", 60)
+		self.engine.publish()
+		self.object_ids = [it_object.get_field("_id") for it_object in self.engine.new_objects(start_state, 3)]
+		self.engine.save(transactional=True)
+		self.objects = collections["objects"]
+		self.timers = collections["timers"]
+
+	#Helper function to get the states of the objects as written
+	def stored_states(self):
+		return [self.objects.find_one({"_id": object_id})["state"] for object_id in self.object_ids]
+
+	def test_failed_write_commits_nothing(self):
+		stored = [self.objects.find_one({"_id": object_id}) for object_id in self.object_ids]
+		for object_id in self.object_ids:
+			self.engine.trigger_activate(object_id, "go")
+		#The objects and states are written before the workflow document fails
+		self.workflows.failing = True
+		self.assertRaises(RuntimeError, self.engine.save, transactional=True)
+		self.assertEqual(self.stored_states(), ["start"] * 3)
+		self.assertEqual(list(self.timers.find({})), [])
+		#The objects keep their changes, and the revision they were written with
+		for it_stored, object_id in zip(stored, self.object_ids):
+			it_object = self.engine.get_object(object_id)
+			self.assertTrue(it_object._changed)
+			self.assertEqual(it_object.get_field("rev"), it_stored["rev"])
+		self.workflows.failing = False
+		self.engine.save(transactional=True)
+		self.assertEqual(self.stored_states(), ["end"] * 3)
+		self.assertEqual(len(list(self.timers.find({}))), 3)
+
+	def test_failed_batch_keeps_the_batches_committed_before_it(self):
+		for object_id in self.object_ids:
+			self.engine.trigger_activate(object_id, "go")
+		self.workflows.failing = True
+		self.assertRaises(RuntimeError, self.engine.save, transactional=True, batch_size=2)
+		#The workflow document is written with the last batch, so only the first one committed
+		self.assertEqual(sorted(self.stored_states()), ["end", "end", "start"])
+		unsaved = [state == "start" for state in self.stored_states()]
+		self.assertEqual([self.engine.get_object(object_id)._changed for object_id in self.object_ids], unsaved)
+
+
+if __name__ == "__main__":
+	unittest.main()
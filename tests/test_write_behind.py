@@ -0,0 +1,109 @@
+## @package test_write_behind
+# Tests of write-behind persistence and of reading objects with unwritten changes on the in memory backend.
+#   $ python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import Cocopan, MemoryDatabase
+
+
+## Engine with one saved object of a two trigger workflow
+class WriteBehindCase(unittest.TestCase):
+
+	def setUp(self):
+		self.engine = Cocopan(database=MemoryDatabase())
+		self.engine.set_db_name("cocopan_test")
+		self.engine.set_queue_collection("queue")
+		self.engine.set_object_collection("objects")
+		self.engine.load("reload")
+		start_state = self.engine.new_state("start")
+		end_state = self.engine.new_state("end")
+		transition = start_state.add_transition(end_state)
+		transition.trigger_add("go")
+		transition.trigger_add("ok")
+		transition.condition_add(["go", "ok"])
+		self.engine.publish()
+		self.object_id = self.engine.new_object(start_state).get_field("_id")
+		self.engine.save()
+		self.objects = self.engine.db.connect("cocopan_test")["objects"]
+
+	#Helper function to get the state of the object as written
+	def stored_state(self):
+		return self.objects.find_one({"_id": self.object_id})["state"]
+
+
+class FlushTest(WriteBehindCase):
+
+	def test_close_writes_pending_changes(self):
+		buffer = self.engine.write_behind(flush_size=1000, interval=60)
+		self.engine.trigger_activate(self.object_id, "go")
+		self.engine.trigger_activate(self.object_id, "ok")
+		self.assertEqual(buffer.metrics()["pending"], 1)
+		self.assertEqual(self.stored_state(), "start")
+		buffer.close()
+		self.assertEqual(self.stored_state(), "end")
+		self.assertEqual(buffer.metrics()["pending"], 0)
+
+	def test_repeated_changes_are_written_once(self):
+		buffer = self.engine.write_behind(flush_size=1000, interval=60)
+		it_object = self.engine.get_object(self.object_id)
+		self.engine.trigger_activate(self.object_id, "go")
+		for index in range(5):
+			it_object.set_field("count", index)
+		self.engine.trigger_activate(self.object_id, "ok")
+		buffer.flush()
+		metrics = buffer.metrics()
+		self.assertEqual((metrics["flushes"], metrics["written"]), (1, 1))
+		stored = self.objects.find_one({"_id": self.object_id})
+		self.assertEqual((stored["state"], stored["count"]), ("end", 4))
+		buffer.close()
+		self.assertEqual(buffer.metrics()["flushes"], 1)
+
+	def test_reading_refreshes_objects_once_written(self):
+		buffer = self.engine.write_behind(flush_size=1000, interval=60)
+		try:
+			self.engine.get_object(self.object_id).set_field("count", 1)
+			buffer.flush()
+			#Written objects are no longer held by the buffer, so reading replaces them
+			self.objects.update_one({"_id": self.object_id}, {"$set": {"triggers": ["go"]}})
+			self.engine.enqueue(self.object_id, "ok")
+			self.assertEqual(self.engine.process_queue(), 1)
+			self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "end")
+		finally:
+			buffer.close()
+		self.assertEqual(self.stored_state(), "end")
+
+
+class ReloadTest(WriteBehindCase):
+
+	def test_reading_keeps_unsaved_changes(self):
+		self.engine.trigger_activate(self.object_id, "go")
+		self.engine.enqueue(self.object_id, "ok")
+		self.assertEqual(self.engine.process_queue(), 1)
+		self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "end")
+		self.assertEqual(self.objects.find_one({"_id": self.object_id})["state"], "end")
+
+	def test_reading_refreshes_saved_objects(self):
+		self.objects.update_one({"_id": self.object_id}, {"$set": {"triggers": ["go"]}})
+		self.engine.enqueue(self.object_id, "ok")
+		self.engine.process_queue()
+		self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "end")
+
+	def test_reading_keeps_changes_pending_in_write_behind(self):
+		buffer = self.engine.write_behind(flush_size=1000, interval=60)
+		try:
+			self.engine.trigger_activate(self.object_id, "go")
+			self.engine.enqueue(self.object_id, "ok")
+			self.engine.process_queue()
+			self.assertEqual(self.engine.get_object(self.object_id).get_current_state(), "end")
+		finally:
+			buffer.close()
+		self.assertEqual(self.objects.find_one({"_id": self.object_id})["state"], "end")
+
+
+if __name__ == "__main__":
+	unittest.main()